@@ -19,14 +19,21 @@ finally:
     del _get_version, _PackageNotFoundError
 
 from .functions import *  # noqa: E403
-from .frames import read_excel_from_biologists  # noqa: E401
+from .frames import read_excel_from_biologists, read_excel_workbooks  # noqa: E401
 from .genomics import (
     reverse_complement,  # noqa: E401
     get_one_letter_amino_acid_code,  # noqa: E401
     get_three_letter_amino_acid_code,  # noqa: E401
 )
-from .mutalizer import CodonComparison, extract_codon_from_sequence  # noqa: E401
-from .fastq import count_most_common_sequences
+from .mutalizer import (
+    CodonComparison,  # noqa: E401
+    extract_codon_from_sequence,  # noqa: E401
+    get_codon_comparison,  # noqa: E401
+    annotate_from_effect_table,  # noqa: E401
+)
+from .fastq import count_most_common_sequences, count_umi_sequences, demultiplex
+from .collapse import collapse_sequence_counts
+from .library import count_library_variants
 
 
 __all__ = [
@@ -35,6 +42,13 @@ __all__ = [
     "get_three_letter_amino_acid_code",
     "CodonComparison",
     "extract_codon_from_sequence",
+    "get_codon_comparison",
+    "annotate_from_effect_table",
     "read_excel_from_biologists",
+    "read_excel_workbooks",
     "count_most_common_sequences",
+    "demultiplex",
+    "count_umi_sequences",
+    "collapse_sequence_counts",
+    "count_library_variants",
 ]
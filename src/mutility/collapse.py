@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+collapse.py: Contains functions to collapse sequencing errors in sequence
+count tables by assigning rare sequences to abundant parent sequences.
+"""
+
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+from pandas import DataFrame
+from .util import encode_sequences, hamming_neighbours, pack_words, word_mismatches
+import numpy as np
+import pandas as pd
+
+__author__ = "Marco Mernberger"
+__copyright__ = "Copyright (c) 2020 Marco Mernberger"
+__license__ = "mit"
+
+
+def _segment_bounds(length: int, segments: int) -> List[Tuple[int, int]]:
+    edges = np.linspace(0, length, segments + 1).round().astype(int)
+    return [(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+def _pairs_within_groups(order: np.ndarray, starts: np.ndarray, sizes: np.ndarray):
+    """Returns all pairs (i, j) of members sharing a group, as indices into order."""
+    ends = np.repeat(starts + sizes, sizes)
+    positions = np.repeat(starts, sizes) + (
+        np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    )
+    partners = ends - positions - 1
+    left = np.repeat(positions, partners)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(partners) - partners, partners)
+    right = left + offsets + 1
+    return order[left], order[right]
+
+
+def iterate_seed_candidates(
+    matrix: np.ndarray, max_distance: int, large_group: int = 2048, chunk_size: int = 1000000
+) -> Iterator[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+    """
+    Yields candidate pairs of sequences that share an identical seed.
+
+    Each sequence is split into max_distance + 1 segments. By the pigeonhole
+    principle, two sequences with at most max_distance mismatches agree in
+    at least one segment, so only sequences sharing a segment need to be
+    compared. Groups larger than large_group (e.g. low complexity seeds) are
+    compared directly with hamming_neighbours to avoid materializing all
+    pairs. Pairs of the other groups are yielded segment by segment in
+    chunks of about chunk_size pairs (at least one group each), and the same
+    pair may be yielded for several segments.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        Encoded sequences from encode_sequences.
+    max_distance : int
+        Maximum number of mismatches.
+    large_group : int, optional
+        Group size above which pairs are not enumerated, by default 2048.
+    chunk_size : int, optional
+        Approximate number of unverified pairs per yielded chunk, by default
+        1000000.
+
+    Yields
+    ------
+    Iterator[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]
+        Arrays of indices i < j and either the verified distances (for large
+        groups) or None if the pairs still need to be verified.
+    """
+    for start, stop in _segment_bounds(matrix.shape[1], max_distance + 1):
+        segment = np.ascontiguousarray(matrix[:, start:stop])
+        keys = segment.view(np.dtype((np.void, stop - start))).ravel()
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        group_sizes = counts[inverse[order]]
+        is_start = np.r_[True, inverse[order][1:] != inverse[order][:-1]]
+        starts = np.nonzero(is_start)[0]
+        sizes = group_sizes[starts]
+        small = (sizes > 1) & (sizes <= large_group)
+        small_starts, small_sizes = starts[small], sizes[small]
+        pairs = small_sizes * (small_sizes - 1) // 2
+        chunk_ids = (np.cumsum(pairs) - pairs) // chunk_size
+        splits = np.nonzero(np.diff(chunk_ids))[0] + 1
+        for group_starts, group_sizes in zip(
+            np.split(small_starts, splits), np.split(small_sizes, splits)
+        ):
+            if len(group_starts) == 0:
+                continue
+            i, j = _pairs_within_groups(order, group_starts, group_sizes)
+            yield np.minimum(i, j), np.maximum(i, j), None
+        for group_start, size in zip(starts[sizes > large_group], sizes[sizes > large_group]):
+            members = np.sort(order[group_start : group_start + size])
+            i, j, d = hamming_neighbours(matrix[members], max_distance=max_distance)
+            yield members[i], members[j], d
+
+
+def find_neighbours(
+    sequences: Union[List[str], np.ndarray],
+    max_distance: int = 1,
+    chunk_size: int = 1000000,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds all pairs of sequences within max_distance mismatches via a seed index.
+
+    Unlike hamming_neighbours, which compares all pairs, candidates are taken
+    from a pigeonhole seed index (see iterate_seed_candidates), so the cost
+    grows with the number of sequences sharing seeds rather than
+    quadratically.
+
+    Parameters
+    ----------
+    sequences : Union[List[str], np.ndarray]
+        Sequences or a matrix from encode_sequences.
+    max_distance : int, optional
+        Maximum number of mismatches, by default 1.
+    chunk_size : int, optional
+        Approximate number of candidate pairs gathered and verified at once,
+        which bounds the peak memory, by default 1000000.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Indices i < j and distances of all pairs within max_distance.
+    """
+    matrix = sequences if isinstance(sequences, np.ndarray) else encode_sequences(sequences)
+    n = len(matrix)
+    if n < 2:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+    words = pack_words(matrix)
+    found_keys, found_d = [], []
+    for i, j, d in iterate_seed_candidates(matrix, max_distance, chunk_size=chunk_size):
+        if d is None:
+            d = word_mismatches(words[i], words[j])
+            keep = d <= max_distance
+            i, j, d = i[keep], j[keep], d[keep]
+        found_keys.append(i.astype(np.int64) * n + j)
+        found_d.append(d)
+    if not found_keys:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+    keys, first = np.unique(np.concatenate(found_keys), return_index=True)
+    distances = np.concatenate(found_d)[first]
+    return keys // n, keys % n, distances
+
+
+def assign_parents(
+    counts: np.ndarray, i: np.ndarray, j: np.ndarray, ratio: float = 2.0
+) -> np.ndarray:
+    """
+    Assigns each sequence to a parent sequence (UMI-tools directional style).
+
+    An edge a -> b between neighbours exists if count[a] >= ratio * count[b] - 1.
+    Each sequence is attached to its most abundant parent and parents are
+    followed transitively, so every sequence ends up at the root of its
+    directional cluster.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Counts of all sequences.
+    i : np.ndarray
+        First indices of neighbouring pairs.
+    j : np.ndarray
+        Second indices of neighbouring pairs.
+    ratio : float, optional
+        Abundance ratio required for an edge, by default 2.0.
+
+    Returns
+    -------
+    np.ndarray
+        Index of the root parent for each sequence (itself for roots).
+    """
+    counts = np.asarray(counts)
+    n = len(counts)
+    # rank sequences by abundance, so that parents always have a lower rank
+    order = np.argsort(-counts, kind="stable")
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    a = np.concatenate([i, j])
+    b = np.concatenate([j, i])
+    valid = (counts[a] >= ratio * counts[b] - 1) & (rank[a] < rank[b])
+    parent_rank = np.arange(n)
+    np.minimum.at(parent_rank, rank[b[valid]], rank[a[valid]])
+    while True:
+        next_rank = parent_rank[parent_rank]
+        if (next_rank == parent_rank).all():
+            break
+        parent_rank = next_rank
+    return order[parent_rank[rank]]
+
+
+def collapse_sequence_counts(
+    df_counts: DataFrame,
+    max_distance: int = 1,
+    ratio: float = 2.0,
+) -> DataFrame:
+    """
+    Collapses sequences within max_distance mismatches into abundant parents.
+
+    Works on tables as written by count_most_common_sequences with either a
+    'Seq' column or 'Seq1' and 'Seq2' columns for paired reads, where the
+    mismatches of both mates are added up.
+
+    Parameters
+    ----------
+    df_counts : DataFrame
+        Count table with sequence column(s) and a 'Count' column.
+    max_distance : int, optional
+        Maximum number of mismatches between parent and child, by default 1.
+    ratio : float, optional
+        Parent abundance ratio, see assign_parents, by default 2.0.
+
+    Returns
+    -------
+    DataFrame
+        One row per parent with the collapsed 'Count', the parent's own count
+        as 'Count_Parent' and the number of collapsed sequences as
+        'Collapsed', sorted by 'Count'.
+    """
+    sequence_columns = ["Seq1", "Seq2"] if "Seq1" in df_counts else ["Seq"]
+    df_counts = df_counts.reset_index(drop=True)
+    matrices = [encode_sequences(df_counts[column].astype(str)) for column in sequence_columns]
+    matrix = np.hstack(matrices)
+    counts = df_counts["Count"].to_numpy()
+    i, j, _ = find_neighbours(matrix, max_distance)
+    parents = assign_parents(counts, i, j, ratio)
+    df = df_counts.loc[np.unique(parents)].copy()
+    df["Count_Parent"] = df["Count"]
+    df["Count"] = pd.Series(counts).groupby(parents).sum()
+    df["Collapsed"] = pd.Series(parents).value_counts() - 1
+    df = df.sort_values("Count", ascending=False)
+    return df
+
+
+def collapse_count_file(
+    infile: Union[Path, str],
+    outfile: Union[Path, str],
+    max_distance: int = 1,
+    ratio: float = 2.0,
+):
+    """
+    Collapses a count table written by count_most_common_sequences.
+
+    Parameters
+    ----------
+    infile : Union[Path, str]
+        Count table to read.
+    outfile : Union[Path, str]
+        Output file for the collapsed table.
+    max_distance : int, optional
+        Maximum number of mismatches between parent and child, by default 1.
+    ratio : float, optional
+        Parent abundance ratio, see assign_parents, by default 2.0.
+    """
+    outfile = Path(outfile)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    df_counts = pd.read_csv(infile, sep="\t")
+    df = collapse_sequence_counts(df_counts, max_distance, ratio)
+    df.to_csv(outfile, sep="\t", index=False)
@@ -1,10 +1,18 @@
+import numpy as np
 import pandas as pd
+import bz2
 import gzip
 import collections
+import hashlib
+import itertools
+import math
+import random
 from pathlib import Path
 from gzip import GzipFile
-from typing import BinaryIO, Union, Optional
+from typing import BinaryIO, Dict, Iterator, List, Union, Optional, Tuple
 from dataclasses import dataclass, replace
+from pandas import DataFrame
+from .instrumentation import instrumentation
 
 try:
     import string
@@ -90,7 +98,8 @@ class Fragment:
         return f"{self.Read1}\n{self.Read2}\n"
 
 
-def _open_auto(filename: str):
+def _open_auto(filename: Union[str, Path]):
+    filename = str(filename)
     if filename.endswith(".gz"):
         return gzip.open(filename, "rb")
     if filename.endswith(".bz2"):
@@ -115,7 +124,8 @@ def iterate_fastq(filename: str, reverse_reads: bool) -> Read:
             break
 
 
-def get_fastq_iterator(filepath: Path):
+def get_fastq_iterator(filepath: Union[str, Path]):
+    filepath = Path(filepath)
     if filepath.suffix == ".gz":
         fileobj = gzip.open(filepath, "r")
     else:
@@ -130,22 +140,26 @@ def read_fastq_iterator(
 
     Yield (seq, name, quality)
     """
-    row1 = file_object.readline().decode()
-    row2 = file_object.readline().decode()
-    row3 = file_object.readline().decode()
-    row4 = file_object.readline().decode()
-    while row1:
-        seq = row2[:-1]
-        quality = row4[:-1]
-        name = row1[1:-1]
-        if reverse_reads:
-            seq = seq[::-1].translate(rev_comp_table)
-            qual = qual[::-1]
-        yield (seq, name, quality)
+    try:
         row1 = file_object.readline().decode()
         row2 = file_object.readline().decode()
-        _ = file_object.readline().decode()
+        row3 = file_object.readline().decode()
         row4 = file_object.readline().decode()
+        while row1:
+            seq = row2[:-1]
+            quality = row4[:-1]
+            name = row1[1:-1]
+            if reverse_reads:
+                seq = seq[::-1].translate(rev_comp_table)
+                quality = quality[::-1]
+            yield (seq, name, quality)
+            row1 = file_object.readline().decode()
+            row2 = file_object.readline().decode()
+            _ = file_object.readline().decode()
+            row4 = file_object.readline().decode()
+    finally:
+        if instrumentation.enabled and not file_object.closed:
+            instrumentation.count("fastq.bytes_decompressed", file_object.tell())
 
 
 def count_most_common_sequences(
@@ -154,22 +168,80 @@ def count_most_common_sequences(
     r2: Optional[Union[str, Path]] = None,
     max: int = 100000,
     index: Optional[int] = None,
+    sample_seed: Optional[int] = None,
+    top_k: Optional[int] = None,
+    output_format: Optional[str] = None,
+    merge_pairs: bool = False,
+    expected_overlap: Optional[int] = None,
 ):
+    """
+    Counts the distinct read (pair) sequences and writes them as a table.
+
+    Parameters
+    ----------
+    output_file : Union[str, Path]
+        Output table with Seq (Seq1 and Seq2), Count and Example columns,
+        sorted by descending count.
+    r1 : Union[str, Path]
+        Read 1 (gzipped) FASTQ file.
+    r2 : Optional[Union[str, Path]], optional
+        Read 2 (gzipped) FASTQ file, by default None.
+    max : int, optional
+        Number of reads (pairs) to count, by default 100000.
+    index : Optional[int], optional
+        Only count the first index bases of each read, by default None.
+    sample_seed : Optional[int], optional
+        If given, the max reads are drawn uniformly from the whole input by
+        reservoir sampling with this seed instead of taking the first max
+        reads, by default None.
+    top_k : Optional[int], optional
+        Only write the top_k most common sequences, selected with a heap
+        before building the table, by default all.
+    output_format : Optional[str], optional
+        'tsv', 'parquet' or 'feather', by default inferred from the suffix
+        of output_file, see write_count_table.
+    merge_pairs : bool, optional
+        Merge overlapping read pairs with iterate_merged_reads and count the
+        merged reads as Seq, unmerged pairs are not counted, by default
+        False.
+    expected_overlap : Optional[int], optional
+        Expected overlap of the mates for merging, by default None.
+    """
     if isinstance(output_file, str):
         outfile = Path(output_file)
     else:
         outfile = output_file
     outfile.parent.mkdir(parents=True, exist_ok=True)
+    with instrumentation.stage("fastq.count_most_common_sequences"):
+        df = _count_most_common_sequences(
+            r1, r2, max, index, sample_seed, top_k, merge_pairs, expected_overlap
+        )
+    with instrumentation.stage("fastq.write_count_table"):
+        write_count_table(df, outfile, output_format)
 
-    iter1 = get_fastq_iterator(r1)
-    iterlist = [iter1]
-    if r2 is not None:
-        iter2 = get_fastq_iterator(r2)
-        iterlist.append(iter2)
+
+def _count_most_common_sequences(
+    r1, r2, max, index, sample_seed=None, top_k=None, merge_pairs=False, expected_overlap=None
+):
+    if sample_seed is not None:
+        sample = reservoir_sample(r1, max, r2, seed=sample_seed)
+        mates = 1 if r2 is None else 2
+        iterlist = [[_decode_record(records[mate]) for records in sample] for mate in range(mates)]
+    else:
+        iter1 = get_fastq_iterator(r1)
+        iterlist = [iter1]
+        if r2 is not None:
+            iter2 = get_fastq_iterator(r2)
+            iterlist.append(iter2)
+    tuples = zip(*iterlist)
+    if merge_pairs and r2 is not None:
+        pairs = itertools.islice(tuples, max)
+        tuples = zip(iterate_merged_reads(pairs, expected_overlap=expected_overlap))
+        r2 = None
     counter = collections.Counter()
     examples = {}
     count = 0
-    for tup in zip(*iterlist):
+    for tup in tuples:
         seqs = []
         names = []
         for read in tup:
@@ -184,29 +256,1048 @@ def count_most_common_sequences(
         count += 1
         if count >= max:
             break
+    if instrumentation.enabled:
+        instrumentation.count("fastq.records_read", count * len(iterlist))
+    # partial selection with a heap for top_k, a stable sort otherwise
+    most_common = counter.most_common(top_k)
+    keys = [key for key, _ in most_common]
+    counts = [n for _, n in most_common]
     if r2 is not None:
+        seq1, seq2 = (list(seqs) for seqs in zip(*keys)) if keys else ([], [])
         to_df = {
-            "Seq1": [],
-            "Seq2": [],
-            "Count": [],
-            "Example": [],
+            "Seq1": seq1,
+            "Seq2": seq2,
+            "Count": counts,
+            "Example": [examples[key] for key in keys],
         }
-        for key in counter:
-            to_df["Seq1"].append(key[0])
-            to_df["Seq2"].append(key[1])
-            to_df["Count"].append(counter[key])
-            to_df["Example"].append(examples[key])
     else:
         to_df = {
-            "Seq": [],
-            "Count": [],
-            "Example": [],
+            "Seq": [key[0] for key in keys],
+            "Count": counts,
+            "Example": [examples[key][0] for key in keys],
         }
-        for key in counter:
-            to_df["Seq"].append(key[0])
-            to_df["Count"].append(counter[key])
-            to_df["Example"].append(examples[key][0])
+    return pd.DataFrame(to_df)
+
+
+def write_count_table(
+    df: DataFrame, output_file: Union[str, Path], output_format: Optional[str] = None
+):
+    """
+    Writes a sequence count table as TSV, Parquet or Feather.
+
+    In the columnar formats, the mate sequences Seq1 and Seq2 of paired
+    reads are dictionary encoded if at most half of their values are
+    distinct and then reload as categoricals. Parquet files are zstd and
+    Feather files lz4 compressed.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Count table from count_most_common_sequences.
+    output_file : Union[str, Path]
+        Output file.
+    output_format : Optional[str], optional
+        'tsv', 'parquet' or 'feather', by default 'parquet' for '.parquet'
+        and '.pq', 'feather' for '.feather' and '.arrow' and 'tsv'
+        otherwise.
+    """
+    output_file = Path(output_file)
+    if output_format is None:
+        output_format = {
+            ".parquet": "parquet",
+            ".pq": "parquet",
+            ".feather": "feather",
+            ".arrow": "feather",
+        }.get(output_file.suffix, "tsv")
+    if output_format == "tsv":
+        df.to_csv(output_file, sep="\t", index=False)
+        return
+    if output_format not in ("parquet", "feather"):
+        raise ValueError(f"Unknown output format {output_format}.")
+    # dictionary encoding only pays off for repeated mates
+    repeated = [
+        column
+        for column in ("Seq1", "Seq2")
+        if column in df and df[column].nunique() <= len(df) // 2
+    ]
+    df = df.assign(**{column: df[column].astype("category") for column in repeated})
+    if output_format == "parquet":
+        df.to_parquet(output_file, compression="zstd", index=False)
+    else:
+        df.to_feather(output_file, compression="lz4")
+
+
+def _iterate_records(file_object: BinaryIO) -> Iterator[Tuple[bytes, bytes, bytes, bytes]]:
+    """Yields the four raw lines of each FASTQ record, including newlines."""
+    readline = file_object.readline
+    while True:
+        name = readline()
+        if not name:
+            return
+        yield name, readline(), readline(), readline()
+
+
+def _barcode_neighbours(barcodes: List[str], max_mismatches: int) -> Dict[str, str]:
+    """
+    Maps all sequences within max_mismatches substitutions to their closest
+    barcode, sequences equally close to two barcodes are left out.
+    """
+    closest: Dict[str, Tuple[int, Optional[str]]] = {}
+    for barcode in barcodes:
+        for distance in range(max_mismatches + 1):
+            for positions in itertools.combinations(range(len(barcode)), distance):
+                alternatives = [[b for b in "ACGTN" if b != barcode[i]] for i in positions]
+                for bases in itertools.product(*alternatives):
+                    neighbour = list(barcode)
+                    for i, base in zip(positions, bases):
+                        neighbour[i] = base
+                    neighbour = "".join(neighbour)
+                    previous = closest.get(neighbour)
+                    if previous is None or distance < previous[0]:
+                        closest[neighbour] = (distance, barcode)
+                    elif distance == previous[0] and previous[1] != barcode:
+                        closest[neighbour] = (distance, None)
+    return {neighbour: barcode for neighbour, (_, barcode) in closest.items() if barcode}
+
+
+class BarcodeMatcher:
+    """
+    Assigns observed barcodes to samples, tolerating sequencing errors.
+
+    All sequences within max_mismatches substitutions of a barcode are
+    precomputed into a hash, so matching is a dictionary lookup per index.
+    Dual indices are given as 'i7+i5' and corrected independently, each
+    with up to max_mismatches errors.
+
+    Parameters
+    ----------
+    barcodes : Dict[str, str]
+        Barcode per sample name.
+    max_mismatches : int, optional
+        Maximum number of mismatches per index, by default 1.
+    separator : str, optional
+        Separator of dual indices, by default '+'.
+    """
+
+    def __init__(self, barcodes: Dict[str, str], max_mismatches: int = 1, separator: str = "+"):
+        self.separator = separator
+        self.samples: Dict[Tuple[str, ...], str] = {}
+        for sample, barcode in barcodes.items():
+            key = tuple(barcode.upper().split(separator))
+            if key in self.samples:
+                raise ValueError(
+                    f"Samples {self.samples[key]} and {sample} have the same barcode {barcode}."
+                )
+            self.samples[key] = sample
+        indices = {len(key) for key in self.samples}
+        if len(indices) > 1:
+            raise ValueError("All barcodes must have the same number of indices.")
+        self.neighbours = [
+            _barcode_neighbours(sorted({key[i] for key in self.samples}), max_mismatches)
+            for i in range(indices.pop() if indices else 0)
+        ]
+
+    def match(self, barcode: str) -> Optional[str]:
+        """Returns the sample of the observed barcode or None."""
+        parts = barcode.upper().split(self.separator)
+        if len(parts) != len(self.neighbours):
+            return None
+        corrected = []
+        for part, neighbours in zip(parts, self.neighbours):
+            index = neighbours.get(part)
+            if index is None:
+                return None
+            corrected.append(index)
+        return self.samples.get(tuple(corrected))
+
+
+class FastqWriterPool:
+    """
+    Buffered writers for many output files with a bounded number of open files.
+
+    Records are collected in memory per file and appended to the file when
+    its buffer exceeds buffer_size or all buffers together exceed
+    max_buffered. At most max_open files are kept open, the least recently
+    used file is closed first. Files ending with '.gz' are gzip compressed,
+    appending to a closed file adds a gzip member, which all gzip readers
+    handle transparently.
+
+    Parameters
+    ----------
+    max_open : int, optional
+        Maximum number of open files, by default 64.
+    buffer_size : int, optional
+        Buffer size per file in bytes, by default 1 MB.
+    max_buffered : int, optional
+        Maximum size of all buffers in bytes, by default 64 MB.
+    compresslevel : int, optional
+        gzip compression level, by default 1.
+    """
+
+    def __init__(
+        self,
+        max_open: int = 64,
+        buffer_size: int = 1 << 20,
+        max_buffered: int = 64 << 20,
+        compresslevel: int = 1,
+    ):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.compresslevel = compresslevel
+        self.buffers: Dict[Path, List[bytes]] = {}
+        self.sizes: Dict[Path, int] = {}
+        self.buffered = 0
+        self.handles: "collections.OrderedDict[Path, BinaryIO]" = collections.OrderedDict()
+        self.created = set()
+
+    def write(self, filename: Path, data: bytes):
+        """Adds data to the buffer of filename."""
+        buffer = self.buffers.get(filename)
+        if buffer is None:
+            buffer = self.buffers[filename] = []
+            self.sizes[filename] = 0
+        buffer.append(data)
+        self.sizes[filename] += len(data)
+        self.buffered += len(data)
+        if self.sizes[filename] >= self.buffer_size:
+            self.flush(filename)
+        elif self.buffered >= self.max_buffered:
+            self.flush()
+
+    def _handle(self, filename: Path) -> BinaryIO:
+        handle = self.handles.get(filename)
+        if handle is not None:
+            self.handles.move_to_end(filename)
+            return handle
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        mode = "ab" if filename in self.created else "wb"
+        self.created.add(filename)
+        if filename.suffix == ".gz":
+            handle = gzip.open(filename, mode, compresslevel=self.compresslevel)
+        else:
+            handle = open(filename, mode)
+        self.handles[filename] = handle
+        return handle
+
+    def flush(self, filename: Optional[Path] = None):
+        """Writes the buffer of filename or all buffers to disk."""
+        filenames = list(self.buffers) if filename is None else [filename]
+        for name in filenames:
+            if self.sizes[name]:
+                self._handle(name).write(b"".join(self.buffers[name]))
+                self.buffered -= self.sizes[name]
+                self.buffers[name].clear()
+                self.sizes[name] = 0
 
+    def close(self):
+        """Flushes all buffers and closes all files."""
+        self.flush()
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _create_empty(filenames: Iterator[Path], pool: FastqWriterPool):
+    """Creates empty (gzip) files for all filenames the pool has not written."""
+    for filename in filenames:
+        if filename not in pool.created:
+            with gzip.open(filename, "wb") if filename.suffix == ".gz" else open(filename, "wb"):
+                pass
+
+
+def _sample_barcodes(
+    samples: Union[DataFrame, Dict[str, str]],
+    sample_column: str,
+    barcode_columns: Union[str, List[str]],
+) -> Dict[str, str]:
+    if not isinstance(samples, DataFrame):
+        names = [str(sample) for sample in samples]
+        barcodes = [str(barcode).strip().upper() for barcode in samples.values()]
+    else:
+        if isinstance(barcode_columns, str):
+            barcode_columns = [barcode_columns]
+        combined = samples[barcode_columns[0]].astype(str).str.strip().str.upper()
+        for column in barcode_columns[1:]:
+            combined = combined + "+" + samples[column].astype(str).str.strip().str.upper()
+        names = samples[sample_column].astype(str).tolist()
+        barcodes = combined.tolist()
+    duplicated = sorted(name for name, count in collections.Counter(names).items() if count > 1)
+    if duplicated:
+        raise ValueError(f"Sample names must be unique, found duplicates: {duplicated}.")
+    if "Undetermined" in names:
+        raise ValueError("The sample name 'Undetermined' is reserved for unassigned reads.")
+    return dict(zip(names, barcodes))
+
+
+def demultiplex(
+    r1: Union[str, Path],
+    output_dir: Union[str, Path],
+    samples: Union[DataFrame, Dict[str, str]],
+    r2: Optional[Union[str, Path]] = None,
+    barcode_location: str = "header",
+    max_mismatches: int = 1,
+    sample_column: str = "Sample",
+    barcode_columns: Union[str, List[str]] = "Barcode",
+    trim_barcode: bool = True,
+    compress: bool = True,
+    max_open_files: int = 64,
+    buffer_size: int = 1 << 20,
+) -> DataFrame:
+    """
+    Splits (paired) FASTQ files into one file (pair) per sample by barcode.
+
+    The input is read once and records are copied as raw bytes into the
+    per-sample outputs through a FastqWriterPool. Barcodes are matched with
+    a BarcodeMatcher, results are memoized per observed barcode. Reads
+    without a unique sample within max_mismatches go to 'Undetermined'.
+
+    Parameters
+    ----------
+    r1 : Union[str, Path]
+        Read 1 (gzipped) FASTQ file.
+    output_dir : Union[str, Path]
+        Directory for {sample}_R1.fastq(.gz) and {sample}_R2.fastq(.gz).
+    samples : Union[DataFrame, Dict[str, str]]
+        Sample sheet, e.g. from read_excel_from_biologists, or a dictionary
+        of barcode per sample. Dual indices are given as 'i7+i5'.
+    r2 : Optional[Union[str, Path]], optional
+        Read 2 (gzipped) FASTQ file, by default None.
+    barcode_location : str, optional
+        'header' for the Illumina index after the last ':' of the read 1
+        header, 'inline' for a barcode at the start of read 1 (and read 2
+        for the second index of dual barcodes), by default 'header'.
+    max_mismatches : int, optional
+        Maximum number of mismatches per index, by default 1.
+    sample_column : str, optional
+        Sample name column of a sample sheet, by default 'Sample'.
+    barcode_columns : Union[str, List[str]], optional
+        Barcode column(s) of a sample sheet, two columns for dual indices,
+        by default 'Barcode'.
+    trim_barcode : bool, optional
+        Remove inline barcodes from the written reads, by default True.
+    compress : bool, optional
+        Write gzip compressed files, by default True.
+    max_open_files : int, optional
+        Maximum number of simultaneously open output files, by default 64.
+    buffer_size : int, optional
+        Buffer size per output file in bytes, by default 1 MB.
+
+    Returns
+    -------
+    DataFrame
+        Sample, Barcode and Reads per sample, including 'Undetermined'.
+
+    Raises
+    ------
+    ValueError
+        If sample names are not unique or a sample is named 'Undetermined'.
+    """
+    if barcode_location not in ("header", "inline"):
+        raise ValueError(f"barcode_location must be 'header' or 'inline', was {barcode_location}.")
+    barcodes = _sample_barcodes(samples, sample_column, barcode_columns)
+    matcher = BarcodeMatcher(barcodes, max_mismatches)
+    inputs = [r1] if r2 is None else [r1, r2]
+    widths: List[int] = []
+    if barcode_location == "inline":
+        widths = sorted({tuple(len(part) for part in key) for key in matcher.samples})
+        if len(widths) != 1:
+            raise ValueError("Inline barcodes must all have the same length.")
+        widths = list(widths[0])
+        if len(widths) > len(inputs):
+            raise ValueError("Dual inline barcodes need read 1 and read 2.")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    suffix = ".fastq.gz" if compress else ".fastq"
+    names = list(barcodes) + ["Undetermined"]
+    outputs = [
+        [output_dir / f"{name}_R{mate + 1}{suffix}" for mate in range(len(inputs))]
+        for name in names
+    ]
+    sample_index = {name: i for i, name in enumerate(names)}
+    undetermined = len(names) - 1
+    counts = [0] * len(names)
+    memo: Dict[bytes, int] = {}
+    handles = [_open_auto(filename) for filename in inputs]
+    try:
+        with instrumentation.stage("fastq.demultiplex"), FastqWriterPool(
+            max_open_files, buffer_size
+        ) as pool:
+            for records in zip(*[_iterate_records(handle) for handle in handles]):
+                if widths:
+                    raw = b"+".join(record[1][:width] for record, width in zip(records, widths))
+                else:
+                    raw = records[0][0].rstrip().rsplit(b":", 1)[-1]
+                index = memo.get(raw)
+                if index is None:
+                    sample = matcher.match(raw.decode())
+                    index = undetermined if sample is None else sample_index[sample]
+                    if len(memo) < 1000000:
+                        memo[raw] = index
+                counts[index] += 1
+                for mate, record in enumerate(records):
+                    if trim_barcode and mate < len(widths) and index != undetermined:
+                        width = widths[mate]
+                        record = (record[0], record[1][width:], record[2], record[3][width:])
+                    pool.write(outputs[index][mate], b"".join(record))
+    finally:
+        for handle in handles:
+            handle.close()
+    # samples without reads get empty files
+    _create_empty(itertools.chain.from_iterable(outputs), pool)
+    if instrumentation.enabled:
+        instrumentation.count("fastq.records_read", sum(counts) * len(inputs))
+    return DataFrame(
+        {"Sample": names, "Barcode": list(barcodes.values()) + [""], "Reads": counts}
+    )
+
+
+def _decode_record(record: Tuple[bytes, bytes, bytes, bytes]) -> Tuple[str, str, str]:
+    """Converts a raw record to the (seq, name, quality) of read_fastq_iterator."""
+    name, seq, _, quality = (line.decode().rstrip("\n") for line in record)
+    return seq, name[1:], quality
+
+
+def _random_open(rng: random.Random) -> float:
+    """Returns a uniform random number in (0, 1)."""
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+def reservoir_sample(
+    r1: Union[str, Path],
+    k: int,
+    r2: Optional[Union[str, Path]] = None,
+    seed: int = 0,
+) -> List[Tuple[Tuple[bytes, bytes, bytes, bytes], ...]]:
+    """
+    Draws k reads (pairs) uniformly from (paired) FASTQ files in one pass.
+
+    Uses reservoir sampling with Algorithm L (Li, 1994), which draws the
+    number of records to skip between replacements instead of a random
+    number per record. Skipped records are only split into lines, not
+    decoded.
+
+    Parameters
+    ----------
+    r1 : Union[str, Path]
+        Read 1 (gzipped) FASTQ file.
+    k : int
+        Sample size.
+    r2 : Optional[Union[str, Path]], optional
+        Read 2 (gzipped) FASTQ file, by default None.
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    List[Tuple[Tuple[bytes, bytes, bytes, bytes], ...]]
+        The raw lines of the sampled records per mate, in file order.
+        Files with at most k records are returned completely.
+    """
+    rng = random.Random(seed)
+    inputs = [r1] if r2 is None else [r1, r2]
+    handles = [_open_auto(filename) for filename in inputs]
+    try:
+        records = zip(*[_iterate_records(handle) for handle in handles])
+        reservoir = list(enumerate(itertools.islice(records, k)))
+        if k > 0 and len(reservoir) == k:
+            index = k - 1
+            w = math.exp(math.log(_random_open(rng)) / k)
+            while True:
+                skip = int(math.log(_random_open(rng)) / math.log1p(-w))
+                record = next(itertools.islice(records, skip, None), None)
+                if record is None:
+                    break
+                index += skip + 1
+                reservoir[rng.randrange(k)] = (index, record)
+                w *= math.exp(math.log(_random_open(rng)) / k)
+    finally:
+        for handle in handles:
+            handle.close()
+    reservoir.sort(key=lambda item: item[0])
+    return [record for _, record in reservoir]
+
+
+def _read_name(header: bytes) -> bytes:
+    """Returns the read name of a header line without comment and /1, /2."""
+    name = header[1:].split(None, 1)[0]
+    if name[-2:] in (b"/1", b"/2"):
+        name = name[:-2]
+    return name
+
+
+def iterate_fraction(
+    fastq_file: Union[str, Path], fraction: float, seed: int = 0
+) -> Iterator[Tuple[bytes, bytes, bytes, bytes]]:
+    """
+    Yields the raw records of a seeded random fraction of reads.
+
+    Reads are kept if a keyed hash of their name is below fraction, so both
+    mates of a pair are kept or dropped together, even if R1 and R2 are
+    processed separately, and the selection is reproducible across runs and
+    machines.
+
+    Parameters
+    ----------
+    fastq_file : Union[str, Path]
+        (gzipped) FASTQ file.
+    fraction : float
+        Expected fraction of reads to keep, between 0 and 1.
+    seed : int, optional
+        Hash key, different seeds give independent samples, by default 0.
+    """
+    if not 0 <= fraction <= 1:
+        raise ValueError(f"fraction must be between 0 and 1, was {fraction}.")
+    threshold = int(fraction * 2**64)
+    key = str(seed).encode()
+    blake2b = hashlib.blake2b
+    with _open_auto(fastq_file) as handle:
+        for record in _iterate_records(handle):
+            digest = blake2b(_read_name(record[0]), digest_size=8, key=key).digest()
+            if int.from_bytes(digest, "little") < threshold:
+                yield record
+
+
+def subsample_fastq(
+    r1: Union[str, Path],
+    output_r1: Union[str, Path],
+    r2: Optional[Union[str, Path]] = None,
+    output_r2: Optional[Union[str, Path]] = None,
+    n: Optional[int] = None,
+    fraction: Optional[float] = None,
+    seed: int = 0,
+) -> int:
+    """
+    Writes a random subsample of (paired) FASTQ files.
+
+    Exactly one of n (reservoir_sample) and fraction (iterate_fraction) must
+    be given. Outputs ending with '.gz' are gzip compressed.
+
+    Parameters
+    ----------
+    r1 : Union[str, Path]
+        Read 1 (gzipped) FASTQ file.
+    output_r1 : Union[str, Path]
+        Read 1 output file.
+    r2 : Optional[Union[str, Path]], optional
+        Read 2 (gzipped) FASTQ file, by default None.
+    output_r2 : Optional[Union[str, Path]], optional
+        Read 2 output file, required with r2.
+    n : Optional[int], optional
+        Number of reads (pairs) to sample, by default None.
+    fraction : Optional[float], optional
+        Fraction of reads (pairs) to sample, by default None.
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    int
+        Number of written reads (pairs).
+
+    Raises
+    ------
+    ValueError
+        If fraction sampling selected a different number of reads from r1
+        and r2, i.e. the read names of the files do not match.
+    """
+    if (n is None) == (fraction is None):
+        raise ValueError("Either n or fraction must be given.")
+    if (r2 is None) != (output_r2 is None):
+        raise ValueError("r2 and output_r2 must be given together.")
+    inputs = [r1] if r2 is None else [r1, r2]
+    outputs = [Path(output_r1)] if r2 is None else [Path(output_r1), Path(output_r2)]
+    for output in outputs:
+        output.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    with instrumentation.stage("fastq.subsample"), FastqWriterPool() as pool:
+        if n is not None:
+            for records in reservoir_sample(r1, n, r2, seed):
+                for output, record in zip(outputs, records):
+                    pool.write(output, b"".join(record))
+                written += 1
+        else:
+            counts = []
+            for output, fastq_file in zip(outputs, inputs):
+                counts.append(0)
+                for record in iterate_fraction(fastq_file, fraction, seed):
+                    pool.write(output, b"".join(record))
+                    counts[-1] += 1
+            if len(set(counts)) > 1:
+                raise ValueError(
+                    f"Sampled {counts[0]} reads from {r1} but {counts[1]} from {r2}, are the "
+                    "read names of both files identical?"
+                )
+            written = counts[0]
+    _create_empty(outputs, pool)
+    return written
+
+
+_N = ord("N")
+
+
+def _read_matrix(sequences: List[str], width: int, right_align: bool = False) -> np.ndarray:
+    """Returns ASCII codes of sequences as a zero padded (n, width) matrix."""
+    if all(len(s) == width for s in sequences):
+        return np.frombuffer("".join(sequences).encode(), dtype=np.uint8).reshape(-1, width)
+    matrix = np.zeros((len(sequences), width), dtype=np.uint8)
+    for i, sequence in enumerate(sequences):
+        row = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        if right_align:
+            matrix[i, width - len(row) :] = row
+        else:
+            matrix[i, : len(row)] = row
+    return matrix
+
+
+def _best_overlaps(
+    r1: np.ndarray,
+    r2: np.ndarray,
+    shortest: np.ndarray,
+    overlaps: range,
+    best_overlap: np.ndarray,
+    best_mismatches: np.ndarray,
+):
+    """
+    Updates the overlap with the lowest mismatch rate per pair in place,
+    longer overlaps win ties. r1 is right aligned, r2 left aligned.
+    """
+    width = r1.shape[1]
+    # N is rare, so it is only excluded from the mismatches where present
+    with_n = np.nonzero((r1 == _N).any(axis=1) | (r2 == _N).any(axis=1))[0]
+    for overlap in overlaps:
+        if overlap > width or overlap > r2.shape[1]:
+            break
+        a, b = r1[:, width - overlap :], r2[:, :overlap]
+        mismatches = np.count_nonzero(a != b, axis=1)
+        if len(with_n):
+            a, b = a[with_n], b[with_n]
+            mismatches[with_n] = np.count_nonzero((a != b) & (a != _N) & (b != _N), axis=1)
+        # compare mismatch rates without division
+        lhs, rhs = mismatches * best_overlap, best_mismatches * overlap
+        better = (overlap <= shortest) & ((lhs < rhs) | ((lhs == rhs) & (overlap > best_overlap)))
+        best_overlap[better] = overlap
+        best_mismatches[better] = mismatches[better]
+
+
+def merge_read_pairs(
+    reads1: List[Tuple[str, str, str]],
+    reads2: List[Tuple[str, str, str]],
+    min_overlap: int = 10,
+    max_mismatch_rate: float = 0.1,
+    expected_overlap: Optional[int] = None,
+    hint_window: int = 3,
+) -> List[Optional[Tuple[str, str, str]]]:
+    """
+    Merges overlapping read pairs into single reads.
+
+    Read 2 is reverse complemented and the overlap of the end of read 1
+    with the start of read 2 with the lowest mismatch rate is chosen,
+    longer overlaps win ties. All pairs of the batch are scored at once
+    per overlap length on padded NumPy matrices. Bases of the two mates
+    disagreeing in the overlap are resolved by quality: the higher quality
+    base is taken with the quality difference (at least 2) as quality,
+    agreeing bases get the higher quality. N is never counted as mismatch.
+
+    With expected_overlap, e.g. for amplicons of known length, only
+    overlaps within hint_window of it are scored first, and only pairs
+    that do not merge there are scored for all overlaps.
+
+    Fragments shorter than a read (read-through into the adapter) are not
+    merged.
+
+    Parameters
+    ----------
+    reads1 : List[Tuple[str, str, str]]
+        (seq, name, quality) of read 1 as from read_fastq_iterator.
+    reads2 : List[Tuple[str, str, str]]
+        (seq, name, quality) of read 2, as sequenced.
+    min_overlap : int, optional
+        Minimum overlap length, by default 10.
+    max_mismatch_rate : float, optional
+        Maximum fraction of mismatches in the overlap, by default 0.1.
+    expected_overlap : Optional[int], optional
+        Expected overlap length, by default None.
+    hint_window : int, optional
+        Overlaps within this distance of expected_overlap are scored
+        first, by default 3.
+
+    Returns
+    -------
+    List[Optional[Tuple[str, str, str]]]
+        (seq, name, quality) of the merged read, with the name of read 1,
+        or None for each pair that could not be merged.
+    """
+    n = len(reads1)
+    if n == 0:
+        return []
+    seqs1 = [read[0] for read in reads1]
+    quals1 = [read[2] for read in reads1]
+    seqs2 = [reverse_complement(read[0]) for read in reads2]
+    quals2 = [read[2][::-1] for read in reads2]
+    lengths1 = np.array([len(s) for s in seqs1])
+    lengths2 = np.array([len(s) for s in seqs2])
+    width1, width2 = int(lengths1.max()), int(lengths2.max())
+    r1 = _read_matrix(seqs1, width1, right_align=True)
+    q1 = _read_matrix(quals1, width1, right_align=True)
+    r2 = _read_matrix(seqs2, width2)
+    q2 = _read_matrix(quals2, width2)
+    shortest = np.minimum(lengths1, lengths2)
+    best_overlap = np.zeros(n, dtype=np.int64)
+    best_mismatches = np.ones(n, dtype=np.int64)
+
+    def merged():
+        return (best_overlap >= min_overlap) & (
+            best_mismatches <= max_mismatch_rate * best_overlap
+        )
+
+    overlaps = range(min_overlap, min(width1, width2) + 1)
+    if expected_overlap is not None:
+        window = range(
+            max(expected_overlap - hint_window, min_overlap), expected_overlap + hint_window + 1
+        )
+        _best_overlaps(r1, r2, shortest, window, best_overlap, best_mismatches)
+        rows = np.nonzero(~merged())[0]
+        if len(rows):
+            overlap = np.zeros(len(rows), dtype=np.int64)
+            mismatches = np.ones(len(rows), dtype=np.int64)
+            _best_overlaps(r1[rows], r2[rows], shortest[rows], overlaps, overlap, mismatches)
+            best_overlap[rows], best_mismatches[rows] = overlap, mismatches
+    else:
+        _best_overlaps(r1, r2, shortest, overlaps, best_overlap, best_mismatches)
+    rows = np.nonzero(merged())[0]
+    result: List[Optional[Tuple[str, str, str]]] = [None] * n
+    if len(rows) == 0:
+        return result
+    overlap = best_overlap[rows]
+    columns = np.arange(int(overlap.max()))
+    in_overlap = columns < overlap[:, None]
+    columns1 = np.where(in_overlap, width1 - overlap[:, None] + columns, width1 - 1)
+    a = np.take_along_axis(r1[rows], columns1, axis=1)
+    qa = np.take_along_axis(q1[rows], columns1, axis=1).astype(np.int16)
+    b = r2[rows][:, : len(columns)]
+    qb = q2[rows][:, : len(columns)].astype(np.int16)
+    pick_a = ((qa >= qb) | (b == _N)) & ~((a == _N) & (b != _N))
+    bases = np.where(pick_a, a, b)
+    quality = np.where(a == b, np.maximum(qa, qb), 33 + np.maximum(np.abs(qa - qb), 2))
+    quality = np.where((a == _N) ^ (b == _N), np.where(a == _N, qb, qa), quality)
+    quality = quality.astype(np.uint8)
+    for i, row in enumerate(rows):
+        o = int(overlap[i])
+        end1 = int(lengths1[row]) - o
+        result[row] = (
+            seqs1[row][:end1] + bases[i, :o].tobytes().decode() + seqs2[row][o:],
+            reads1[row][1],
+            quals1[row][:end1] + quality[i, :o].tobytes().decode() + quals2[row][o:],
+        )
+    return result
+
+
+def iterate_merged_reads(
+    pairs: Iterator[Tuple[Tuple[str, str, str], Tuple[str, str, str]]],
+    batch_size: int = 65536,
+    **kwargs,
+) -> Iterator[Tuple[str, str, str]]:
+    """
+    Yields merged reads for a stream of read pairs, see merge_read_pairs.
+
+    Pairs are merged in batches of batch_size, pairs that cannot be merged
+    are dropped and counted as 'fastq.unmerged_pairs'.
+
+    Parameters
+    ----------
+    pairs : Iterator[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]
+        Pairs of (seq, name, quality), e.g. zip of two read_fastq_iterator.
+    batch_size : int, optional
+        Number of pairs merged at once, by default 65536.
+    **kwargs
+        Passed to merge_read_pairs.
+    """
+    pairs = iter(pairs)
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            return
+        reads1, reads2 = zip(*batch)
+        with instrumentation.stage("fastq.merge_read_pairs"):
+            merged = merge_read_pairs(list(reads1), list(reads2), **kwargs)
+        unmerged = 0
+        for read in merged:
+            if read is None:
+                unmerged += 1
+            else:
+                yield read
+        if instrumentation.enabled:
+            instrumentation.count("fastq.unmerged_pairs", unmerged)
+
+
+_umi_codes = str.maketrans("ACGT", "0123")
+
+
+def _umi_extractor(umi_pattern: Optional[str], umi_header: bool, header_separator: str):
+    """
+    Returns a function that takes (seq, name, quality) and returns the read
+    without UMI bases and the UMI.
+    """
+    if (umi_pattern is None) == (not umi_header):
+        raise ValueError("Either umi_pattern or umi_header must be given.")
+    if umi_header:
+
+        def from_header(read):
+            return read, read[1].split(None, 1)[0].rsplit(header_separator, 1)[-1]
+
+        return from_header
+    pattern = umi_pattern.upper()
+    if set(pattern) - {"N", "X"}:
+        raise ValueError(f"UMI pattern must only contain N (UMI) and X (keep), was {pattern}.")
+    if set(pattern) == {"N"}:
+        length = len(pattern)
+
+        def from_prefix(read):
+            seq, name, quality = read
+            return (seq[length:], name, quality[length:]), seq[:length]
+
+        return from_prefix
+    umi_positions = [i for i, c in enumerate(pattern) if c == "N"]
+    keep_positions = [i for i, c in enumerate(pattern) if c == "X"]
+    length = len(pattern)
+
+    def from_pattern(read):
+        seq, name, quality = read
+        umi = "".join(seq[i] for i in umi_positions)
+        kept = "".join(seq[i] for i in keep_positions) + seq[length:]
+        kept_quality = "".join(quality[i] for i in keep_positions) + quality[length:]
+        return (kept, name, kept_quality), umi
+
+    return from_pattern
+
+
+class _KeyCounter:
+    """
+    Counts uint64 keys added in batches.
+
+    Each batch is reduced to a sorted run of unique keys and counts. Runs
+    are merged into the accumulated run only once they together are at
+    least as large as it, so every key takes part in O(log n) merges
+    instead of one per batch.
+    """
+
+    def __init__(self):
+        self.runs: List[Tuple[np.ndarray, np.ndarray]] = []
+        self.pending = 0
+
+    def add(self, keys: np.ndarray):
+        run = np.unique(keys, return_counts=True)
+        self.runs.append(run)
+        self.pending += len(run[0])
+        if len(self.runs) > 1 and self.pending >= len(self.runs[0][0]):
+            self.runs = [self.result()]
+            self.pending = 0
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted unique keys and their counts."""
+        if not self.runs:
+            return np.array([], dtype=np.uint64), np.array([], dtype=np.int64)
+        if len(self.runs) == 1:
+            return self.runs[0]
+        keys, inverse = np.unique(np.concatenate([k for k, _ in self.runs]), return_inverse=True)
+        weights = np.concatenate([c for _, c in self.runs])
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys))
+        return keys, counts.astype(np.int64)
+
+
+def collapse_umis(keys: np.ndarray, counts: np.ndarray, umi_length: int) -> np.ndarray:
+    """
+    Collapses UMIs per sequence with the directional method of UMI-tools.
+
+    UMI b is merged into UMI a of the same sequence if they differ in one
+    base and count(a) >= 2 * count(b) - 1. Clusters are formed from the
+    most abundant UMIs down and each cluster is one molecule.
+
+    Neighbours are found without pairwise comparisons: flipping a 2-bit
+    base code with XOR 1, 2 or 3 gives the three substitutions at a
+    position, which are looked up in the sorted keys.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        Sorted unique packed keys, sequence id << 2 * umi_length | UMI.
+    counts : np.ndarray
+        Number of reads per key.
+    umi_length : int
+        Number of UMI bases.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the keys that start a molecule.
+    """
+    sources, targets = [], []
+    for position in range(umi_length):
+        for flip in (1, 2, 3):
+            neighbours = keys ^ np.uint64(flip << (2 * position))
+            index = np.minimum(np.searchsorted(keys, neighbours), len(keys) - 1)
+            found = np.nonzero(keys[index] == neighbours)[0]
+            sources.append(found)
+            targets.append(index[found])
+    source = np.concatenate(sources) if sources else np.array([], dtype=np.int64)
+    target = np.concatenate(targets) if targets else np.array([], dtype=np.int64)
+    directed = counts[source] >= 2 * counts[target] - 1
+    source, target = source[directed], target[directed]
+    roots = np.ones(len(keys), dtype=bool)
+    if len(source) == 0:
+        return roots
+    edges = collections.defaultdict(list)
+    for a, b in zip(source.tolist(), target.tolist()):
+        edges[a].append(b)
+    connected = np.union1d(source, target)
+    roots[connected] = False
+    visited = set()
+    # most abundant first, ties by key for reproducibility
+    for node in connected[np.lexsort((keys[connected], -counts[connected]))].tolist():
+        if node in visited:
+            continue
+        roots[node] = True
+        visited.add(node)
+        stack = [node]
+        while stack:
+            for neighbour in edges.get(stack.pop(), ()):
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    stack.append(neighbour)
+    return roots
+
+
+def count_umi_sequences(
+    output_file: Union[str, Path],
+    r1: Union[str, Path],
+    r2: Optional[Union[str, Path]] = None,
+    umi_pattern: Optional[str] = None,
+    umi_header: bool = False,
+    header_separator: str = ":",
+    max: Optional[int] = None,
+    index: Optional[int] = None,
+    collapse: bool = True,
+    output_format: Optional[str] = None,
+    batch_size: int = 1000000,
+) -> DataFrame:
+    """
+    Counts reads and UMI deduplicated molecules per read (pair) sequence.
+
+    The UMI is taken from the start of read 1 by umi_pattern, e.g.
+    'NNNNNNNNXX' for an 8 base UMI followed by two kept bases, and removed
+    from the read, or from the last header_separator field of the read 1
+    name with umi_header, e.g. '@M1:1:FC:1:1:1:1:ACGTACGT'. Reads with
+    other bases than ACGT in the UMI are skipped.
+
+    Sequences are replaced by integer ids and combined with the 2-bit
+    packed UMI into a single uint64 key per read. Keys are collected in
+    batches and merged into a sorted unique key array with counts, so
+    memory grows with the number of distinct (sequence, UMI) pairs only.
+
+    Parameters
+    ----------
+    output_file : Union[str, Path]
+        Output table with Seq (Seq1 and Seq2), Reads, UMIs (distinct UMIs)
+        and Molecules, sorted by descending molecules, written with
+        write_count_table.
+    r1 : Union[str, Path]
+        Read 1 (gzipped) FASTQ file.
+    r2 : Optional[Union[str, Path]], optional
+        Read 2 (gzipped) FASTQ file, by default None.
+    umi_pattern : Optional[str], optional
+        UMI pattern at the start of read 1, by default None.
+    umi_header : bool, optional
+        Take the UMI from the read name instead, by default False.
+    header_separator : str, optional
+        Separator of the UMI field in the read name, by default ':'.
+    max : Optional[int], optional
+        Maximum number of reads (pairs) to count, by default all.
+    index : Optional[int], optional
+        Only count the first index bases of each read after UMI removal,
+        by default None.
+    collapse : bool, optional
+        Collapse UMIs with sequencing errors with collapse_umis, otherwise
+        Molecules equals UMIs, by default True.
+    output_format : Optional[str], optional
+        'tsv', 'parquet' or 'feather', by default inferred from the suffix.
+    batch_size : int, optional
+        Number of keys collected before they are reduced to a sorted run of
+        unique keys, by default 1000000.
+
+    Returns
+    -------
+    DataFrame
+        The written table.
+    """
+    extract = _umi_extractor(umi_pattern, umi_header, header_separator)
+    outfile = Path(output_file)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    iterlist = [get_fastq_iterator(r1)]
+    if r2 is not None:
+        iterlist.append(get_fastq_iterator(r2))
+    sequence_ids: Dict[Tuple[str, ...], int] = {}
+    key_counter = _KeyCounter()
+    batch: List[int] = []
+    umi_length = None
+    invalid = 0
+    with instrumentation.stage("fastq.count_umi_sequences"):
+        for reads in itertools.islice(zip(*iterlist), max):
+            read1, umi = extract(reads[0])
+            if umi_length is None:
+                umi_length = len(umi)
+                if umi_length > 16:
+                    raise ValueError("UMIs longer than 16 bases are not supported.")
+                shift = 2 * umi_length
+            try:
+                code = int(umi.translate(_umi_codes), 4) if len(umi) == umi_length else -1
+            except ValueError:
+                code = -1
+            if code < 0:
+                invalid += 1
+                continue
+            key = (read1[0][:index],) + tuple(read[0][:index] for read in reads[1:])
+            sequence_id = sequence_ids.setdefault(key, len(sequence_ids))
+            batch.append(sequence_id << shift | code)
+            if len(batch) >= batch_size:
+                key_counter.add(np.array(batch, dtype=np.uint64))
+                batch.clear()
+        if batch:
+            key_counter.add(np.array(batch, dtype=np.uint64))
+        keys, counts = key_counter.result()
+        umi_length = umi_length or 0
+        if collapse and len(keys):
+            molecules = collapse_umis(keys, counts, umi_length)
+        else:
+            molecules = np.ones(len(keys), dtype=bool)
+        ids = (keys >> np.uint64(2 * umi_length)).astype(np.int64)
+        n = len(sequence_ids)
+        reads_per_sequence = np.bincount(ids, weights=counts, minlength=n).astype(np.int64)
+        umis_per_sequence = np.bincount(ids, minlength=n)
+        molecules_per_sequence = np.bincount(ids, weights=molecules, minlength=n).astype(np.int64)
+    if instrumentation.enabled:
+        instrumentation.count("fastq.invalid_umis", invalid)
+    sequences = list(sequence_ids)
+    if r2 is not None:
+        to_df = {"Seq1": [key[0] for key in sequences], "Seq2": [key[1] for key in sequences]}
+    else:
+        to_df = {"Seq": [key[0] for key in sequences]}
+    to_df["Reads"] = reads_per_sequence
+    to_df["UMIs"] = umis_per_sequence
+    to_df["Molecules"] = molecules_per_sequence
     df = pd.DataFrame(to_df)
-    df = df.sort_values("Count", ascending=False)
-    df.to_csv(output_file, sep="\t", index=False)
+    df = df.sort_values(["Molecules", "Reads"], ascending=False, kind="stable", ignore_index=True)
+    with instrumentation.stage("fastq.write_count_table"):
+        write_count_table(df, outfile, output_format)
+    return df
@@ -1,8 +1,17 @@
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import re
 from typing import Union, Optional, List, Dict
 from pathlib import Path
 from pandas import DataFrame
+from .instrumentation import instrumentation
+from .util import file_checksum
 
 
 def trim_dna_strings(sequence: str) -> str:
@@ -10,24 +19,218 @@ def trim_dna_strings(sequence: str) -> str:
     return sequence.strip().upper()
 
 
+def trim_dna_column(column: pd.Series) -> pd.Series:
+    """Vectorized trim_dna_strings, empty cells and cells trimmed to '' are NaN."""
+    trimmed = column.where(column.isna(), column.astype(str).str.strip().str.upper())
+    return trimmed.replace("", np.nan).astype(object)
+
+
+def _trim_column_dtypes(trim_columns: Optional[List[str]], kwargs: Dict) -> Dict:
+    """Adds dtype=str for trim_columns to the read_excel kwargs, so numbers stay verbatim."""
+    dtype = kwargs.get("dtype")
+    if trim_columns and (dtype is None or isinstance(dtype, dict)):
+        kwargs = dict(kwargs)
+        kwargs["dtype"] = {**{col: str for col in trim_columns}, **(dtype or {})}
+    return kwargs
+
+
+def default_excel_engine() -> Optional[str]:
+    """Returns 'calamine' if python-calamine is installed, else None (pandas default)."""
+    if importlib.util.find_spec("python_calamine") is not None:
+        return "calamine"
+    return None
+
+
+def _excel_cache_file(cache_dir: Path, infile: Path, arguments: Dict) -> Path:
+    key = json.dumps(
+        {"workbook": file_checksum(infile), "arguments": arguments}, sort_keys=True, default=repr
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return Path(cache_dir) / f"{infile.stem}.{digest}.parquet"
+
+
+def _write_parquet_cache(df: DataFrame, cache_file: Path):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_file.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp)
+        os.replace(tmp, cache_file)
+    except (ValueError, TypeError):
+        # e.g. non-string column names or mixed type columns, just do not cache
+        os.unlink(tmp)
+
+
 def read_excel_from_biologists(
     infile: Union[Path, str],
-    sheet_name: Optional[Union[str, int]] = 0,
+    sheet_name: Optional[Union[str, int, List[Union[str, int]]]] = 0,
     trim_columns: Optional[List[str]] = None,
     merge_columns: List[str] = [],
     combine_columns: Optional[Dict[str, List[str]]] = None,
+    cache_dir: Optional[Union[Path, str]] = None,
     **kwargs,
+) -> Union[DataFrame, Dict[Union[str, int], DataFrame]]:
+    """
+    Reads a sample sheet and cleans it up.
+
+    Columns in trim_columns are read as strings, stripped and uppercased,
+    merged cells in merge_columns are forward filled and each column in
+    combine_columns is created by joining the given columns with '_'. The
+    calamine engine is used if available, unless an engine is passed.
+
+    Parameters
+    ----------
+    infile : Union[Path, str]
+        Excel workbook.
+    sheet_name : Optional[Union[str, int, List[Union[str, int]]]], optional
+        Sheet to read, a list of sheets or None for all sheets, by default
+        the first sheet.
+    trim_columns : Optional[List[str]], optional
+        Columns with DNA sequences to trim, by default None.
+    merge_columns : List[str], optional
+        Columns with merged cells to fill, by default [].
+    combine_columns : Optional[Dict[str, List[str]]], optional
+        New column names and the columns to combine, by default None.
+    cache_dir : Optional[Union[Path, str]], optional
+        Directory to cache the result as Parquet, keyed by the workbook
+        checksum and all arguments, by default no caching. Only single
+        sheets are cached.
+
+    Returns
+    -------
+    DataFrame
+        The cleaned up sheet, or a dictionary of cleaned up sheets if
+        sheet_name is None or a list.
+    """
+    infile = Path(infile)
+    cache_file = None
+    single_sheet = sheet_name is not None and not isinstance(sheet_name, list)
+    if cache_dir is not None and single_sheet:
+        arguments = {
+            "sheet_name": sheet_name,
+            "trim_columns": trim_columns,
+            "merge_columns": merge_columns,
+            "combine_columns": combine_columns,
+            "kwargs": kwargs,
+        }
+        cache_file = _excel_cache_file(Path(cache_dir), infile, arguments)
+        if cache_file.exists():
+            instrumentation.count("cache_hits", cache="excel")
+            return pd.read_parquet(cache_file)
+        instrumentation.count("cache_misses", cache="excel")
+    if "engine" not in kwargs:
+        kwargs["engine"] = default_excel_engine()
+    kwargs = _trim_column_dtypes(trim_columns, kwargs)
+    with instrumentation.stage("frames.read_excel"):
+        df = pd.read_excel(infile, sheet_name=sheet_name, **kwargs)
+    if isinstance(df, dict):
+        return {
+            sheet: clean_biologist_frame(frame, trim_columns, merge_columns, combine_columns)
+            for sheet, frame in df.items()
+        }
+    df = clean_biologist_frame(df, trim_columns, merge_columns, combine_columns)
+    if cache_file is not None:
+        _write_parquet_cache(df, cache_file)
+    return df
+
+
+def clean_biologist_frame(
+    df: DataFrame,
+    trim_columns: Optional[List[str]] = None,
+    merge_columns: List[str] = [],
+    combine_columns: Optional[Dict[str, List[str]]] = None,
 ) -> DataFrame:
-    converters = None
-    if trim_columns is not None:
-        converters = dict(zip(trim_columns, [trim_dna_strings] * len(trim_columns)))
-    df = pd.read_excel(infile, sheet_name=sheet_name, converters=converters, **kwargs)
+    """Applies the trimming, merging and combining of read_excel_from_biologists."""
+    for col in trim_columns or []:
+        if col in df.columns:
+            df[col] = trim_dna_column(df[col])
     # deal with merged cells
     for col in merge_columns:
-        df[col] = df[col].fillna(method="ffill")
+        df[col] = df[col].ffill()
     if combine_columns is not None:
-        for new_column in combine_columns:
-            df[new_column] = df[combine_columns[new_column]].apply(
-                lambda row: "_".join(row), axis="columns"
-            )
+        for new_column, columns in combine_columns.items():
+            first, *others = columns
+            df[new_column] = df[first].str.cat([df[col] for col in others], sep="_")
     return df
+
+
+def _read_workbook(
+    infile: Path,
+    sheet_name: Optional[Union[str, int, List[Union[str, int]]]],
+    trim_columns: Optional[List[str]],
+    merge_columns: List[str],
+    combine_columns: Optional[Dict[str, List[str]]],
+    kwargs: Dict,
+) -> List[DataFrame]:
+    engine = kwargs.pop("engine", default_excel_engine())
+    kwargs = _trim_column_dtypes(trim_columns, kwargs)
+    with pd.ExcelFile(infile, engine=engine) as workbook:
+        if sheet_name is None:
+            sheets = workbook.sheet_names
+        elif isinstance(sheet_name, list):
+            sheets = sheet_name
+        else:
+            sheets = [sheet_name]
+        frames = []
+        for sheet in sheets:
+            df = workbook.parse(sheet, **kwargs)
+            df = clean_biologist_frame(df, trim_columns, merge_columns, combine_columns)
+            df["source_file"] = str(infile)
+            df["source_sheet"] = workbook.sheet_names[sheet] if isinstance(sheet, int) else sheet
+            frames.append(df)
+    return frames
+
+
+def read_excel_workbooks(
+    infiles: List[Union[Path, str]],
+    sheet_name: Optional[Union[str, int, List[Union[str, int]]]] = 0,
+    trim_columns: Optional[List[str]] = None,
+    merge_columns: List[str] = [],
+    combine_columns: Optional[Dict[str, List[str]]] = None,
+    max_workers: Optional[int] = None,
+    **kwargs,
+) -> DataFrame:
+    """
+    Reads sample sheets from many workbooks in parallel and concatenates them.
+
+    Each workbook is opened once for all requested sheets and workbooks are
+    parsed concurrently in a process pool. Every sheet is cleaned up as in
+    read_excel_from_biologists before concatenation, so merged cells are
+    never filled across sheets.
+
+    Parameters
+    ----------
+    infiles : List[Union[Path, str]]
+        Excel workbooks.
+    sheet_name : Optional[Union[str, int, List[Union[str, int]]]], optional
+        Sheet(s) to read from each workbook, None for all sheets, by default
+        the first sheet.
+    trim_columns : Optional[List[str]], optional
+        Columns with DNA sequences to trim, by default None.
+    merge_columns : List[str], optional
+        Columns with merged cells to fill, by default [].
+    combine_columns : Optional[Dict[str, List[str]]], optional
+        New column names and the columns to combine, by default None.
+    max_workers : Optional[int], optional
+        Number of worker processes, by default the number of CPUs. With a
+        single worker or workbook, everything is read in this process.
+
+    Returns
+    -------
+    DataFrame
+        All sheets with additional 'source_file' and 'source_sheet' columns.
+    """
+    infiles = [Path(infile) for infile in infiles]
+    arguments = [
+        (infile, sheet_name, trim_columns, merge_columns, combine_columns, dict(kwargs))
+        for infile in infiles
+    ]
+    if len(infiles) < 2 or max_workers == 1:
+        results = [_read_workbook(*args) for args in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_read_workbook, *zip(*arguments)))
+    frames = [df for frames in results for df in frames]
+    if not frames:
+        return DataFrame(columns=["source_file", "source_sheet"])
+    return pd.concat(frames, ignore_index=True)
@@ -6,6 +6,8 @@
 from typing import Optional, Callable, List, Dict, Tuple, Any
 from IPython.display import Markdown, display
 import numpy as np
+import pandas as pd
+import weakref
 
 
 __author__ = "Marco Mernberger"
@@ -23,6 +25,7 @@ def filter_function(
     threshold: float,
     canonical_chromosomes: List[str],
     biotypes: List[str] = None,
+    cache_static_mask: bool = False,
 ) -> Callable:
     """
     Filter function for RNAseq used to filter genes instances.
@@ -42,24 +45,48 @@ def filter_function(
         List of canonical chromosomes to consider.
     biotypes : List[str], optional
         Biotypes that are relevant, by default None.
+    cache_static_mask : bool, optional
+        Remember the chromosome/biotype mask per DataFrame, so that repeated
+        calls on the same DataFrame only evaluate the expression threshold,
+        by default False. The mask is recomputed if the DataFrame's index
+        changed, but in-place edits of the 'chr' or 'biotype' values are not
+        detected; do not use the cache on DataFrames that are edited like
+        that. Masks are released when their DataFrame is garbage collected.
 
     Returns
     -------
     Callable
         Filter function t be passed to genes.filter.
     """
+    canonical_chromosomes = list(canonical_chromosomes)
+    biotypes = None if biotypes is None else list(biotypes)
+    static_masks: Dict[int, Tuple[Any, pd.Index, np.ndarray]] = {}
 
-    def __filter(df):
-        keep = np.zeros(len(df), dtype=bool)
-        for column_name in column_names:
-            keep = keep | (df[column_name] >= threshold)
-        chromosomes = [x in canonical_chromosomes for x in df["chr"].values]
-        keep = keep & chromosomes
+    def __static_mask(df):
+        keep = df["chr"].isin(canonical_chromosomes).to_numpy()
         if biotypes is not None:
-            bio = [x in biotypes for x in df["biotype"].values]
-            keep = keep & bio
+            keep &= df["biotype"].isin(biotypes).to_numpy()
+        return keep
+
+    def __cached_static_mask(df):
+        key = id(df)
+        ref, index, keep = static_masks.get(key, (None, None, None))
+        if ref is None or ref() is not df:
+            weakref.finalize(df, static_masks.pop, key, None)
+        elif index is df.index and len(keep) == len(df):
+            return keep
+        keep = __static_mask(df)
+        static_masks[key] = (weakref.ref(df), df.index, keep)
         return keep
 
+    def __filter(df):
+        keep = (df[column_names].to_numpy() >= threshold).any(axis=1)
+        if cache_static_mask:
+            keep &= __cached_static_mask(df)
+        else:
+            keep &= __static_mask(df)
+        return pd.Series(keep, index=df.index)
+
     return __filter
 
 
@@ -62,6 +62,15 @@ three_to_one = {
 
 one_to_three = {v: k for k, v in three_to_one.items()}
 
+# standard genetic code, stop codons are translated to '*'
+codon_table = {
+    a + b + c: aa
+    for (a, b, c), aa in zip(
+        [(a, b, c) for a in "TCAG" for b in "TCAG" for c in "TCAG"],
+        "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    )
+}
+
 
 def get_one_letter_amino_acid_code(three_letter_code: str) -> str:
     """
@@ -95,3 +104,25 @@ def get_three_letter_amino_acid_code(one_letter_code: str) -> str:
         Three letter amino acid code.
     """
     return one_to_three[one_letter_code]
+
+
+def translate(sequence: str) -> str:
+    """
+    translate returns the one letter amino acid sequence for a coding sequence.
+
+    Incomplete trailing codons are ignored, stop codons are translated to '*'
+    and codons containing other letters than ACGT are translated to 'X'.
+
+    Parameters
+    ----------
+    sequence : str
+        Coding DNA sequence, starting with a complete codon.
+
+    Returns
+    -------
+    str
+        One letter amino acid sequence.
+    """
+    return "".join(
+        [codon_table.get(sequence[i : i + 3], "X") for i in range(0, len(sequence) - 2, 3)]
+    )
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+instrumentation.py: Contains opt-in stage timers and counters for the hot
+paths of mutility.
+
+Instrumentation is disabled by default. Instrumented code checks the
+enabled flag before doing any work, e.g.
+
+    with stage("fastq.count_most_common_sequences"):
+        ...
+    if instrumentation.enabled:
+        count("fastq.records_read", records)
+
+so that a disabled instrumentation costs a single attribute lookup. Use
+enable() to start collecting and export_json()/export_prometheus() to
+export the collected metrics.
+"""
+
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import json
+import re
+import threading
+import time
+import tracemalloc
+
+__author__ = "Marco Mernberger"
+__copyright__ = "Copyright (c) 2020 Marco Mernberger"
+__license__ = "mit"
+
+
+_null_stage = nullcontext()
+
+
+class Instrumentation:
+    """
+    Collects wall clock time per named stage and named, labelled counters.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Start collecting immediately, by default False.
+    trace_memory : bool, optional
+        Record the peak traced memory per stage with tracemalloc, by default
+        False. Peaks of nested stages are included in the enclosing stage.
+    """
+
+    def __init__(self, enabled: bool = False, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        self._memory_stack: List[int] = []
+        self._started_tracing = False
+        self.reset()
+
+    def reset(self):
+        """Discards all collected metrics."""
+        with self._lock:
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def enable(self, trace_memory: bool = False):
+        """Starts collecting metrics, optionally with peak memory per stage."""
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.enabled = True
+
+    def disable(self):
+        """Stops collecting metrics, collected metrics are kept."""
+        self.enabled = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def stage(self, name: str):
+        """
+        Returns a context manager that times the enclosed block as stage name.
+
+        Parameters
+        ----------
+        name : str
+            Stage name, e.g. 'fastq.count_most_common_sequences'.
+        """
+        if not self.enabled:
+            return _null_stage
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        trace = self.trace_memory and tracemalloc.is_tracing()
+        if trace:
+            with self._lock:
+                peak = tracemalloc.get_traced_memory()[1]
+                if self._memory_stack:
+                    self._memory_stack[-1] = max(self._memory_stack[-1], peak)
+                tracemalloc.reset_peak()
+                self._memory_stack.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+                entry["seconds"] += elapsed
+                entry["calls"] += 1
+                if trace and self._memory_stack:
+                    peak = max(self._memory_stack.pop(), tracemalloc.get_traced_memory()[1])
+                    entry["peak_memory"] = max(entry.get("peak_memory", 0), peak)
+                    if self._memory_stack:
+                        self._memory_stack[-1] = max(self._memory_stack[-1], peak)
+
+    def count(self, name: str, value: float = 1, **labels: str):
+        """
+        Adds value to the counter name with the given labels.
+
+        Parameters
+        ----------
+        name : str
+            Counter name, e.g. 'fastq.records_read'.
+        value : float, optional
+            Increment, by default 1.
+        **labels : str
+            Labels of the counter, e.g. pattern='genomic_ins'.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self) -> Dict:
+        """Returns all metrics as a JSON serializable dictionary."""
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()
+            ]
+        for entry in stages.values():
+            entry["mean_seconds"] = entry["seconds"] / entry["calls"]
+        return {"stages": stages, "counters": counters}
+
+    def to_json(self, outfile: Optional[Union[Path, str]] = None) -> str:
+        """Returns the snapshot as JSON and writes it to outfile if given."""
+        text = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        if outfile is not None:
+            Path(outfile).write_text(text)
+        return text
+
+    def to_prometheus(self, prefix: str = "mutility") -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+
+        Stages are exported as {prefix}_stage_seconds_total, _calls_total and
+        _peak_memory_bytes with a 'stage' label, counters as
+        {prefix}_{name}_total with their labels.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def add(metric, kind, samples):
+            if samples:
+                lines.append(f"# TYPE {metric} {kind}")
+                lines.extend(
+                    f"{metric}{_prometheus_labels(labels)} {value}" for labels, value in samples
+                )
+
+        stages = sorted(snapshot["stages"].items())
+        add(
+            f"{prefix}_stage_seconds_total",
+            "counter",
+            [({"stage": name}, entry["seconds"]) for name, entry in stages],
+        )
+        add(
+            f"{prefix}_stage_calls_total",
+            "counter",
+            [({"stage": name}, entry["calls"]) for name, entry in stages],
+        )
+        add(
+            f"{prefix}_stage_peak_memory_bytes",
+            "gauge",
+            [
+                ({"stage": name}, entry["peak_memory"])
+                for name, entry in stages
+                if "peak_memory" in entry
+            ],
+        )
+        counters: Dict[str, List] = {}
+        for counter in snapshot["counters"]:
+            metric = f"{prefix}_{_prometheus_name(counter['name'])}_total"
+            counters.setdefault(metric, []).append((counter["labels"], counter["value"]))
+        for metric, samples in sorted(counters.items()):
+            add(metric, "counter", sorted(samples, key=lambda sample: sorted(sample[0].items())))
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{_prometheus_name(k)}="{_escape_label(v)}"' for k, v in sorted(labels.items()))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+instrumentation = Instrumentation()
+stage = instrumentation.stage
+count = instrumentation.count
+
+
+def enable(trace_memory: bool = False):
+    """Enables the process-wide instrumentation."""
+    instrumentation.enable(trace_memory)
+
+
+def disable():
+    """Disables the process-wide instrumentation."""
+    instrumentation.disable()
+
+
+def reset():
+    """Discards all metrics of the process-wide instrumentation."""
+    instrumentation.reset()
+
+
+def export_json(outfile: Optional[Union[Path, str]] = None) -> str:
+    """Returns the process-wide metrics as JSON and writes them to outfile if given."""
+    return instrumentation.to_json(outfile)
+
+
+def export_prometheus(prefix: str = "mutility") -> str:
+    """Returns the process-wide metrics in the Prometheus text format."""
+    return instrumentation.to_prometheus(prefix)
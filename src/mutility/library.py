@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+library.py: Contains functions to count sequencing reads per designed
+library variant directly from FASTQ files.
+"""
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from pandas import DataFrame
+from .fastq import get_fastq_iterator, reverse_complement
+from .instrumentation import instrumentation
+from .mutalizer import CodonComparison, get_codon_comparison
+from .util import SpaceSavingCounter, encode_sequences
+import numpy as np
+import pandas as pd
+
+__author__ = "Marco Mernberger"
+__copyright__ = "Copyright (c) 2020 Marco Mernberger"
+__license__ = "mit"
+
+
+unmatched = -1
+ambiguous = -2
+
+
+class LibraryIndex:
+    """
+    Hash index of the expected amplicon sequences of a designed library.
+
+    Amplicons are the full library sequences, including the 25bp flanks
+    that get_first_codon_difference trims. A read matches an amplicon if it
+    starts with the amplicon sequence, so reads running past the amplicon
+    (e.g. into the adapter) still match. Since library sequences of
+    different length can be prefixes of the same read, a read is looked up
+    once per distinct amplicon length and reads matching more than one
+    variant are reported as ambiguous. Identical library sequences are
+    indexed to their first occurrence.
+
+    Parameters
+    ----------
+    sequences : Sequence[str]
+        Amplicon sequences, their position is the variant index.
+    """
+
+    def __init__(self, sequences: Sequence[str]):
+        self.tables: Dict[int, Dict[str, int]] = {}
+        for i, sequence in enumerate(sequences):
+            self.tables.setdefault(len(sequence), {}).setdefault(sequence.upper(), i)
+        self.lengths = sorted(self.tables)
+        self.size = len(sequences)
+
+    @classmethod
+    def from_variant_table(cls, df: DataFrame, column: str = "Sequence") -> "LibraryIndex":
+        """Returns the index for the library sequences in df[column]."""
+        return cls(df[column].astype(str).tolist())
+
+    def lookup(self, read: str) -> int:
+        """
+        Returns the variant index of read, unmatched or ambiguous.
+
+        Parameters
+        ----------
+        read : str
+            Read sequence, starting at the first amplicon base.
+
+        Returns
+        -------
+        int
+            The index of the matching variant, unmatched (-1) if no variant
+            matches and ambiguous (-2) if several variants match.
+        """
+        found = unmatched
+        read_length = len(read)
+        for length in self.lengths:
+            if length > read_length:
+                break
+            hit = self.tables[length].get(read[:length])
+            if hit is not None:
+                if found != unmatched:
+                    return ambiguous
+                found = hit
+        return found
+
+
+def _read_library(library: Union[DataFrame, Path, str]) -> DataFrame:
+    if isinstance(library, DataFrame):
+        return library.reset_index(drop=True)
+    library = Path(library)
+    if library.suffix in (".parquet", ".pq"):
+        return pd.read_parquet(library)
+    return pd.read_csv(library, sep="\t")
+
+
+def iterate_read_sequences(
+    fastq_files: Union[Path, str, Iterable[Union[Path, str]]],
+    offset: int = 0,
+    reverse_reads: bool = False,
+) -> Iterable[str]:
+    """
+    Yields the uppercase sequences of all reads in one or more FASTQ files.
+
+    Parameters
+    ----------
+    fastq_files : Union[Path, str, Iterable[Union[Path, str]]]
+        (gzipped) FASTQ file(s).
+    offset : int, optional
+        Number of leading bases to skip, e.g. an adapter, by default 0.
+    reverse_reads : bool, optional
+        Reverse complement reads before skipping the offset, by default False.
+    """
+    if isinstance(fastq_files, (str, Path)):
+        fastq_files = [fastq_files]
+    for fastq_file in fastq_files:
+        for sequence, _, _ in get_fastq_iterator(Path(fastq_file)):
+            sequence = sequence.upper()
+            if reverse_reads:
+                sequence = reverse_complement(sequence)
+            yield sequence[offset:] if offset else sequence
+
+
+_base_codes = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    _base_codes[_base] = _code
+
+
+def _kmer_codes(matrix: np.ndarray, k: int, step: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns 2 bit packed k-mer codes of all rows and a mask of valid k-mers.
+
+    k-mers start every step columns, k-mers containing anything but ACGT
+    (including padding) are invalid.
+    """
+    codes = _base_codes[matrix]
+    if matrix.shape[1] < k:
+        empty = np.zeros((len(matrix), 0), dtype=np.uint64)
+        return empty, empty.astype(bool)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k, axis=1)[:, ::step]
+    valid = (windows < 4).all(axis=2)
+    weights = np.uint64(4) ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    kmers = (windows.astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64)
+    return kmers, valid
+
+
+class VariantAssigner:
+    """
+    Assigns reads to library variants within a mismatch budget.
+
+    Reads are assigned to a reference amplicon (the wild type exon from the
+    CodonComparison with its 25bp flanks) by voting of their
+    non-overlapping k-mers against a seed index of k-mers unique to one
+    reference; by the pigeonhole principle, a read with at most
+    max_mismatches errors and at least (max_mismatches + 1) * kmer_size
+    bases has an error-free seed.
+
+    Each library variant is described relative to its reference by the
+    first position p in which it differs, a short window up to position e
+    and a shift s, so that the variant equals the reference before p and the
+    reference shifted by s from e on (s is 0 for substitutions and the
+    length difference for indels). Candidates for a read are the variants
+    of its reference that first differ at one of the first
+    max_mismatches + 1 positions in which the read differs from the
+    reference, plus variants identical to the reference. The mismatches of
+    a read to a candidate are then the mismatches to the reference before
+    p, to the window, and to the shifted reference after e, which are read
+    from prefix sums of the mismatches to the (shifted) references, so each
+    candidate costs a few array lookups instead of a full comparison. A
+    read is assigned if its best candidate has at most max_mismatches
+    mismatches and all other candidates have at least margin more,
+    otherwise it is ambiguous.
+
+    Reads running past the amplicon are compared up to the variant length.
+    Variants whose first difference is not visible in the read, i.e. reads
+    with a sequencing error that reverts the first changed base, are not
+    considered.
+
+    Parameters
+    ----------
+    library : Union[DataFrame, Path, str]
+        Variant table with ID and Sequence columns or a TSV/Parquet file of it.
+    comparator : Optional[CodonComparison], optional
+        Reference exons for the library IDs, by default the shared instance
+        from get_codon_comparison. IDs without reference exon use their
+        first library sequence as reference.
+    max_mismatches : int, optional
+        Maximum number of mismatches of an assigned read, by default 2.
+    margin : int, optional
+        Minimum distance between the best and second best candidate, by
+        default 1.
+    kmer_size : int, optional
+        Length of the reference seeds, at most 32, by default 16.
+    chunk_size : int, optional
+        Number of reads processed at once, by default 8192.
+    """
+
+    def __init__(
+        self,
+        library: Union[DataFrame, Path, str],
+        comparator: Optional[CodonComparison] = None,
+        max_mismatches: int = 2,
+        margin: int = 1,
+        kmer_size: int = 16,
+        chunk_size: int = 8192,
+    ):
+        if kmer_size > 32:
+            raise ValueError("kmer_size must be at most 32.")
+        if comparator is None:
+            comparator = get_codon_comparison()
+        self.max_mismatches = max_mismatches
+        self.margin = margin
+        self.kmer_size = kmer_size
+        self.chunk_size = chunk_size
+        df_library = _read_library(library)
+        sequences = df_library["Sequence"].astype(str).str.upper()
+        ids = df_library["ID"].astype(str)
+        reference_ids = list(dict.fromkeys(ids))
+        wt_exons = comparator.df_wt_exons
+        references = []
+        for exon_id in reference_ids:
+            if exon_id in wt_exons.index:
+                wt = wt_exons.loc[exon_id]
+                flank5 = wt["5_contant"] + wt["5_overhang"]
+                flank3 = wt["3_overhang"] + wt["3_contant"]
+                references.append((flank5 + wt["Exon"] + flank3).upper())
+            else:
+                references.append(sequences[(ids == exon_id).to_numpy()].iloc[0])
+        reference_of_row = ids.map({exon_id: i for i, exon_id in enumerate(reference_ids)})
+        # identical sequences are assigned to their first row
+        first = ~sequences.duplicated().to_numpy()
+        self.rows = np.nonzero(first)[0]
+        variants = sequences[first].tolist()
+        self.length = max(len(s) for s in variants + references)
+        self.references = encode_sequences(references, self.length)
+        self.reference_lengths = np.array([len(s) for s in references])
+        self._init_variants(variants, reference_of_row.to_numpy()[first])
+        self.shifted_references = [self._shifted_references(shift) for shift in self.shifts]
+        self._init_seeds()
+
+    def _shifted_references(self, shift: int) -> np.ndarray:
+        shifted = np.zeros_like(self.references)
+        if shift >= 0:
+            shifted[:, : self.length - shift] = self.references[:, shift:]
+        else:
+            shifted[:, -shift:] = self.references[:, :shift]
+        return shifted
+
+    def _init_variants(self, variants: List[str], variant_reference: np.ndarray):
+        matrix = encode_sequences(variants, self.length)
+        lengths = np.array([len(s) for s in variants])
+        reference_lengths = self.reference_lengths[variant_reference]
+        shifts = reference_lengths - lengths
+        self.shifts = np.union1d(shifts, [0])
+        shift_index = np.searchsorted(self.shifts, shifts)
+        columns = np.arange(self.length)
+        diff = matrix != self.references[variant_reference]
+        differs = diff.any(axis=1)
+        first_diff = np.where(differs, diff.argmax(axis=1), lengths)
+        # the window ends after the last difference to the shifted reference
+        window_end = first_diff.copy()
+        for i, shift in enumerate(self.shifts):
+            selected = shift_index == i
+            shifted = self._shifted_references(shift)[variant_reference[selected]]
+            tail = (matrix[selected] != shifted) & (columns < lengths[selected][:, None])
+            last = self.length - np.argmax(tail[:, ::-1], axis=1)
+            window_end[selected] = np.where(tail.any(axis=1), last, 0)
+        window_end = np.maximum(window_end, first_diff)
+        width = max(int((window_end - first_diff).max(initial=0)), 1)
+        window_columns = np.minimum(first_diff[:, None] + np.arange(width), self.length - 1)
+        self.windows = np.take_along_axis(matrix, window_columns, axis=1)
+        self.windows[np.arange(width) >= (window_end - first_diff)[:, None]] = 0
+        self.window_mask = self.windows != 0
+        self.first_diff = first_diff
+        self.window_end = window_end
+        self.variant_lengths = lengths
+        self.shift_index = shift_index
+        self.variant_reference = variant_reference
+        # candidates are looked up by reference and first difference
+        keys = variant_reference * self.length + first_diff
+        order = np.argsort(keys[differs], kind="stable")
+        self.diff_keys = keys[differs][order]
+        self.diff_variants = np.nonzero(differs)[0][order]
+        self.identical = {
+            reference: np.nonzero(~differs & (variant_reference == reference))[0]
+            for reference in np.unique(variant_reference[~differs])
+        }
+
+    def _init_seeds(self):
+        n_references = len(self.references)
+        kmers, valid = _kmer_codes(self.references, self.kmer_size)
+        owners = np.broadcast_to(np.arange(n_references)[:, None], kmers.shape)[valid]
+        seeds, inverse = np.unique(kmers[valid], return_inverse=True)
+        # keep seeds occurring in a single reference
+        references_per_seed = np.zeros(len(seeds), dtype=np.int64)
+        pairs = np.unique(inverse.ravel() * n_references + owners)
+        np.add.at(references_per_seed, pairs // n_references, 1)
+        owner = np.full(len(seeds), -1)
+        owner[inverse.ravel()] = owners
+        unique = references_per_seed == 1
+        self.seeds = seeds[unique]
+        self.seed_references = owner[unique]
+
+    def _references_for(self, reads: np.ndarray) -> np.ndarray:
+        n, n_references = len(reads), len(self.references)
+        kmers, valid = _kmer_codes(reads, self.kmer_size, self.kmer_size)
+        if len(self.seeds) == 0:
+            return np.full(n, -1)
+        position = np.minimum(np.searchsorted(self.seeds, kmers), len(self.seeds) - 1)
+        hit = valid & (self.seeds[position] == kmers)
+        rows = np.nonzero(hit)[0]
+        votes = np.bincount(
+            rows * n_references + self.seed_references[position[hit]],
+            minlength=n * n_references,
+        ).reshape(n, n_references)
+        best = votes.argmax(axis=1)
+        best_votes = votes[np.arange(n), best]
+        votes[np.arange(n), best] = 0
+        tied = votes.max(axis=1) == best_votes
+        return np.where((best_votes > 0) & ~tied, best, -1)
+
+    def _candidates(self, mismatches: np.ndarray, reference: np.ndarray):
+        mismatches &= np.cumsum(mismatches, axis=1) <= self.max_mismatches + 1
+        ii, positions = np.nonzero(mismatches)
+        keys = reference[ii] * self.length + positions
+        start = np.searchsorted(self.diff_keys, keys, side="left")
+        sizes = np.searchsorted(self.diff_keys, keys, side="right") - start
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        # each variant has a single first difference, so pairs are unique
+        pair_reads = [np.repeat(ii, sizes)]
+        pair_variants = [self.diff_variants[np.repeat(start, sizes) + offsets]]
+        for ref, identical in self.identical.items():
+            with_ref = np.nonzero(reference == ref)[0]
+            pair_reads.append(np.repeat(with_ref, len(identical)))
+            pair_variants.append(np.tile(identical, len(with_ref)))
+        return np.concatenate(pair_reads), np.concatenate(pair_variants)
+
+    def _assign_matrix(self, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        result = np.full(len(matrix), unmatched, dtype=np.int64)
+        distances = np.full(len(matrix), -1, dtype=np.int64)
+        references = self._references_for(matrix)
+        rows = np.nonzero(references >= 0)[0]
+        reads, reference = matrix[rows], references[rows]
+        n = len(reads)
+        # prefix sums of the mismatches to the reference under each shift
+        prefix = np.zeros((len(self.shifts), n, self.length + 1), dtype=np.int16)
+        for i, shifted in enumerate(self.shifted_references):
+            np.cumsum(reads != shifted[reference], axis=1, dtype=np.int16, out=prefix[i, :, 1:])
+        zero = int(np.searchsorted(self.shifts, 0))
+        mismatches = reads != self.references[reference]
+        mismatches &= np.arange(self.length) < self.reference_lengths[reference][:, None]
+        pair_reads, candidates = self._candidates(mismatches, reference)
+        if len(pair_reads) == 0:
+            return result, distances
+        first_diff = self.first_diff[candidates]
+        shift_index = self.shift_index[candidates]
+        width = self.windows.shape[1]
+        window_columns = np.minimum(first_diff[:, None] + np.arange(width), self.length - 1)
+        window_mismatches = (
+            (reads[pair_reads[:, None], window_columns] != self.windows[candidates])
+            & self.window_mask[candidates]
+        ).sum(axis=1)
+        d = (
+            prefix[zero, pair_reads, first_diff].astype(np.int64)
+            + window_mismatches
+            + prefix[shift_index, pair_reads, self.variant_lengths[candidates]]
+            - prefix[shift_index, pair_reads, self.window_end[candidates]]
+        )
+        best = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(best, pair_reads, d)
+        close = np.bincount(pair_reads[d < best[pair_reads] + self.margin], minlength=n)
+        within = best <= self.max_mismatches
+        unique = within & (close == 1)
+        chosen = unique[pair_reads] & (d == best[pair_reads])
+        result[rows[pair_reads[chosen]]] = self.rows[candidates[chosen]]
+        result[rows[within & ~unique]] = ambiguous
+        distances[rows[within]] = best[within]
+        return result, distances
+
+    def assign(self, reads: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Assigns reads to library variants.
+
+        Parameters
+        ----------
+        reads : Sequence[str]
+            Uppercase read sequences starting at the first amplicon base.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The library row of each read, unmatched (-1) or ambiguous (-2),
+            and the number of mismatches to the best variant (-1 for
+            unmatched reads).
+        """
+        result = np.full(len(reads), unmatched, dtype=np.int64)
+        distances = np.full(len(reads), -1, dtype=np.int64)
+        for start in range(0, len(reads), self.chunk_size):
+            chunk = reads[start : start + self.chunk_size]
+            matrix = encode_sequences(chunk, self.length)
+            stop = start + len(chunk)
+            result[start:stop], distances[start:stop] = self._assign_matrix(matrix)
+        return result, distances
+
+
+def _count_batch(
+    assigner: VariantAssigner,
+    batch: List[str],
+    counts: List[int],
+    miss: Callable[[str, int], None],
+):
+    assigned, _ = assigner.assign(batch)
+    for row, count in zip(*np.unique(assigned[assigned >= 0], return_counts=True)):
+        counts[row] += int(count)
+    for i in np.nonzero(assigned < 0)[0]:
+        miss(batch[i], assigned[i])
+
+
+def count_library_variants(
+    library: Union[DataFrame, Path, str],
+    fastq_files: Union[Path, str, Iterable[Union[Path, str]]],
+    max_reads: Optional[int] = None,
+    offset: int = 0,
+    reverse_reads: bool = False,
+    unmatched_top: int = 1000,
+    max_mismatches: int = 0,
+    comparator: Optional[CodonComparison] = None,
+    batch_size: int = 100000,
+) -> Tuple[DataFrame, DataFrame]:
+    """
+    Counts reads per library variant directly while scanning FASTQ files.
+
+    This replaces counting all distinct sequences with
+    count_most_common_sequences and joining them to the variant table.
+
+    Parameters
+    ----------
+    library : Union[DataFrame, Path, str]
+        Variant table with ID and Sequence columns, e.g. annotated by
+        extract_codon_from_sequence, or a TSV/Parquet file of it.
+    fastq_files : Union[Path, str, Iterable[Union[Path, str]]]
+        (gzipped) FASTQ file(s) to count.
+    max_reads : Optional[int], optional
+        Maximum number of reads to count, by default all.
+    offset : int, optional
+        Number of leading read bases before the amplicon, by default 0.
+    reverse_reads : bool, optional
+        Reverse complement reads first, by default False.
+    unmatched_top : int, optional
+        Number of most common unmatched sequences to report, by default 1000.
+        Unmatched sequences are counted in a SpaceSavingCounter tracking
+        10 * unmatched_top sequences, so memory stays bounded; once more
+        distinct sequences were seen, the reported counts are upper bounds.
+    max_mismatches : int, optional
+        If larger than 0, reads are assigned with a VariantAssigner allowing
+        that many mismatches, by default 0 (exact matches only).
+    comparator : Optional[CodonComparison], optional
+        Reference exons for the VariantAssigner, by default the shared
+        instance from get_codon_comparison.
+    batch_size : int, optional
+        Number of reads assigned at once by the VariantAssigner, by default
+        100000.
+
+    Returns
+    -------
+    Tuple[DataFrame, DataFrame]
+        The library table with an added 'Count' column, and a table of the
+        most common unmatched sequences ('Seq', 'Count', 'Status'), where
+        Status is 'unmatched' or 'ambiguous'.
+    """
+    df_library = _read_library(library)
+    index = LibraryIndex.from_variant_table(df_library)
+    counts = [0] * index.size
+    missed = SpaceSavingCounter(max(10 * unmatched_top, 1))
+    missed_status: Dict[str, str] = {}
+    ambiguous_reads = 0
+    reads = 0
+
+    def __miss(sequence: str, hit: int):
+        nonlocal ambiguous_reads
+        evicted = missed.add(sequence)
+        if evicted is not None:
+            missed_status.pop(evicted, None)
+        if hit == ambiguous:
+            missed_status[sequence] = "ambiguous"
+            ambiguous_reads += 1
+
+    with instrumentation.stage("library.count_library_variants"):
+        if max_mismatches > 0:
+            assigner = VariantAssigner(df_library, comparator, max_mismatches)
+            lookup = None
+        else:
+            lookup = index.lookup
+        batch: List[str] = []
+        for sequence in iterate_read_sequences(fastq_files, offset, reverse_reads):
+            if max_reads is not None and reads >= max_reads:
+                break
+            reads += 1
+            if lookup is None:
+                batch.append(sequence)
+                if len(batch) >= batch_size:
+                    _count_batch(assigner, batch, counts, __miss)
+                    batch = []
+                continue
+            hit = lookup(sequence)
+            if hit >= 0:
+                counts[hit] += 1
+            else:
+                __miss(sequence, hit)
+        if batch:
+            _count_batch(assigner, batch, counts, __miss)
+    df_counts = df_library.copy()
+    df_counts["Count"] = counts
+    to_df: Dict[str, List] = {"Seq": [], "Count": [], "Status": []}
+    for sequence, count in missed.most_common(unmatched_top):
+        to_df["Seq"].append(sequence)
+        to_df["Count"].append(count)
+        to_df["Status"].append(missed_status.get(sequence, "unmatched"))
+    if instrumentation.enabled:
+        instrumentation.count("fastq.records_read", reads)
+        instrumentation.count("library.reads", sum(counts), status="matched")
+        instrumentation.count("library.reads", ambiguous_reads, status="ambiguous")
+        unmatched_reads = reads - sum(counts) - ambiguous_reads
+        instrumentation.count("library.reads", unmatched_reads, status="unmatched")
+    return df_counts, pd.DataFrame(to_df)
+
+
+def write_library_counts(
+    output_file: Union[Path, str],
+    library: Union[DataFrame, Path, str],
+    fastq_files: Union[Path, str, Iterable[Union[Path, str]]],
+    unmatched_file: Optional[Union[Path, str]] = None,
+    **kwargs,
+):
+    """
+    Writes the per variant counts of count_library_variants as TSV.
+
+    Parameters
+    ----------
+    output_file : Union[Path, str]
+        Output file for the library table with counts.
+    library : Union[DataFrame, Path, str]
+        Variant table or file, see count_library_variants.
+    fastq_files : Union[Path, str, Iterable[Union[Path, str]]]
+        (gzipped) FASTQ file(s) to count.
+    unmatched_file : Optional[Union[Path, str]], optional
+        Output file for the unmatched sequences, by default
+        output_file with '.unmatched.tsv' suffix.
+    **kwargs
+        Further arguments to count_library_variants.
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    if unmatched_file is None:
+        unmatched_file = output_file.with_suffix(".unmatched.tsv")
+    df_counts, df_unmatched = count_library_variants(library, fastq_files, **kwargs)
+    df_counts.to_csv(output_file, sep="\t", index=False)
+    df_unmatched.to_csv(unmatched_file, sep="\t", index=False)
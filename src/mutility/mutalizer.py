@@ -1,8 +1,16 @@
 import pandas as pd
+import numpy as np
+import itertools
+import os
 import re
+import tempfile
 from pathlib import Path
-from .genomics import get_one_letter_amino_acid_code
-from typing import Tuple, Union
+from .genomics import get_one_letter_amino_acid_code, three_to_one, translate
+from .instrumentation import instrumentation
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    import pyarrow as pa
 
 
 # effect pattern
@@ -49,10 +57,70 @@ pattern_genomic_delins = re.compile(
     r"NC_000017\.11:g\.(?P<start>\d+)_(?P<stop>\d+)delins(?P<ins>[ATCG]{1,3})$"
 )
 
+# vocabularies for compact output columns, see compact_mutation_columns
+mutation_columns = [
+    "type_g",
+    "type_g_fine",
+    "effect",
+    "type_p",
+    "codon",
+    "codon_ref",
+    "codon_alt",
+    "aa_ref",
+    "aa_alt",
+]
+codon_vocabulary = [""] + ["".join(c) for c in itertools.product("ACGT", repeat=3)]
+amino_acid_vocabulary = [""] + sorted(set(three_to_one.values()))
+compact_vocabularies: Dict[str, Optional[List[str]]] = {
+    "type_g": ["del", "dup", "ins", "sub"],
+    "type_g_fine": None,
+    "effect": None,
+    "type_p": ["del", "delins", "fs", "mis", "non", "syn"],
+    "codon_ref": codon_vocabulary,
+    "codon_alt": codon_vocabulary,
+    "RefCodon": codon_vocabulary,
+    "AltCodon": codon_vocabulary,
+    "aa_ref": amino_acid_vocabulary,
+    "aa_alt": amino_acid_vocabulary,
+}
+
+
+default_reference = Path("incoming/Sequences_lib_5678_with_bbs1.tsv")
+
+# process-wide CodonComparison instances, see get_codon_comparison
+_reference_instances: Dict[Tuple[str, Optional[str]], Tuple[int, int, "CodonComparison"]] = {}
+
+
+def reference_key(path: Path) -> str:
+    """
+    Returns a key identifying the current state of a reference table.
+
+    The key combines the size and modification time of the file, so cached
+    data derived from the table is invalidated as soon as it changes,
+    without reading the file.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the reference table.
+
+    Returns
+    -------
+    str
+        Key of the form '<size>-<mtime_ns>'.
+    """
+    stat = path.stat()
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
 
 class CodonComparison:
-    def __init__(self, path_to_df: Path = Path("incoming/Sequences_lib_5678_with_bbs1.tsv")):
-        self.path = path_to_df
+    def __init__(
+        self,
+        path_to_df: Path = default_reference,
+        cache_dir: Optional[Path] = None,
+    ):
+        self.path = Path(path_to_df)
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
         self.init_df_exons()
 
     def init_df_exons(self):
@@ -61,10 +129,10 @@ class CodonComparison:
         self.init_codons()
 
     def init_codons(self):
-        wt_codons = {}
-        for exon_id, row in self.df_wt_exons.iterrows():
-            wt_codons[exon_id] = re.findall("...", row["Coding"])
-        self.wt_codons = wt_codons
+        self.wt_codons = {
+            exon_id: re.findall("...", coding)
+            for exon_id, coding in self.df_wt_exons["Coding"].items()
+        }
 
     def assert_frame(self):
         assert all(self.df_wt_exons["Coding"].str.len() % 3 == 0)
@@ -72,22 +140,31 @@ class CodonComparison:
     def read_df(self):
         df_wt_exons = pd.read_csv(self.path, sep="\t")
         df_wt_exons = df_wt_exons.fillna("")
-        df_wt_exons["Coding"] = df_wt_exons[
-            ["beginning_of_truncated_start_codon", "Exon", "end_of_truncated_end_codon"]
-        ].apply("".join, axis=1)
+        df_wt_exons["Coding"] = (
+            df_wt_exons["beginning_of_truncated_start_codon"]
+            + df_wt_exons["Exon"]
+            + df_wt_exons["end_of_truncated_end_codon"]
+        )
         df_wt_exons = df_wt_exons.set_index("ID")
         return df_wt_exons
 
-    def get_first_codon_difference(self, row: pd.Series) -> Tuple[str, str]:
-        exon_id = row["ID"]
-        wt = self.df_wt_exons.loc[exon_id]
-        sequence = "".join(
+    @property
+    def effect_cache_file(self) -> Path:
+        return self.cache_dir / f"{self.path.name}.{reference_key(self.path)}.effects.npz"
+
+    def get_alt_coding(self, row: pd.Series) -> str:
+        wt = self.df_wt_exons.loc[row["ID"]]
+        return "".join(
             [
                 wt["beginning_of_truncated_start_codon"],
                 row["Sequence"][25:-25],
                 wt["end_of_truncated_end_codon"],
             ]
         )
+
+    def get_first_codon_difference(self, row: pd.Series) -> Tuple[str, str]:
+        exon_id = row["ID"]
+        sequence = self.get_alt_coding(row)
         alt_codons = re.findall("...", sequence)
         found = False
         for codon_ref, codon_alt in zip(self.wt_codons[exon_id], alt_codons):
@@ -105,26 +182,600 @@ class CodonComparison:
         )
         return df
 
+    @property
+    def effect_table(self) -> "EffectTable":
+        """
+        Lookup table of all single variants of the reference exons.
+
+        The table is built on first access. If a cache_dir is set, it is
+        stored there and reloaded as long as the reference is unchanged.
+        """
+        if not hasattr(self, "_effect_table"):
+            cache_file = None
+            if self.cache_dir is not None:
+                cache_file = self.effect_cache_file
+            if cache_file is not None and cache_file.exists():
+                instrumentation.count("cache_hits", cache="effect_table")
+                self._effect_table = EffectTable.load(cache_file)
+            else:
+                instrumentation.count("cache_misses", cache="effect_table")
+                with instrumentation.stage("mutalizer.build_effect_table"):
+                    self._effect_table = build_effect_table(self)
+                if cache_file is not None:
+                    self._effect_table.save(cache_file)
+        return self._effect_table
+
+    def get_variant_keys(self, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the variant keys of all rows and whether each row is a
+        single variant, i.e. equal to the reference outside the key window.
+        """
+        exon_indices = {exon_id: i for i, exon_id in enumerate(self.df_wt_exons.index)}
+        coding = self.df_wt_exons["Coding"]
+        keys, single = [], []
+        for exon_id, row in zip(df["ID"], df.to_dict("records")):
+            ref, alt = coding[exon_id], self.get_alt_coding(row)
+            keys.append(variant_key(exon_indices[exon_id], ref, alt))
+            single.append(is_single_variant(ref, alt))
+        return np.array(keys, dtype=np.uint64), np.array(single, dtype=bool)
+
+    def add_effect_columns_from_table(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the columns of extract_codon_from_sequence via the effect table.
+
+        Instead of parsing the HGVS annotation of each row, the variant is
+        derived from the library sequence and looked up in the precomputed
+        effect_table. Rows that do not correspond to a single variant in the
+        table (e.g. wildtype sequences) get empty values.
+        """
+        if len(df) == 0:
+            for column in effect_table_columns:
+                df[column] = pd.Series(dtype=object)
+            return df
+        keys, single = self.get_variant_keys(df)
+        effects = self.effect_table.lookup(keys, single)
+        effects.index = df.index
+        df[effect_table_columns] = effects
+        return df
+
+
+# nucleotide codes used in variant keys, 5 is used for padding
+_key_nucleotides = {"A": 0, "C": 1, "G": 2, "T": 3}
+effect_table_columns = ["RefCodon", "AltCodon"] + mutation_columns
+
+
+def variant_key(exon_index: int, ref: str, alt: str) -> int:
+    """
+    Returns a sortable integer key for a variant of an exon coding sequence.
+
+    The key is built from the exon index, the index of the first codon that
+    differs between ref and alt, the length difference and the first six
+    alternative bases starting at that codon. Variants that result in the
+    same alternative sequence (e.g. deletions within homopolymers) therefore
+    share the same key.
+
+    Parameters
+    ----------
+    exon_index : int
+        Index of the exon in the reference table.
+    ref : str
+        Reference coding sequence.
+    alt : str
+        Alternative coding sequence.
+
+    Returns
+    -------
+    int
+        64-bit variant key.
+    """
+    codon_index = len(os.path.commonprefix([ref, alt])) // 3
+    delta = len(alt) - len(ref)
+    if not -128 <= delta < 128:
+        raise ValueError(f"Length difference {delta} too large for a single variant.")
+    window = alt[codon_index * 3 : codon_index * 3 + 6]
+    code = 0
+    for i in range(6):
+        code = code * 8 + (_key_nucleotides.get(window[i], 4) if i < len(window) else 5)
+    return (exon_index << 48) | (codon_index << 32) | ((delta + 128) << 24) | code
+
+
+def is_single_variant(ref: str, alt: str) -> bool:
+    """
+    Checks that alt differs from ref only within the window of its variant key.
+
+    The key of variant_key only covers the alternative bases up to the end
+    of the codon after the first differing codon. A sequence with a single
+    variant continues with the reference shifted by the length difference
+    after that window, sequences with further changes do not.
+
+    Parameters
+    ----------
+    ref : str
+        Reference coding sequence.
+    alt : str
+        Alternative coding sequence.
+
+    Returns
+    -------
+    bool
+        True if alt is described completely by its variant key.
+    """
+    window_end = len(os.path.commonprefix([ref, alt])) // 3 * 3 + 6
+    delta = len(alt) - len(ref)
+    return window_end - delta >= 0 and alt[window_end:] == ref[window_end - delta :]
+
+
+def describe_variant(
+    ref: str, alt: str, first_aa_number: int
+) -> Tuple[str, str, str, str, str, str, str, str, str, str, str]:
+    """
+    Describes a variant of a coding sequence in the format of extract_codon_from_sequence.
+
+    Parameters
+    ----------
+    ref : str
+        Reference coding sequence.
+    alt : str
+        Alternative coding sequence.
+    first_aa_number : int
+        Amino acid number of the first codon in ref.
+
+    Returns
+    -------
+    Tuple[str, str, str, str, str, str, str, str, str, str, str]
+        RefCodon, AltCodon, type_g, type_g_fine, effect, type_p, codon,
+        codon_ref, codon_alt, aa_ref, aa_alt.
+    """
+    position = len(os.path.commonprefix([ref, alt]))
+    i = position // 3
+    ref_codon, alt_codon = ref[i * 3 : i * 3 + 3], alt[i * 3 : i * 3 + 3]
+    if len(ref_codon) < 3 or len(alt_codon) < 3:
+        ref_codon, alt_codon = "", ""
+    delta = len(alt) - len(ref)
+    if delta == 0:
+        type_g = "sub"
+        type_g_fine = f"sub{sum(a != b for a, b in zip(ref, alt))}"
+    elif delta < 0:
+        type_g, type_g_fine = "del", f"del{-delta}"
+    else:
+        inserted = alt[position : position + delta]
+        if delta == 1 and position > 0 and ref[position - 1] == inserted:
+            type_g, type_g_fine = "dup", "ins1"
+        else:
+            type_g, type_g_fine = "ins", f"ins{inserted}"
+    protein_ref, protein_alt = translate(ref), translate(alt)
+    j = len(os.path.commonprefix([protein_ref, protein_alt]))
+    number = str(first_aa_number + j)
+    if delta == 0:
+        aa_ref, aa_alt = protein_ref[i], protein_alt[i]
+        number = str(first_aa_number + i)
+        if aa_ref == aa_alt:
+            protein = "p.(=)", "syn", number, ref_codon, alt_codon, aa_ref, aa_alt
+        elif aa_alt == "*":
+            protein = f"p.{aa_ref}{number}X", "non", number, "", "", aa_ref, "X"
+        else:
+            effect = f"p.{aa_ref}{number}{aa_alt}"
+            protein = effect, "mis", number, ref_codon, alt_codon, aa_ref, aa_alt
+    elif delta % 3 == 0 and delta < 0:
+        aa_ref = protein_ref[j]
+        if protein_alt[j:] == protein_ref[j - delta // 3 :]:
+            protein = f"p.{aa_ref}{number}del", "del", number, "", "", aa_ref, ""
+        else:
+            aa_alt = protein_alt[j] if j < len(protein_alt) else ""
+            next_aa = f"{protein_ref[j + 1]}{first_aa_number + j + 1}"
+            effect = f"p.{aa_ref}{number}_{next_aa}delins{aa_alt}"
+            protein = effect, "delins", number, "", "", aa_ref, aa_alt
+    elif j >= min(len(protein_ref), len(protein_alt)):
+        protein = "p.(=)", "syn", "", "", "", "", ""
+    else:
+        aa_ref, aa_alt = protein_ref[j], protein_alt[j]
+        if aa_alt == "*":
+            protein = f"p.{aa_ref}{number}X", "non", number, "", "", aa_ref, "X"
+        else:
+            protein = f"p.{aa_ref}{number}{aa_alt}fs", "fs", number, "", "", aa_ref, aa_alt
+    return (ref_codon, alt_codon, type_g, type_g_fine) + protein
+
+
+def iterate_single_variants(coding: str) -> Iterator[str]:
+    """
+    Yields all single variants of a coding sequence.
+
+    These are all substitutions of a single codon by any other codon,
+    deletions of one to three bases and insertions of a single base at every
+    position.
+    """
+    codons = ["".join(c) for c in itertools.product("ACGT", repeat=3)]
+    for start in range(0, len(coding) - 2, 3):
+        for codon in codons:
+            if codon != coding[start : start + 3]:
+                yield coding[:start] + codon + coding[start + 3 :]
+    for position in range(len(coding)):
+        for length in (1, 2, 3):
+            if position + length <= len(coding):
+                yield coding[:position] + coding[position + length :]
+    for position in range(len(coding) + 1):
+        for base in "ACGT":
+            yield coding[:position] + base + coding[position:]
+
+
+class EffectTable:
+    """
+    Sorted lookup table mapping variant keys to variant effects.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        Sorted uint64 variant keys, see variant_key.
+    effects : pd.DataFrame
+        Effect columns, one row per key.
+    """
+
+    def __init__(self, keys: np.ndarray, effects: pd.DataFrame):
+        self.keys = keys
+        self.effects = effects
+
+    def __len__(self):
+        return len(self.keys)
 
-def extract_codon_from_sequence(df: pd.DataFrame) -> pd.DataFrame:
-    comparator = CodonComparison()
-    df = comparator.add_codon_columns_from_sequence(df)
-    df[
-        [
-            "type_g",
-            "type_g_fine",
-            "effect",
-            "type_p",
-            "codon",
-            "codon_ref",
-            "codon_alt",
-            "aa_ref",
-            "aa_alt",
-        ]
-    ] = df.apply(extract_mutation_details, axis=1, result_type="expand")
+    def lookup(self, keys: np.ndarray, valid: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """
+        Returns the effects for the given keys by binary search.
+
+        Keys that are not in the table or not valid, e.g. sequences with more
+        than one variant (see is_single_variant), get empty strings in all
+        columns.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        if valid is not None:
+            found &= valid
+        result = self.effects.iloc[positions].reset_index(drop=True)
+        result.loc[~found] = ""
+        return result
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {column: self.effects[column].to_numpy(dtype=str) for column in self.effects}
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as op:
+                np.savez_compressed(op, __keys__=self.keys, **arrays)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path: Path) -> "EffectTable":
+        with np.load(path, allow_pickle=False) as npz:
+            keys = npz["__keys__"]
+            effects = pd.DataFrame(
+                {column: npz[column].astype(object) for column in npz.files if column != "__keys__"}
+            )
+        return cls(keys, effects)
+
+
+def build_effect_table(comparator: CodonComparison) -> EffectTable:
+    """
+    Precomputes the effects of all single variants for all reference exons.
+
+    Parameters
+    ----------
+    comparator : CodonComparison
+        Reference exons to build the table for.
+
+    Returns
+    -------
+    EffectTable
+        Lookup table of all variants from iterate_single_variants.
+    """
+    keys = []
+    rows = []
+    seen = set()
+    for exon_index, (exon_id, wt) in enumerate(comparator.df_wt_exons.iterrows()):
+        coding = wt["Coding"]
+        for alt in iterate_single_variants(coding):
+            key = variant_key(exon_index, coding, alt)
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            rows.append(describe_variant(coding, alt, int(wt["first_aa_number"])))
+    keys = np.array(keys, dtype=np.uint64)
+    order = np.argsort(keys)
+    effects = pd.DataFrame(rows, columns=effect_table_columns).iloc[order]
+    return EffectTable(keys[order], effects.reset_index(drop=True))
+
+
+def annotate_from_effect_table(
+    df: pd.DataFrame, comparator: Optional[CodonComparison] = None, compact: bool = False
+) -> pd.DataFrame:
+    """
+    Annotates library sequences using the precomputed effect table.
+
+    This is the lookup based counterpart to extract_codon_from_sequence: it
+    adds the same columns, but only needs the ID and Sequence columns.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame with ID and Sequence columns.
+    comparator : Optional[CodonComparison], optional
+        Reference to compare against, by default the shared instance from
+        get_codon_comparison.
+    compact : bool, optional
+        If True, convert the columns with compact_mutation_columns, by default False.
+
+    Returns
+    -------
+    pd.DataFrame
+        The annotated DataFrame.
+    """
+    if comparator is None:
+        comparator = get_codon_comparison()
+    with instrumentation.stage("mutalizer.annotate_from_effect_table"):
+        df = comparator.add_effect_columns_from_table(df)
+        if compact:
+            df = compact_mutation_columns(df)
+    if instrumentation.enabled:
+        instrumentation.count("mutalizer.rows_annotated", len(df), method="effect_table")
+    return df
+
+
+def get_codon_comparison(
+    path_to_df: Path = default_reference, cache_dir: Optional[Path] = None
+) -> CodonComparison:
+    """
+    Returns a process-wide CodonComparison for the given reference table.
+
+    The instance is created once and reused for all subsequent calls as long
+    as the reference file is unchanged. If cache_dir is given, the effect
+    table is cached there, so that other processes can skip building it.
+
+    Parameters
+    ----------
+    path_to_df : Path, optional
+        Path to the reference table, by default default_reference.
+    cache_dir : Optional[Path], optional
+        Directory for the on-disk effect table cache, by default None.
+
+    Returns
+    -------
+    CodonComparison
+        The shared CodonComparison instance.
+    """
+    path = Path(path_to_df).resolve()
+    key = (str(path), None if cache_dir is None else str(Path(cache_dir).resolve()))
+    stat = path.stat()
+    if key in _reference_instances:
+        mtime, size, comparator = _reference_instances[key]
+        if mtime == stat.st_mtime_ns and size == stat.st_size:
+            instrumentation.count("cache_hits", cache="codon_comparison")
+            return comparator
+    instrumentation.count("cache_misses", cache="codon_comparison")
+    comparator = CodonComparison(path, cache_dir)
+    _reference_instances[key] = (stat.st_mtime_ns, stat.st_size, comparator)
+    return comparator
+
+
+def extract_codon_from_sequence(
+    df: pd.DataFrame, comparator: Optional[CodonComparison] = None, compact: bool = False
+) -> pd.DataFrame:
+    if comparator is None:
+        comparator = get_codon_comparison()
+    with instrumentation.stage("mutalizer.extract_codon_from_sequence"):
+        df = comparator.add_codon_columns_from_sequence(df)
+        df[mutation_columns] = df.apply(extract_mutation_details, axis=1, result_type="expand")
+        if compact:
+            df = compact_mutation_columns(df)
+    if instrumentation.enabled:
+        instrumentation.count("mutalizer.rows_annotated", len(df), method="regex")
+    return df
+
+
+def compact_mutation_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the columns added by extract_codon_from_sequence to compact dtypes.
+
+    Class, codon and amino acid columns become categoricals. Where the
+    vocabulary is known in advance (mutation types, the 64 codons, one letter
+    amino acid codes) the categories are fixed, so that the integer codes are
+    identical across separately annotated tables or chunks. Unexpected values
+    are appended to the categories rather than dropped. The codon position
+    becomes a nullable integer column with <NA> for missing positions.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame as returned by extract_codon_from_sequence.
+
+    Returns
+    -------
+    pd.DataFrame
+        The same DataFrame with compact column dtypes.
+    """
+    for column, vocabulary in compact_vocabularies.items():
+        if column not in df:
+            continue
+        if vocabulary is None:
+            df[column] = df[column].astype("category")
+        else:
+            values = df[column].astype(str)
+            unexpected = sorted(set(values.unique()) - set(vocabulary))
+            df[column] = pd.Categorical(values, categories=vocabulary + unexpected)
+    if "codon" in df:
+        codon = df["codon"]
+        df["codon"] = pd.to_numeric(codon.mask(codon == "")).astype("Int64")
     return df
 
 
+def _is_parquet(path: Path) -> bool:
+    return path.suffix in (".parquet", ".pq")
+
+
+def iterate_variant_chunks(
+    infile: Path,
+    chunksize: int = 100000,
+    sep: str = "\t",
+    csv_kwargs: Optional[Dict] = None,
+    parquet_kwargs: Optional[Dict] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yields a variant table in chunks of at most chunksize rows.
+
+    Parquet files are read batch-wise from their row groups, everything else
+    is read as delimited text with pandas.
+
+    Parameters
+    ----------
+    infile : Path
+        Variant table, either Parquet or delimited text.
+    chunksize : int, optional
+        Maximum number of rows per chunk, by default 100000.
+    sep : str, optional
+        Delimiter for text input, by default tab.
+    csv_kwargs : Optional[Dict], optional
+        Additional arguments for pd.read_csv, by default None.
+    parquet_kwargs : Optional[Dict], optional
+        Additional arguments for pyarrow's ParquetFile.iter_batches, e.g.
+        columns, by default None.
+
+    Yields
+    ------
+    Iterator[pd.DataFrame]
+        Consecutive chunks of the variant table.
+    """
+    infile = Path(infile)
+    if _is_parquet(infile):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(infile)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, **(parquet_kwargs or {})):
+            yield batch.to_pandas()
+    else:
+        with pd.read_csv(infile, sep=sep, chunksize=chunksize, **(csv_kwargs or {})) as reader:
+            for chunk in reader:
+                yield chunk
+
+
+def _promote_schema(schema: "pa.Schema", empty_columns: List[str]) -> "pa.Schema":
+    """
+    Stores all-null columns as strings, integer columns as int64 and gives
+    dictionary columns int32 indices, whatever the first chunk needed.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for field in schema:
+        if pa.types.is_null(field.type) or field.name in empty_columns:
+            field = field.with_type(pa.string())
+        elif pa.types.is_integer(field.type):
+            # float chunks with NaN (missing values) are written as nulls
+            field = field.with_type(pa.int64())
+        elif pa.types.is_dictionary(field.type):
+            # pandas picks int8 codes for few categories, later chunks may have more
+            field = field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def annotate_variant_file(
+    infile: Union[Path, str],
+    outfile: Union[Path, str],
+    chunksize: int = 100000,
+    comparator: Optional[CodonComparison] = None,
+    sep: str = "\t",
+    compact: bool = False,
+    csv_kwargs: Optional[Dict] = None,
+    parquet_kwargs: Optional[Dict] = None,
+) -> int:
+    """
+    Annotates a variant table chunk by chunk and writes the result incrementally.
+
+    Only one chunk is held in memory at any time, so peak memory is bounded by
+    chunksize rather than by the size of the table. The output format is
+    chosen by the suffix of outfile: .parquet/.pq writes a Parquet file with
+    one row group per chunk, anything else is written as TSV. The Parquet
+    schema is fixed by the first chunk, with columns that are empty in it
+    stored as strings, integer columns as nullable int64 and categorical
+    columns with int32 dictionary indices, so that later chunks with values,
+    missing values or more categories in these columns fit the schema.
+
+    Parameters
+    ----------
+    infile : Union[Path, str]
+        Variant table to annotate (Parquet or delimited text).
+    outfile : Union[Path, str]
+        Output file for the annotated table.
+    chunksize : int, optional
+        Number of rows annotated at once, by default 100000.
+    comparator : Optional[CodonComparison], optional
+        Reference to compare against, by default the shared instance from
+        get_codon_comparison.
+    sep : str, optional
+        Delimiter for text input, by default tab.
+    compact : bool, optional
+        If True, write compact dtypes (see compact_mutation_columns), which
+        become dictionary encoded columns in Parquet output, by default False.
+    csv_kwargs : Optional[Dict], optional
+        Additional arguments for pd.read_csv, by default None.
+    parquet_kwargs : Optional[Dict], optional
+        Additional arguments for pyarrow's ParquetFile.iter_batches, by
+        default None.
+
+    Returns
+    -------
+    int
+        Number of annotated rows.
+    """
+    outfile = Path(outfile)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    if comparator is None:
+        comparator = get_codon_comparison()
+    writer = None
+    rows = 0
+    try:
+        for chunk in iterate_variant_chunks(infile, chunksize, sep, csv_kwargs, parquet_kwargs):
+            if len(chunk) == 0:
+                continue
+            text_columns = [
+                c for c in ["hg38 genomic", "hg38 protein", "Effect New"] if c in chunk
+            ]
+            chunk[text_columns] = chunk[text_columns].fillna("")
+            chunk = extract_codon_from_sequence(chunk, comparator, compact)
+            if _is_parquet(outfile):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    empty = [column for column in chunk if chunk[column].isna().all()]
+                    schema = _promote_schema(table.schema, empty)
+                    writer = pq.ParquetWriter(outfile, schema)
+                    string_columns = [f.name for f in schema if pa.types.is_string(f.type)]
+                for column in string_columns:
+                    values = chunk[column]
+                    if values.dtype != object:
+                        present = values.notna()
+                        converted = pd.Series(None, index=values.index, dtype=object)
+                        converted[present] = values[present].astype(str)
+                        chunk[column] = converted
+                table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                writer.write_table(table)
+            else:
+                first = rows == 0
+                chunk.to_csv(
+                    outfile, sep="\t", index=False, mode="w" if first else "a", header=first
+                )
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
 def extract_mutation_details(row: pd.Series) -> Tuple[str, str, str, str, str, str, str, str, str]:
     """
     Extracts mutation details from a row of a dataframe.
@@ -147,6 +798,8 @@ def extract_genomic_info(row: pd.Series) -> Tuple[str, str]:
     ]:
         match = matcher(row["hg38 genomic"])
         if match:
+            if instrumentation.enabled:
+                instrumentation.count("mutalizer.regex_matches", pattern=matcher.__name__)
             return match
     raise ValueError(f'Could not match {row["hg38 genomic"]}.')
 
@@ -163,6 +816,8 @@ def extract_protein_info(row: pd.Series) -> Tuple[str, str, str, str, str, str,
     ]:
         match = matcher(row)
         if match:
+            if instrumentation.enabled:
+                instrumentation.count("mutalizer.regex_matches", pattern=matcher.__name__)
             return match
     raise ValueError(f'Could not match {row["hg38 protein"]}, {row["Effect New"]}.')
 
@@ -6,145 +6,588 @@ uniprot.py: Contains some functions for retrieving ENSEMBL ids for certain
 protein classes.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Dict
-from pypipegraph import Job
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 from pandas import DataFrame
+import os
 import pandas as pd
-import requests
-import parse
 import re
+import sqlite3
+import tempfile
+import time
+from .util import DownloadCache, default_cache_dir, download_cached, file_checksum, _write_atomic
+
+if TYPE_CHECKING:
+    from pypipegraph import Job
 
 __author__ = "Marco Mernberger"
 __copyright__ = "Copyright (c) 2020 Marco Mernberger"
 __license__ = "mit"
 
 
-def get_kinase_from_url(species: str = "mouse") -> DataFrame:
+pkinfam_url = "https://www.uniprot.org/docs/pkinfam.txt"
+_kinase_entry = re.compile(r"_([A-Z0-9]+)\s*\(\s*([A-Z0-9]+)\s*\)")
+
+
+def iterate_kinase_families(lines: Iterable[str]) -> Iterator[Tuple[str, str, str]]:
+    """
+    Parses the lines of a pkinfam.txt document in a single pass.
+
+    Kinase families are headed by a line framed by two lines ending in '=',
+    framed lines starting with whitespace (e.g. the document title) are no
+    families. All entries following a family header up to the next header
+    belong to that family.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        Lines of the document, e.g. an open file.
+
+    Yields
+    ------
+    Iterator[Tuple[str, str, str]]
+        Species mnemonic (e.g. 'HUMAN'), uniprot id and kinase class.
+    """
+    before, previous = "", ""
+    group = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.endswith("=") and before.endswith("=") and previous:
+            group = None if previous[0].isspace() else previous
+        elif group is not None:
+            for species, uniprot in _kinase_entry.findall(line):
+                yield species, uniprot, group
+        before, previous = previous, line
+
+
+def parse_kinase_families(
+    lines: Iterable[str], species: Optional[Union[str, List[str]]] = None
+) -> DataFrame:
+    """
+    Returns a DataFrame with kinase uniprot ids and classes from pkinfam.txt lines.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        Lines of the document, e.g. an open file.
+    species : Optional[Union[str, List[str]]], optional
+        Species to keep, e.g. 'mouse' or ['human', 'mouse'], by default all.
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with columns 'species', 'uniprot_id' and 'kinase class'.
+    """
+    if isinstance(species, str):
+        species = [species]
+    keep = None if species is None else {s.upper() for s in species}
+    to_df: Dict[str, List] = {"species": [], "uniprot_id": [], "kinase class": []}
+    for mnemonic, uniprot, group in iterate_kinase_families(lines):
+        if keep is None or mnemonic in keep:
+            to_df["species"].append(mnemonic.lower())
+            to_df["uniprot_id"].append(uniprot)
+            to_df["kinase class"].append(group)
+    return pd.DataFrame(to_df)
+
+
+def fetch_kinase_source(
+    source: Optional[Union[Path, str]] = None, cache: Optional[DownloadCache] = None
+) -> Path:
+    """
+    Returns a local path of the kinase family document.
+
+    Parameters
+    ----------
+    source : Optional[Union[Path, str]], optional
+        Url or local copy of pkinfam.txt, by default pkinfam_url.
+    cache : Optional[DownloadCache], optional
+        Cache for downloaded urls, by default the download_cached default.
+
+    Returns
+    -------
+    Path
+        The local file, urls are fetched via the cache.
+    """
+    if source is None:
+        source = pkinfam_url
+    if isinstance(source, str) and re.match(r"(https?|ftp)://", source):
+        return download_cached(source, cache)
+    return Path(source)
+
+
+def get_kinase_from_url(
+    species: Union[str, List[str]] = "mouse", source: Optional[Union[Path, str]] = None
+) -> DataFrame:
     """
     Retrieves a list of kinases from the uniprot server and returns a DataFrame
     with kinase uniprot ids and corresponding classes.
 
+    The document is downloaded via download_cached and parsed line by line,
+    so several species are obtained with a single download and parse.
+
     Parameters
     ----------
-    species : str, optional
-        Species to use, must be either "mouse" or "human", by default "mouse".
+    species : Union[str, List[str]], optional
+        Species to use, must be either "mouse" or "human" or a list of both,
+        by default "mouse".
+    source : Optional[Union[Path, str]], optional
+        Url or local copy of pkinfam.txt, by default pkinfam_url.
 
     Returns
     -------
     DataFrame
-        A DataFrame with kinase uniprot ids and corresponding classes.
+        A DataFrame with kinase uniprot ids and corresponding classes, with an
+        additional 'species' column if a list of species was given.
 
     Raises
     ------
     ValueError
         If the wrong species was provided.
     """
-    if species not in ["mouse", "human"]:
+    species_list = [species] if isinstance(species, str) else list(species)
+    if any(s not in ["mouse", "human"] for s in species_list):
         raise ValueError(
             "SwissProt has only information for human and mouse kinases, set species accordingly."
         )
-    species = species.upper()
-    pattern = species + "{uniprot})"
-    url_for_kinases = "https://www.uniprot.org/docs/pkinfam.txt"
-    r = requests.get(url_for_kinases)
-    to_df: Dict[str, List] = {"uniprot_id": [], "kinase class": []}
-    for p in parse.findall("=\n{group}\n{equals}=\n{kinases}\n\n", r.text):
-        group = p["group"]
-        if not re.match(r"\s", group):
-            kinase_block = p["kinases"]
-            for k in parse.findall(pattern, kinase_block):
-                uniprot = k["uniprot"].strip()[1:]
-                to_df["uniprot_id"].append(uniprot)
-                to_df["kinase class"].append(group)
-    return pd.DataFrame(to_df)
+    with open(fetch_kinase_source(source), encoding="utf-8", errors="replace") as handle:
+        df = parse_kinase_families(handle, species_list)
+    if isinstance(species, str):
+        df = df[["uniprot_id", "kinase class"]]
+    return df
 
 
-def uniprot_to_ensenbl(uniprot_ids: List[str]) -> DataFrame:
+class IDMapper:
     """
-    Converts a list of uniprot IDs to Ensembl IDs using the Uniprot conversion
-    tool.
+    Client for the UniProt ID mapping service with a local SQLite cache.
+
+    IDs are split into batches of at most batch_size, which are submitted
+    concurrently as ID mapping jobs. Results are stored in a SQLite cache
+    keyed by (from, to, id), including IDs without any mapping, and only IDs
+    missing from the cache or older than ttl are queried.
+
+    Parameters
+    ----------
+    cache_file : Optional[Path], optional
+        SQLite database for cached mappings, by default no persistent cache
+        (an in-memory database).
+    ttl : float, optional
+        Seconds after which cached mappings are refetched, by default 30 days.
+    batch_size : int, optional
+        Maximum number of IDs per job, by default 500.
+    max_workers : int, optional
+        Number of concurrently submitted jobs, by default 4.
+    base_url : str, optional
+        Base url of the ID mapping service, by default 'https://rest.uniprot.org'.
+    retries : int, optional
+        Number of retries per request, by default 3.
+    poll_interval : float, optional
+        Seconds between job status checks, by default 1.
+    """
+
+    def __init__(
+        self,
+        cache_file: Optional[Path] = None,
+        ttl: float = 30 * 86400,
+        batch_size: int = 500,
+        max_workers: int = 4,
+        base_url: str = "https://rest.uniprot.org",
+        retries: int = 3,
+        poll_interval: float = 1.0,
+    ):
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.poll_interval = poll_interval
+        if cache_file is not None:
+            Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(":memory:" if cache_file is None else str(cache_file))
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS mapping ("
+                "from_db TEXT, to_db TEXT, id TEXT, target TEXT, fetched REAL, "
+                "PRIMARY KEY (from_db, to_db, id, target))"
+            )
+
+    def _request(self, method: str, url: str, **kwargs):
+        import requests
+
+        for attempt in range(self.retries + 1):
+            try:
+                r = requests.request(method, url, timeout=60, **kwargs)
+                if r.status_code < 500:
+                    r.raise_for_status()
+                    return r
+                error = ValueError("HTTP Error return: %i fetching %s" % (r.status_code, url))
+            except requests.RequestException as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.poll_interval * 2 ** attempt)
+        raise ValueError(f"Could not fetch {url}: {error}")
+
+    def _map_batch(self, ids: List[str], from_db: str, to_db: str) -> List[Tuple[str, str]]:
+        r = self._request(
+            "POST",
+            f"{self.base_url}/idmapping/run",
+            data={"from": from_db, "to": to_db, "ids": ",".join(ids)},
+        )
+        job_id = r.json()["jobId"]
+        while True:
+            status = self._request(
+                "GET", f"{self.base_url}/idmapping/status/{job_id}", allow_redirects=False
+            )
+            if status.status_code == 200 and status.json().get("jobStatus") in (
+                "NEW",
+                "RUNNING",
+            ):
+                time.sleep(self.poll_interval)
+                continue
+            break
+        r = self._request(
+            "GET", f"{self.base_url}/idmapping/stream/{job_id}", params={"format": "tsv"}
+        )
+        pairs = []
+        for line in r.text.split("\n")[1:]:
+            fields = line.split("\t")
+            if len(fields) >= 2:
+                pairs.append((fields[0], fields[1]))
+        return pairs
+
+    def cached(self, ids: Iterable[str], from_db: str, to_db: str) -> Dict[str, List[str]]:
+        """Returns the unexpired cached mappings for ids, IDs without mapping map to []."""
+        result: Dict[str, List[str]] = {}
+        oldest = time.time() - self.ttl
+        ids = list(ids)
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset : offset + 500]
+            rows = self.connection.execute(
+                "SELECT id, target FROM mapping WHERE from_db = ? AND to_db = ? AND fetched >= ? "
+                f"AND id IN ({','.join('?' * len(chunk))})",
+                [from_db, to_db, oldest] + chunk,
+            )
+            for id_, target in rows:
+                result.setdefault(id_, [])
+                if target != "":
+                    result[id_].append(target)
+        return result
+
+    def map(
+        self,
+        ids: Iterable[str],
+        from_db: str = "UniProtKB_AC-ID",
+        to_db: str = "Ensembl",
+    ) -> DataFrame:
+        """
+        Maps ids from from_db to to_db, querying only IDs not in the cache.
+
+        Parameters
+        ----------
+        ids : Iterable[str]
+            IDs to map.
+        from_db : str, optional
+            Source database, by default 'UniProtKB_AC-ID'.
+        to_db : str, optional
+            Target database, by default 'Ensembl'.
+
+        Returns
+        -------
+        DataFrame
+            DataFrame with columns 'from' and 'to', one row per mapping.
+        """
+        ids = list(dict.fromkeys(ids))
+        result = self.cached(ids, from_db, to_db)
+        missing = [id_ for id_ in ids if id_ not in result]
+        batches = [
+            missing[offset : offset + self.batch_size]
+            for offset in range(0, len(missing), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            fetched = list(
+                executor.map(lambda batch: self._map_batch(batch, from_db, to_db), batches)
+            )
+        now = time.time()
+        with self.connection:
+            for batch, pairs in zip(batches, fetched):
+                self.connection.executemany(
+                    "DELETE FROM mapping WHERE from_db = ? AND to_db = ? AND id = ?",
+                    [(from_db, to_db, id_) for id_ in batch],
+                )
+                mapped = {id_: [] for id_ in batch}
+                for id_, target in pairs:
+                    mapped.setdefault(id_, []).append(target)
+                rows = [
+                    (from_db, to_db, id_, target, now)
+                    for id_, targets in mapped.items()
+                    for target in (targets or [""])
+                ]
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO mapping VALUES (?, ?, ?, ?, ?)", rows
+                )
+                result.update(mapped)
+        to_df: Dict[str, List] = {"from": [], "to": []}
+        for id_ in ids:
+            for target in result.get(id_, []):
+                to_df["from"].append(id_)
+                to_df["to"].append(target)
+        return pd.DataFrame(to_df)
+
+
+def uniprot_to_ensenbl(uniprot_ids: List[str], mapper: Optional[IDMapper] = None) -> DataFrame:
+    """
+    Converts a list of uniprot IDs to Ensembl IDs using the Uniprot ID mapping
+    service.
 
     Parameters
     ----------
     uniprot_ids : List[str]
         List of IDs to convert.
+    mapper : Optional[IDMapper], optional
+        IDMapper to use, e.g. one with a persistent cache, by default a new
+        IDMapper without persistent cache.
 
     Returns
     -------
     DataFrame
         DataFrame with uniprot IDs and corresponding Ensembl IDs.
     """
-    query = " ".join(uniprot_ids)
-    url_uniprot = "https://www.uniprot.org/uploadlists/"
-    payload = {
-        "from": "ACC+ID",
-        "to": "ENSEMBL_ID",
-        "format": "tab",
-        "query": query,
-    }
-    r = requests.get(url_uniprot, params=payload)
-    to_df: Dict[str, List] = {"uniprot": [], "gene_stable_id": []}
-    lines = r.text.split("\n")
-    for line in lines[1:]:
-        try:
-            u, e = line.split("\t")
-            to_df["uniprot"].append(u)
-            to_df["gene_stable_id"].append(e)
-        except ValueError:
-            pass
-    return pd.DataFrame(to_df)
+    if mapper is None:
+        mapper = IDMapper()
+    df = mapper.map(uniprot_ids, "UniProtKB_AC-ID", "Ensembl")
+    # Ensembl IDs are reported with version, gene stable ids are unversioned
+    df["to"] = df["to"].str.replace(r"\.\d+$", "", regex=True)
+    return df.rename(columns={"from": "uniprot", "to": "gene_stable_id"})
+
+
+snapshot_version = 1
+snapshot_columns = ["species", "uniprot_id", "kinase class", "gene_stable_id"]
+
+
+def default_snapshot() -> Path:
+    """
+    Returns the kinase snapshot used by get_kinases_with_ensembl_ids.
+
+    This is $MUTILITY_KINASE_SNAPSHOT if set, otherwise the snapshot of the
+    current snapshot_version in the user cache directory (see
+    util.default_cache_dir), where export_kinase_snapshot() writes it.
+    """
+    cached = default_cache_dir() / f"kinases.v{snapshot_version}.parquet"
+    return Path(os.environ.get("MUTILITY_KINASE_SNAPSHOT", cached))
+
+
+def export_kinase_snapshot(
+    outfile: Optional[Path] = None,
+    species: Iterable[str] = ("human", "mouse"),
+    mapper: Optional[IDMapper] = None,
+    source: Optional[Union[Path, str]] = None,
+) -> Path:
+    """
+    Writes the kinase table and Ensembl ID mappings to a snapshot file.
+
+    The snapshot is a zstd compressed Parquet file with one row per kinase
+    and Ensembl gene (columns in snapshot_columns). The snapshot_version,
+    creation time and sha256 of the kinase document are stored in the
+    schema metadata.
+
+    Parameters
+    ----------
+    outfile : Optional[Path], optional
+        Snapshot file to write, by default default_snapshot().
+    species : Iterable[str], optional
+        Species to include, by default human and mouse.
+    mapper : Optional[IDMapper], optional
+        IDMapper for the conversion to Ensembl IDs, by default a new IDMapper
+        without persistent cache.
+    source : Optional[Union[Path, str]], optional
+        Url or local copy of pkinfam.txt, by default pkinfam_url.
+
+    Returns
+    -------
+    Path
+        The snapshot file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    outfile = default_snapshot() if outfile is None else Path(outfile)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    source_file = fetch_kinase_source(source)
+    df_uniprot = get_kinase_from_url(list(species), source_file)
+    df_ensembl = uniprot_to_ensenbl(df_uniprot["uniprot_id"].unique(), mapper)
+    df = df_uniprot.merge(df_ensembl, how="left", left_on="uniprot_id", right_on="uniprot")
+    table = pa.Table.from_pandas(df[snapshot_columns], preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            "mutility_snapshot_version": str(snapshot_version),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "source_sha256": file_checksum(source_file),
+        }
+    )
+    fd, tmp = tempfile.mkstemp(dir=outfile.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, outfile)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return outfile
 
 
-def get_kinases_with_ensembl_ids(species: str) -> DataFrame:
+def load_kinase_snapshot(
+    snapshot: Optional[Path] = None, species: Optional[Union[str, List[str]]] = None
+) -> DataFrame:
+    """
+    Reads a snapshot written by export_kinase_snapshot via memory mapping.
+
+    Parameters
+    ----------
+    snapshot : Optional[Path], optional
+        Snapshot file, by default default_snapshot().
+    species : Optional[Union[str, List[str]]], optional
+        Species to read, by default all.
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with the columns in snapshot_columns.
+
+    Raises
+    ------
+    ValueError
+        If the snapshot does not exist or was written with a different
+        snapshot_version.
+    """
+    snapshot = default_snapshot() if snapshot is None else Path(snapshot)
+    if not snapshot.exists():
+        raise ValueError(
+            f"Kinase snapshot {snapshot} does not exist. Create it with "
+            "export_kinase_snapshot() or point $MUTILITY_KINASE_SNAPSHOT to one."
+        )
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(snapshot, memory_map=True).metadata or {}
+    version = metadata.get(b"mutility_snapshot_version", b"").decode()
+    if version != str(snapshot_version):
+        raise ValueError(
+            f"Snapshot {snapshot} has version {version or 'unknown'}, expected {snapshot_version}."
+        )
+    if isinstance(species, str):
+        species = [species]
+    filters = None if species is None else [("species", "in", list(species))]
+    table = pq.read_table(snapshot, memory_map=True, filters=filters)
+    return table.to_pandas()[snapshot_columns]
+
+
+def get_kinases_with_ensembl_ids(
+    species: str,
+    mapper: Optional[IDMapper] = None,
+    source: Optional[Union[Path, str]] = None,
+    snapshot: Optional[Path] = None,
+    refresh: bool = False,
+) -> DataFrame:
     """
     Returns a DataFrame containing all kinase for the given species from uniprot,
     their corresponding enzyme class and ensembl stable ids.
 
+    If no source is given and the snapshot exists, the table is read from
+    the snapshot without any network access. Otherwise, or with refresh set,
+    the table is fetched from uniprot.
+
     Parameters
     ----------
     species : str
         The species to use must be either "human" or "mouse".
+    mapper : Optional[IDMapper], optional
+        IDMapper for the conversion to Ensembl IDs, by default a new IDMapper
+        without persistent cache.
+    source : Optional[Union[Path, str]], optional
+        Url or local copy of pkinfam.txt, by default pkinfam_url.
+    snapshot : Optional[Path], optional
+        Snapshot written by export_kinase_snapshot, by default default_snapshot().
+    refresh : bool, optional
+        Fetch the table from uniprot even if a snapshot exists, by default False.
 
     Returns
     -------
     DataFrame
         DataFrame containing ensembl ids, uniprot ids and kinase class.
     """
-    df_uniprot = get_kinase_from_url(species)
-    df_uniprot.index = df_uniprot["uniprot_id"]
-    df_ensembl = uniprot_to_ensenbl(df_uniprot["uniprot_id"].values)
-    df_ensembl.index = df_ensembl["uniprot"]
-    df = df_uniprot.join(df_ensembl)
-    df = df[["gene_stable_id", "uniprot_id", "kinase class"]]
+    snapshot = default_snapshot() if snapshot is None else Path(snapshot)
+    if source is None and not refresh and snapshot.exists():
+        df = load_kinase_snapshot(snapshot, species)
+        df = df[["gene_stable_id", "uniprot_id", "kinase class"]]
+    else:
+        df_uniprot = get_kinase_from_url(species, source)
+        df_uniprot.index = df_uniprot["uniprot_id"]
+        df_ensembl = uniprot_to_ensenbl(df_uniprot["uniprot_id"].values, mapper)
+        df_ensembl.index = df_ensembl["uniprot"]
+        df = df_uniprot.join(df_ensembl)
+        df = df[["gene_stable_id", "uniprot_id", "kinase class"]]
     df = df.drop_duplicates(subset=["gene_stable_id"])  # we want that unique for indexing
     assert len(df["gene_stable_id"].unique()) == len(df)
     return df
 
 
-def write_kinases(outfile: Path, species: str) -> Job:
+def write_kinases(
+    outfile: Path,
+    species: str,
+    source: Optional[Union[Path, str]] = None,
+    cache: Optional[DownloadCache] = None,
+    base_url: str = "https://rest.uniprot.org",
+) -> "Job":
     """
     Returns a job that writes a DataFrame containing all kinase for the given
     species from uniprot, their corresponding enzyme class and ensembl stable ids.
 
+    The kinase document is fetched into a DownloadCache when the job is
+    created and its sha256 is part of a ParameterInvariant, so the table is
+    rebuilt when the document, the species or the involved functions change,
+    and not otherwise. Within the cache's max_age, creating the job needs no
+    network access. ID mappings are kept in a persistent IDMapper cache next
+    to the downloads and the table is written atomically, so an interrupted
+    job never leaves a partial outfile.
+
     Parameters
     ----------
     outfile : Path
         The filepath to write the DataFrame to.
     species : str
         The species to use must be either "human" or "mouse".
+    source : Optional[Union[Path, str]], optional
+        Url or local copy of pkinfam.txt, by default pkinfam_url.
+    cache : Optional[DownloadCache], optional
+        Cache for the kinase document and ID mappings, by default a
+        DownloadCache in the default cache directory.
+    base_url : str, optional
+        Base url of the ID mapping service, by default 'https://rest.uniprot.org'.
 
     Returns
     -------
     Job
         The Job that writes the DataFrame.
     """
+    import pypipegraph as ppg
+
+    outfile = Path(outfile)
     outfile.parent.mkdir(parents=True, exist_ok=True)
+    if cache is None:
+        cache = DownloadCache()
+    source_file = fetch_kinase_source(source, cache)
+    mapper_cache = cache.cache_dir / "idmapping.sqlite"
+    parameters = (species, file_checksum(source_file), base_url)
 
     def __write(outfile):
-        df = get_kinases_with_ensembl_ids(species)
-        df.to_csv(outfile, sep="\t", index=False)
+        mapper = IDMapper(mapper_cache, base_url=base_url)
+        df = get_kinases_with_ensembl_ids(species, mapper, source_file, refresh=True)
+        _write_atomic(Path(outfile), df.to_csv(sep="\t", index=False).encode())
 
-    return ppg2.FileGeneratingJob(outfile, __write).depends_on(
-        ppg2.FunctionInvariant("get_kinases_with_ensembl_ids", get_kinases_with_ensembl_ids)
+    return ppg.FileGeneratingJob(outfile, __write).depends_on(
+        [
+            ppg.ParameterInvariant(f"write_kinases_{outfile}", parameters),
+            ppg.FunctionInvariant("get_kinases_with_ensembl_ids", get_kinases_with_ensembl_ids),
+            ppg.FunctionInvariant("parse_kinase_families", parse_kinase_families),
+        ]
     )
@@ -1,5 +1,30 @@
-from typing import Iterable
-from scipy.spatial.distance import hamming
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import urllib.parse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    BinaryIO,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from .instrumentation import instrumentation
 
 
 def download_file(url, file_object):
@@ -19,7 +44,6 @@ def download_file(url, file_object):
 def download_http(url, file_object):
     """Download a file from http"""
     import requests
-    import shutil
 
     r = requests.get(url, stream=True)
     if r.status_code != 200:
@@ -31,26 +55,18 @@ def download_http(url, file_object):
 def download_ftp(url, file_object):
     """Download a file from ftp"""
     import ftplib
-    import urllib
 
-    schema, host, path, parameters, query, fragment = urllib.parse.urlparse(url)
+    parsed = urllib.parse.urlparse(url)
+    path = parsed.path
     if "ftp_proxy" in os.environ:
-        tf = tempfile.NamedTemporaryFile()
-        cmd = ["wget", "-O", tf.name, url]
-        subprocess.check_call(cmd)
-        tf.seek(0, 0)
-        bs = 1024 * 1024 * 10
-        block = tf.read(bs)
-        while block:
-            file_object.write(block)
-            block = tf.read(bs)
-        tf.close()
+        with tempfile.NamedTemporaryFile() as tf:
+            cmd = ["wget", "-q", "-O", tf.name, url]
+            subprocess.check_call(cmd)
+            shutil.copyfileobj(tf, file_object)
 
     else:
-        with ftplib.FTP(host) as ftp:
+        with _ftp_connect(parsed) as ftp:
             try:
-                ftp.set_pasv(True)
-                ftp.login("anonymous", "")
                 if "\n" in path:  # pragma: no cover
                     raise ValueError("New line in path: %s" % (repr(path),))
                 if path.endswith("/"):
@@ -61,21 +77,845 @@ def download_ftp(url, file_object):
                 raise ValueError("Error retrieving urls %s: %s" % (url, e))
 
 
-def flatten(list_of_lists: Iterable) -> Iterable:
+def _ftp_connect(parsed: urllib.parse.ParseResult):
+    import ftplib
+
+    ftp = ftplib.FTP()
+    try:
+        ftp.connect(parsed.hostname, parsed.port or 21)
+        ftp.set_pasv(True)
+        ftp.login(parsed.username or "anonymous", parsed.password or "")
+    except BaseException:
+        ftp.close()
+        raise
+    return ftp
+
+
+class _PermanentDownloadError(ValueError):
+    """Download error that a retry will not fix, e.g. HTTP 404."""
+
+
+def _is_transient(error: Exception) -> bool:
+    """Server errors, connection errors and timeouts are worth a retry."""
+    import ftplib
+
+    try:
+        import requests
+    except ImportError:  # pragma: no cover
+        requests = None
+    if requests is not None and isinstance(error, requests.RequestException):
+        return isinstance(
+            error,
+            (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError),
+        )
+    if isinstance(error, _PermanentDownloadError):
+        return False
+    # ValueError: HTTP 5xx or a checksum mismatch of the transferred data
+    return isinstance(error, (ValueError, OSError, EOFError, ftplib.error_temp))
+
+
+def file_checksum(filename: Path, algorithm: str = "sha256") -> str:
+    """Returns the hex digest of a file."""
+    h = hashlib.new(algorithm)
+    with Path(filename).open("rb") as op:
+        for block in iter(lambda: op.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _verify_checksum(filename: Path, checksum: Optional[str]):
+    if checksum is None:
+        return
+    algorithm, _, expected = checksum.rpartition(":")
+    observed = file_checksum(filename, algorithm or "sha256")
+    if observed != expected.lower():
+        raise ValueError(f"Checksum mismatch for {filename}: {observed} != {expected}")
+
+
+def _resume_http(url: str, partial: Path, timeout: float):
+    import requests
+
+    offset = partial.stat().st_size if partial.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with requests.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        if r.status_code == 416 and offset:
+            # range not satisfiable, the partial file is already complete
+            return
+        if r.status_code not in (200, 206):
+            error = _PermanentDownloadError if r.status_code < 500 else ValueError
+            raise error("HTTP Error return: %i fetching %s" % (r.status_code, url))
+        mode = "ab" if r.status_code == 206 else "wb"
+        with partial.open(mode) as op:
+            for block in r.iter_content(1024 * 1024):
+                op.write(block)
+
+
+def _resume_ftp(url: str, partial: Path):
+    import ftplib
+
+    if "ftp_proxy" in os.environ:
+        subprocess.check_call(["wget", "-q", "-c", "-O", str(partial), url])
+        return
+    parsed = urllib.parse.urlparse(url)
+    offset = partial.stat().st_size if partial.exists() else 0
+    try:
+        ftp = _ftp_connect(parsed)
+    except ftplib.error_perm as e:
+        raise _PermanentDownloadError("Error retrieving urls %s: %s" % (url, e))
+    with ftp, partial.open("ab") as op:
+        try:
+            ftp.retrbinary("RETR " + parsed.path, op.write, rest=offset or None)
+        except ftplib.error_perm as e:
+            # servers answer 'REST' beyond the end of file with an error
+            if offset and offset >= (ftp.size(parsed.path) or 0):
+                return
+            raise _PermanentDownloadError("Error retrieving urls %s: %s" % (url, e))
+
+
+def download_to_path(
+    url: str,
+    target: Union[Path, str],
+    checksum: Optional[str] = None,
+    retries: int = 3,
+    backoff: float = 1.0,
+    timeout: float = 60.0,
+) -> Path:
+    """
+    Downloads an url to a file, resuming partial downloads.
+
+    Data is written to '<target>.part' and renamed to target once the
+    download is complete and the checksum matches. If a download fails with
+    a server error (HTTP 5xx), a connection error or a timeout, it is
+    retried with exponential backoff, continuing from the partial file via
+    HTTP Range requests or FTP REST. A partial file with a wrong checksum is
+    discarded before the next attempt. Client errors (HTTP 4xx, permanent
+    FTP errors) fail immediately.
+
+    Parameters
+    ----------
+    url : str
+        HTTP(S) or FTP url.
+    target : Union[Path, str]
+        Output file.
+    checksum : Optional[str], optional
+        Expected checksum as '<algorithm>:<hexdigest>', e.g. 'md5:...', a
+        plain hexdigest is taken as sha256, by default None.
+    retries : int, optional
+        Number of retries after the first attempt, by default 3.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled for every further
+        retry, by default 1.0.
+    timeout : float, optional
+        Timeout for HTTP requests in seconds, by default 60.
+
+    Returns
+    -------
+    Path
+        The target path.
+
+    Raises
+    ------
+    ValueError
+        If the download fails with a client error or still fails after all
+        retries.
+    """
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(target.name + ".part")
+    for attempt in range(retries + 1):
+        try:
+            if url.startswith("ftp"):
+                _resume_ftp(url, partial)
+            else:
+                _resume_http(url, partial, timeout)
+            try:
+                _verify_checksum(partial, checksum)
+            except ValueError:
+                partial.unlink()
+                raise
+            os.replace(partial, target)
+            return target
+        except Exception as e:
+            if attempt == retries or not _is_transient(e):
+                raise ValueError("Could not download %s, exception: %s" % (repr(url), e))
+            time.sleep(backoff * 2 ** attempt)
+    return target  # pragma: no cover
+
+
+def download_files(
+    downloads: Union[Dict[str, Union[Path, str]], List[Tuple[str, Union[Path, str]]]],
+    checksums: Optional[Dict[str, str]] = None,
+    max_workers: int = 4,
+    **kwargs,
+) -> List[Path]:
+    """
+    Downloads a batch of urls concurrently.
+
+    Each url is fetched by download_to_path in a thread pool, so partial
+    downloads are resumed and failed downloads are retried. The same url may
+    be downloaded to several targets.
+
+    Parameters
+    ----------
+    downloads : Union[Dict[str, Union[Path, str]], List[Tuple[str, Union[Path, str]]]]
+        Mapping (or list of pairs) of url to target file.
+    checksums : Optional[Dict[str, str]], optional
+        Expected checksums by url, see download_to_path, by default None.
+    max_workers : int, optional
+        Number of concurrent downloads, by default 4.
+    **kwargs
+        Further arguments to download_to_path (retries, backoff, timeout).
+
+    Returns
+    -------
+    List[Path]
+        The downloaded files, in the order of downloads.
+
+    Raises
+    ------
+    ValueError
+        If any download failed, after all other downloads have finished.
+    """
+    if isinstance(downloads, dict):
+        downloads = list(downloads.items())
+    checksums = checksums or {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_to_path, url, target, checksums.get(url), **kwargs)
+            for url, target in downloads
+        ]
+    result, errors = [], []
+    for future in futures:
+        try:
+            result.append(future.result())
+        except ValueError as e:
+            errors.append(str(e))
+    if errors:
+        raise ValueError("\n".join(errors))
+    return result
+
+
+def _write_atomic(filename: Path, data: bytes):
+    fd, tmp = tempfile.mkstemp(dir=filename.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as op:
+            op.write(data)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def remote_validators(url: str, timeout: float = 10.0) -> Tuple[str, str]:
+    """
+    Returns the (ETag, Last-Modified) validators of a remote file.
+
+    For FTP urls, the ETag is empty and the modification time is taken from
+    MDTM. Missing validators are returned as empty strings, as are both
+    validators if the server rejects HEAD requests or MDTM.
+
+    Raises
+    ------
+    ValueError
+        If the server cannot be reached or answers with a server error.
     """
-    Flattens a nested list
+    if url.startswith("ftp"):
+        import ftplib
+
+        parsed = urllib.parse.urlparse(url)
+        with _ftp_connect(parsed) as ftp:
+            try:
+                return "", ftp.sendcmd("MDTM " + parsed.path).split()[-1]
+            except ftplib.error_perm:
+                return "", ""
+    import requests
+
+    r = requests.head(url, allow_redirects=True, timeout=timeout)
+    if 400 <= r.status_code < 500 or r.status_code == 501:
+        # HEAD not supported (or refused), a GET may still work
+        return "", ""
+    if r.status_code != 200:
+        raise ValueError("HTTP Error return: %i fetching %s" % (r.status_code, url))
+    return r.headers.get("ETag", ""), r.headers.get("Last-Modified", "")
+
+
+def default_cache_dir() -> Path:
+    """Returns the user cache directory, $MUTILITY_CACHE or ~/.cache/mutility."""
+    return Path(os.environ.get("MUTILITY_CACHE", Path.home() / ".cache" / "mutility"))
+
+
+class DownloadCache:
     """
-    if not hasattr(list_of_lists, "__iter__"):
-        return [list_of_lists]
-    flat = []
-    while len(list_of_lists) != 0:
-        item = list_of_lists.pop(0)
-        if hasattr(item, "__iter__"):
-            flat.extend(item)
+    Content-addressed local cache for downloaded files.
+
+    Files are stored under blobs/ with a name derived from the url and the
+    remote ETag/Last-Modified validators, so a changed remote file gets a
+    new entry. Per url, an index entry in index/ records the current blob
+    and when it was last validated. Within max_age seconds of the last
+    validation, hits are served from an in-process table or the index
+    without any network access (blob modification times track usage for
+    eviction); after that, the validators are compared
+    with a HEAD request (or MDTM for FTP). If the remote cannot be reached,
+    the cached file is returned. If the remote provides no validators (e.g.
+    HEAD is rejected), the file is downloaded again after max_age and stored
+    under a name derived from its content hash instead.
+
+    Downloads are serialized per url with file locks, so concurrent
+    processes share a single download, and blobs are written atomically.
+    With max_size set, the least recently used blobs are evicted after each
+    download until the cache fits; eviction holds a cache-wide lock and
+    never removes the blob that is being returned. On platforms without
+    fcntl, locking is skipped and concurrent processes may download the
+    same file twice.
+
+    Parameters
+    ----------
+    cache_dir : Optional[Path], optional
+        Cache directory, by default $MUTILITY_CACHE or ~/.cache/mutility.
+    max_size : Optional[int], optional
+        Maximum cache size in bytes, by default unlimited.
+    max_age : float, optional
+        Seconds after which cached files are revalidated, by default one day.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        max_size: Optional[int] = None,
+        max_age: float = 86400.0,
+    ):
+        self.cache_dir = default_cache_dir() if cache_dir is None else Path(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        for sub in ("blobs", "index", "locks"):
+            (self.cache_dir / sub).mkdir(parents=True, exist_ok=True)
+        self._hits: Dict[str, Tuple[Path, float]] = {}
+
+    @staticmethod
+    def _digest(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _index_file(self, url: str) -> Path:
+        return self.cache_dir / "index" / (self._digest(url) + ".json")
+
+    def _read_index(self, url: str) -> Optional[Dict]:
+        try:
+            entry = json.loads(self._index_file(url).read_text())
+        except (OSError, ValueError):
+            return None
+        if not (self.cache_dir / "blobs" / entry["blob"]).exists():
+            return None
+        return entry
+
+    @contextmanager
+    def _lock(self, name: str):
+        try:
+            import fcntl
+        except ImportError:  # not POSIX, run without inter-process locking
+            yield
+            return
+        with (self.cache_dir / "locks" / (name + ".lock")).open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _touch(path: Path) -> bool:
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # evicted by another process meanwhile
+            return False
+        return True
+
+    def _fresh(self, url: str, now: float) -> Optional[Path]:
+        if url in self._hits:
+            path, validated = self._hits[url]
+            if now - validated < self.max_age and path.exists():
+                return path
+        entry = self._read_index(url)
+        if entry is not None and now - entry["validated"] < self.max_age:
+            path = self.cache_dir / "blobs" / entry["blob"]
+            if self._touch(path):
+                self._hits[url] = (path, entry["validated"])
+                return path
+        return None
+
+    def get(self, url: str, checksum: Optional[str] = None, **kwargs) -> Path:
+        """
+        Returns the path of the cached file for url, downloading it if needed.
+
+        Parameters
+        ----------
+        url : str
+            HTTP(S) or FTP url.
+        checksum : Optional[str], optional
+            Expected checksum of new downloads, see download_to_path.
+        **kwargs
+            Further arguments to download_to_path.
+
+        Returns
+        -------
+        Path
+            Path of the cached file. Do not modify the file.
+        """
+        now = time.time()
+        path = self._fresh(url, now)
+        if path is not None:
+            instrumentation.count("cache_hits", cache="download")
+            return path
+        with self._lock(self._digest(url)):
+            # another process may have downloaded the file while we waited
+            path = self._fresh(url, time.time())
+            if path is not None:
+                instrumentation.count("cache_hits", cache="download")
+                return path
+            entry = self._read_index(url)
+            try:
+                etag, last_modified = remote_validators(url)
+            except Exception:
+                if entry is not None:
+                    return self.cache_dir / "blobs" / entry["blob"]
+                # nothing cached, the download itself may still succeed
+                etag, last_modified = "", ""
+            if etag or last_modified:
+                blob = self._digest(url, etag, last_modified)
+                path = self.cache_dir / "blobs" / blob
+                if path.exists():
+                    instrumentation.count("cache_hits", cache="download")
+                else:
+                    instrumentation.count("cache_misses", cache="download")
+                    with instrumentation.stage("util.download"):
+                        download_to_path(url, path, checksum, **kwargs)
+            else:
+                try:
+                    path = self._download_by_content(url, checksum, **kwargs)
+                except ValueError:
+                    if entry is None:
+                        raise
+                    return self.cache_dir / "blobs" / entry["blob"]
+                blob = path.name
+            entry = {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "blob": blob,
+                "validated": time.time(),
+            }
+            _write_atomic(self._index_file(url), json.dumps(entry).encode())
+            self._touch(path)
+            self._hits[url] = (path, entry["validated"])
+        if self.max_size is not None:
+            self.evict(self.max_size, keep=[path])
+        return path
+
+    def _download_by_content(self, url: str, checksum: Optional[str], **kwargs) -> Path:
+        """Downloads url without validators, the blob name is taken from the content."""
+        instrumentation.count("cache_misses", cache="download")
+        download = self.cache_dir / "blobs" / (self._digest(url) + ".tmp")
+        with instrumentation.stage("util.download"):
+            download_to_path(url, download, checksum, **kwargs)
+        path = self.cache_dir / "blobs" / self._digest(url, "sha256:" + file_checksum(download))
+        os.replace(download, path)
+        return path
+
+    def open(self, url: str, **kwargs) -> BinaryIO:
+        """Returns the cached file for url opened in binary mode."""
+        return self.get(url, **kwargs).open("rb")
+
+    def evict(self, max_size: int, keep: Iterable[Path] = ()):
+        """
+        Removes the least recently used blobs until the cache is at most
+        max_size bytes. Partial downloads and the blobs in keep are never
+        removed, so the cache may stay above max_size.
+        """
+        keep = {Path(path).name for path in keep}
+        with self._lock("evict"):
+            blobs = []
+            for path in (self.cache_dir / "blobs").iterdir():
+                if path.suffix in (".part", ".tmp") or not path.is_file():
+                    continue
+                try:
+                    blobs.append((path.stat(), path))
+                except FileNotFoundError:
+                    continue
+            blobs.sort(key=lambda x: x[0].st_mtime)
+            total = sum(stat.st_size for stat, _ in blobs)
+            for stat, path in blobs:
+                if total <= max_size:
+                    break
+                if path.name in keep:
+                    continue
+                path.unlink(missing_ok=True)
+                total -= stat.st_size
+        for url, (path, _) in list(self._hits.items()):
+            if not path.exists():
+                del self._hits[url]
+
+
+_default_cache: Optional[DownloadCache] = None
+
+
+def download_cached(url: str, cache: Optional[DownloadCache] = None, **kwargs) -> Path:
+    """
+    Returns a local path for url from a DownloadCache.
+
+    Parameters
+    ----------
+    url : str
+        HTTP(S) or FTP url.
+    cache : Optional[DownloadCache], optional
+        Cache to use, by default a process-wide DownloadCache in the default
+        cache directory.
+
+    Returns
+    -------
+    Path
+        Path of the cached file.
+    """
+    global _default_cache
+    if cache is None:
+        if _default_cache is None:
+            _default_cache = DownloadCache()
+        cache = _default_cache
+    return cache.get(url, **kwargs)
+
+
+def _is_leaf(item, atomic_types: Tuple[type, ...]) -> bool:
+    # single characters iterate to themselves and are always leaves
+    return (
+        isinstance(item, atomic_types)
+        or not hasattr(item, "__iter__")
+        or (isinstance(item, str) and len(item) <= 1)
+    )
+
+
+def iterate_flat(
+    nested: Iterable, atomic_types: Tuple[type, ...] = (str, bytes)
+) -> Iterator:
+    """
+    Lazily yields the leaves of an arbitrarily nested iterable.
+
+    Nesting is resolved with an explicit stack of iterators instead of
+    recursion, so the depth is not limited by the recursion limit, and the
+    input is never modified. Instances of atomic_types are yielded as a whole
+    instead of being iterated. NumPy arrays with a non-object dtype are
+    yielded element-wise via ravel without further type checks.
+
+    Parameters
+    ----------
+    nested : Iterable
+        Nested iterable, a non-iterable is yielded as the only leaf.
+    atomic_types : Tuple[type, ...], optional
+        Iterable types that are treated as leaves, by default (str, bytes).
+
+    Yields
+    ------
+    Iterator
+        The leaves in depth-first order.
+    """
+    if _is_leaf(nested, atomic_types):
+        yield nested
+        return
+    stack = [iter(nested)]
+    while stack:
+        for item in stack[-1]:
+            if _is_leaf(item, atomic_types):
+                yield item
+            elif isinstance(item, np.ndarray) and item.dtype != object:
+                yield from item.ravel()
+            else:
+                stack.append(iter(item))
+                break
         else:
-            flat.append(item)
-    return flat
+            stack.pop()
+
+
+def flatten(list_of_lists: Iterable, atomic_types: Tuple[type, ...] = (str, bytes)) -> List:
+    """
+    Flattens a nested list of arbitrary depth into a new list.
+
+    See iterate_flat for a lazy version and the handling of atomic types.
+    """
+    return list(iterate_flat(list_of_lists, atomic_types))
+
+
+class SpaceSavingCounter:
+    """
+    Counts the most frequent items of a stream in bounded memory.
+
+    Implements the Space-Saving algorithm: at most capacity items are
+    tracked. An untracked item arriving at a full counter replaces the item
+    with the smallest count and inherits that count. Counts are therefore
+    upper bounds, overestimating by at most errors[item] <= n / capacity
+    after n additions, and every item occurring more than n / capacity times
+    is tracked. While at most capacity distinct items were added, all counts
+    are exact.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of tracked items.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("SpaceSavingCounter needs a capacity of at least 1")
+        self.capacity = capacity
+        self.counts: Dict[Hashable, int] = {}
+        self.errors: Dict[Hashable, int] = {}
+        # one (count, order, item) entry per tracked item, counts may be stale
+        self._heap: List[Tuple[int, int, Hashable]] = []
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.counts
+
+    def __getitem__(self, item: Hashable) -> int:
+        return self.counts.get(item, 0)
+
+    def add(self, item: Hashable, count: int = 1) -> Optional[Hashable]:
+        """
+        Adds count occurrences of item.
+
+        Returns
+        -------
+        Optional[Hashable]
+            The item that was evicted to make room for item, or None.
+        """
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+            return None
+        evicted, floor = None, 0
+        if len(counts) >= self.capacity:
+            heap = self._heap
+            while True:
+                floor, order, evicted = heap[0]
+                current = counts[evicted]
+                if current == floor:
+                    break
+                heapq.heapreplace(heap, (current, order, evicted))
+            heapq.heappop(heap)
+            del counts[evicted]
+            self.errors.pop(evicted, None)
+            self.errors[item] = floor
+        counts[item] = floor + count
+        heapq.heappush(self._heap, (floor + count, next(self._order), item))
+        return evicted
+
+    def most_common(self, n: Optional[int] = None) -> List[Tuple[Hashable, int]]:
+        """Returns the n items with the highest counts, like Counter.most_common."""
+        ordered = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+        return ordered if n is None else ordered[:n]
+
+
+def hamming(str1: str, str2: str) -> int:
+    """
+    Returns the number of mismatches between two sequences of equal length.
+    """
+    if len(str1) != len(str2):
+        raise ValueError("hamming needs sequences of equal length")
+    return sum(a != b for a, b in zip(str1, str2))
 
 
-def hamming(str1, str2):
-    return hamming(list(str1), list(str2)) * len(str1)
+def encode_sequences(sequences: Iterable[str], length: Optional[int] = None) -> np.ndarray:
+    """
+    Encodes sequences as a uint8 matrix with one row per sequence.
+
+    Sequences shorter than length are padded with zeros, longer ones are
+    truncated. Padded positions therefore count as mismatches against real
+    bases, so the distance of sequences of different length includes the
+    length difference.
+
+    Parameters
+    ----------
+    sequences : Iterable[str]
+        ASCII sequences to encode.
+    length : Optional[int], optional
+        Number of columns, by default the length of the longest sequence.
+
+    Returns
+    -------
+    np.ndarray
+        Matrix of shape (number of sequences, length).
+    """
+    sequences = list(sequences)
+    if length is None:
+        length = max((len(s) for s in sequences), default=0)
+    buffer = "".join([s[:length].ljust(length, "\0") for s in sequences]).encode("ascii")
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(len(sequences), length)
+
+
+def _as_matrix(sequences, length: Optional[int] = None) -> np.ndarray:
+    if isinstance(sequences, np.ndarray):
+        return sequences
+    return encode_sequences(sequences, length)
+
+
+def _encode_pair(a: Sequence, b: Optional[Sequence]) -> Tuple[np.ndarray, np.ndarray]:
+    length = None
+    if b is not None and not isinstance(a, np.ndarray) and not isinstance(b, np.ndarray):
+        length = max(max((len(s) for s in a), default=0), max((len(s) for s in b), default=0))
+    matrix_a = _as_matrix(a, length)
+    matrix_b = matrix_a if b is None else _as_matrix(b, matrix_a.shape[1])
+    if matrix_a.shape[1] != matrix_b.shape[1]:
+        raise ValueError("Encoded sequences must have the same number of columns.")
+    words_a = pack_words(matrix_a)
+    return words_a, words_a if b is None else pack_words(matrix_b)
+
+
+def pack_words(matrix: np.ndarray) -> np.ndarray:
+    """
+    Packs encoded sequences into uint64 words, 8 bases per word.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        uint8 matrix with one sequence per row, e.g. from encode_sequences.
+        The columns are zero padded to a multiple of 8.
+
+    Returns
+    -------
+    np.ndarray
+        uint64 matrix with one row of ceil(length / 8) words per sequence,
+        to be compared with word_mismatches.
+    """
+    padding = -matrix.shape[1] % 8
+    if padding:
+        matrix = np.pad(matrix, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(matrix).view(np.uint64)
+
+
+def word_mismatches(words_a: np.ndarray, words_b: np.ndarray) -> np.ndarray:
+    """
+    Counts mismatching bytes between uint64 words, summed over the last axis.
+
+    Each differing byte is reduced to its lowest bit and the bits are summed
+    by a multiplication that accumulates all bytes into the highest one.
+
+    Parameters
+    ----------
+    words_a : np.ndarray
+        Words from pack_words.
+    words_b : np.ndarray
+        Words from pack_words, broadcastable against words_a.
+
+    Returns
+    -------
+    np.ndarray
+        Number of mismatching bases (bytes), int64, with the last axis
+        removed.
+    """
+    x = words_a ^ words_b
+    x |= x >> np.uint64(4)
+    x |= x >> np.uint64(2)
+    x |= x >> np.uint64(1)
+    x &= np.uint64(0x0101010101010101)
+    x *= np.uint64(0x0101010101010101)
+    return (x >> np.uint64(56)).sum(axis=-1, dtype=np.int64)
+
+
+def _distance_dtype(length: int):
+    return np.uint8 if length < 256 else np.uint16 if length < 65536 else np.uint32
+
+
+def hamming_matrix(
+    a: Sequence, b: Optional[Sequence] = None, block_size: int = 256
+) -> np.ndarray:
+    """
+    Computes all pairwise hamming distances between two sets of sequences.
+
+    Sequences are compared eight bases at a time as packed uint64 words, in
+    blocks of block_size x block_size sequences, so temporary memory is
+    bounded by block_size² x length bytes regardless of the number of
+    sequences.
+
+    Parameters
+    ----------
+    a : Sequence
+        Sequences or a matrix from encode_sequences.
+    b : Optional[Sequence], optional
+        Second set of sequences, by default a.
+    block_size : int, optional
+        Number of sequences per block, by default 256.
+
+    Returns
+    -------
+    np.ndarray
+        Distance matrix of shape (len(a), len(b)).
+    """
+    words_a, words_b = _encode_pair(a, b)
+    result = np.empty((len(words_a), len(words_b)), dtype=_distance_dtype(8 * words_a.shape[1]))
+    for i in range(0, len(words_a), block_size):
+        block_a = words_a[i : i + block_size, None, :]
+        for j in range(0, len(words_b), block_size):
+            block_b = words_b[None, j : j + block_size, :]
+            result[i : i + block_size, j : j + block_size] = word_mismatches(block_a, block_b)
+    return result
+
+
+def hamming_neighbours(
+    a: Sequence,
+    b: Optional[Sequence] = None,
+    max_distance: int = 1,
+    block_size: int = 1024,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds all pairs of sequences within max_distance mismatches.
+
+    Blocks of sequences are compared on their first bases only. Pairs
+    that already exceed max_distance are discarded and the remaining bases
+    are compared for the surviving candidate pairs only, with further
+    pruning after each slice. The cost per pair is thus roughly proportional
+    to the number of bases needed to exceed the threshold instead of the
+    sequence length.
+
+    Parameters
+    ----------
+    a : Sequence
+        Sequences or a matrix from encode_sequences.
+    b : Optional[Sequence], optional
+        Second set of sequences. If None, a is compared against itself and
+        each unordered pair is reported once with i < j.
+    max_distance : int, optional
+        Maximum number of mismatches, by default 1.
+    block_size : int, optional
+        Number of sequences per block, by default 1024.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Sparse neighbour list as arrays of indices into a, indices into b
+        and distances.
+    """
+    words_a, words_b = _encode_pair(a, b)
+    words = words_a.shape[1]
+    step = min(words, max(1, (max_distance + 3) // 4))
+    found_i, found_j, found_d = [], [], []
+    for i in range(0, len(words_a), block_size):
+        block_a = words_a[i : i + block_size]
+        start_j = i if b is None else 0
+        for j in range(start_j, len(words_b), block_size):
+            block_b = words_b[j : j + block_size]
+            distances = word_mismatches(block_a[:, None, :step], block_b[None, :, :step])
+            if b is None and i == j:
+                distances[np.tril_indices(len(block_a), 0, len(block_b))] = max_distance + 1
+            ii, jj = np.nonzero(distances <= max_distance)
+            dd = distances[ii, jj]
+            for offset in range(step, words, step):
+                if len(ii) == 0:
+                    break
+                dd = dd + word_mismatches(
+                    block_a[ii, offset : offset + step], block_b[jj, offset : offset + step]
+                )
+                keep = dd <= max_distance
+                ii, jj, dd = ii[keep], jj[keep], dd[keep]
+            found_i.append(ii + i)
+            found_j.append(jj + j)
+            found_d.append(dd)
+    if not found_i:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_d)
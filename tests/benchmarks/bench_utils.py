@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Settings and helpers shared by the benchmark modules."""
+import os
+import tracemalloc
+from typing import Callable, Tuple
+
+SCALE = float(os.environ.get("MUTILITY_BENCHMARK_SCALE", "1"))
+READS = int(5000 * SCALE)
+VARIANTS = int(500 * SCALE)
+# peak memory ceilings per benchmark in MB at scale 1, scaled linearly
+MEMORY_LIMITS_MB = {
+    "codon_comparison": 16,
+    "extract_codon_from_sequence": 32,
+    "annotate_from_effect_table": 64,
+    "count_most_common_sequences": 32,
+    "read_fastq_iterator": 4,
+}
+
+
+def measure_peak_memory(func: Callable, *args, **kwargs) -> Tuple[object, float]:
+    """Runs func once and returns its result and the peak traced memory in MB."""
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak / 1024 ** 2
+
+
+def add_throughput(benchmark, items: int, unit: str = "items"):
+    benchmark.extra_info[f"{unit}_per_second"] = round(items / benchmark.stats.stats.mean)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures for the benchmark suite.
+
+The benchmarks use pytest-benchmark with small data sets. They carry the
+"benchmark" marker and are deselected in the default test run; select them
+with -m benchmark. Set MUTILITY_BENCHMARK_SCALE to scale up the data sizes
+for meaningful measurements.
+
+Timing regressions are checked against an earlier run on the same machine,
+at 10x scale and with at least 10 rounds per benchmark so that the medians
+are stable. Save a run of the reference version, then compare the working
+tree against it; the comparison fails if a median grew by more than 50%:
+
+    tox -e benchmark
+    tox -e benchmark-compare
+
+Peak memory is measured with tracemalloc and checked against the ceilings
+in MEMORY_LIMITS_MB, which fail the test directly.
+"""
+import pytest
+from pathlib import Path
+from typing import Callable
+from bench_utils import MEMORY_LIMITS_MB, READS, SCALE, VARIANTS, measure_peak_memory
+from generators import variant_table, write_fastq
+
+
+@pytest.fixture
+def check_memory(benchmark):
+    def __check(name: str, func: Callable, *args, **kwargs):
+        _, peak = measure_peak_memory(func, *args, **kwargs)
+        limit = MEMORY_LIMITS_MB[name] * max(SCALE, 1)
+        benchmark.extra_info["peak_memory_mb"] = round(peak, 2)
+        assert peak <= limit, f"{name} used {peak:.1f} MB, limit is {limit:.1f} MB"
+
+    return __check
+
+
+@pytest.fixture(scope="session")
+def reference() -> Path:
+    return Path(__file__).parent.parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+
+
+@pytest.fixture(scope="session")
+def variants(reference):
+    return variant_table(reference, rows=VARIANTS)
+
+
+@pytest.fixture(scope="session")
+def fastq_files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("fastq")
+    files = {}
+    for paired in (False, True):
+        for compress in (False, True):
+            name = f"reads_{'pe' if paired else 'se'}_{'gz' if compress else 'plain'}"
+            files[(paired, compress)] = write_fastq(
+                directory / name,
+                reads=READS,
+                diversity=max(READS // 10, 1),
+                paired=paired,
+                compress=compress,
+            )
+    return files
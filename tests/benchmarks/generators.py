@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data generators for the benchmark suite.
+
+All generators are seeded, so repeated benchmark runs work on identical data.
+"""
+import gzip
+import random
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from mutility.genomics import get_three_letter_amino_acid_code
+from mutility.mutalizer import CodonComparison, describe_variant, iterate_single_variants
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choices("ACGT", k=length))
+
+
+def write_fastq(
+    path: Path,
+    reads: int = 10000,
+    read_length: int = 150,
+    diversity: int = 1000,
+    paired: bool = False,
+    compress: bool = False,
+    seed: int = 42,
+) -> Tuple[Path, Optional[Path]]:
+    """
+    Writes synthetic (paired) FASTQ files.
+
+    Reads are drawn from a pool of `diversity` distinct sequences with a
+    skewed abundance distribution, similar to an amplicon library.
+
+    Parameters
+    ----------
+    path : Path
+        Output prefix, '_R1.fastq' ('_R2.fastq') and '.gz' are appended.
+    reads : int, optional
+        Number of reads (pairs) to write, by default 10000.
+    read_length : int, optional
+        Length of each read, by default 150.
+    diversity : int, optional
+        Number of distinct sequences (pairs), by default 1000.
+    paired : bool, optional
+        Write a second mate file, by default False.
+    compress : bool, optional
+        Write gzip compressed files, by default False.
+    seed : int, optional
+        Random seed, by default 42.
+
+    Returns
+    -------
+    Tuple[Path, Optional[Path]]
+        Paths of the R1 and R2 files, R2 is None for single-end data.
+    """
+    rng = random.Random(seed)
+    pool = [
+        (random_sequence(rng, read_length), random_sequence(rng, read_length))
+        for _ in range(diversity)
+    ]
+    weights = [1.0 / (rank + 1) for rank in range(diversity)]
+    quality = "I" * read_length
+    suffix = ".fastq.gz" if compress else ".fastq"
+    opener = gzip.open if compress else open
+    paths = [Path(f"{path}_R1{suffix}")]
+    if paired:
+        paths.append(Path(f"{path}_R2{suffix}"))
+    handles = [opener(p, "wt") for p in paths]
+    try:
+        for i, pair in enumerate(rng.choices(pool, weights=weights, k=reads)):
+            for mate, (handle, sequence) in enumerate(zip(handles, pair)):
+                handle.write(f"@read{i} {mate + 1}:N:0:1\n{sequence}\n+\n{quality}\n")
+    finally:
+        for handle in handles:
+            handle.close()
+    return paths[0], paths[1] if paired else None
+
+
+def _hgvs_genomic(ref: str, alt: str, start: int, type_g: str) -> str:
+    position = next((i for i, (a, b) in enumerate(zip(ref, alt)) if a != b), len(alt))
+    if type_g == "sub":
+        subs = [f"{start + i}{a}>{b}" for i, (a, b) in enumerate(zip(ref, alt)) if a != b]
+        if len(subs) == 1:
+            return f"NC_000017.11:g.{subs[0]}"
+        return f"NC_000017.11:g.[{';'.join(subs)}]"
+    if type_g == "del":
+        length = len(ref) - len(alt)
+        if length == 1:
+            return f"NC_000017.11:g.{start + position}del"
+        return f"NC_000017.11:g.{start + position}_{start + position + length - 1}del"
+    if type_g == "ins":
+        return f"NC_000017.11:g.{start + position}_{start + position + 1}ins{alt[position]}"
+    return f"NC_000017.11:g.{start + position}dup"
+
+
+def _hgvs_protein(effect: Tuple, ref: str, alt: str, start: int) -> Tuple[str, str]:
+    _, _, type_g, _, _, type_p, codon, _, _, aa_ref, aa_alt = effect
+    position = next((i for i, (a, b) in enumerate(zip(ref, alt)) if a != b), len(alt))
+    deleted = ref[position : position + len(ref) - len(alt)]
+    prefix = "NC_000017.11(NP_000537.3):p."
+    three_ref = get_three_letter_amino_acid_code(aa_ref) if aa_ref else ""
+    three_alt = get_three_letter_amino_acid_code(aa_alt) if aa_alt not in ("", "X") else ""
+    if type_p == "mis":
+        return f"{prefix}({three_ref}{codon}{three_alt})", f"p.{aa_ref}{codon}{aa_alt}"
+    if type_p == "non":
+        return f"{prefix}({three_ref}{codon}*)", f"p.{aa_ref}{codon}*"
+    if type_p == "fs":
+        return f"{prefix}({three_ref}{codon}{three_alt}fs*10)", ""
+    if type_p == "del":
+        return f"{prefix}({three_ref}{codon}del)", f"g.{start + position}del{deleted}"
+    if type_g == "sub":
+        return f"{prefix}(=)", f"p.{aa_ref}{codon}{aa_alt}"
+    if type_g == "del":
+        return f"{prefix}(=)", f"g.{start + position}del{deleted}"
+    return f"{prefix}(=)", f"g.{start + position}ins1"
+
+
+def variant_table(
+    reference: Path,
+    rows: int = 1000,
+    mix: Optional[Dict[str, float]] = None,
+    seed: int = 42,
+) -> pd.DataFrame:
+    """
+    Returns a synthetic variant table for the exons in reference.
+
+    Each row is a library sequence with a single variant and HGVS style
+    annotations that extract_codon_from_sequence can parse.
+
+    Parameters
+    ----------
+    reference : Path
+        Reference table as used by CodonComparison.
+    rows : int, optional
+        Number of rows, by default 1000.
+    mix : Optional[Dict[str, float]], optional
+        Relative frequencies of 'sub', 'del' and 'ins' variants, by default
+        80% substitutions, 15% deletions and 5% insertions.
+    seed : int, optional
+        Random seed, by default 42.
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame with ID, Sequence, hg38 genomic, hg38 protein and Effect New.
+    """
+    if mix is None:
+        mix = {"sub": 0.8, "del": 0.15, "ins": 0.05}
+    rng = random.Random(seed)
+    comparator = CodonComparison(reference)
+    candidates: Dict[str, List[Tuple]] = {kind: [] for kind in mix}
+    for exon_id, wt in comparator.df_wt_exons.iterrows():
+        coding = wt["Coding"]
+        flank5 = wt["5_contant"] + wt["5_overhang"]
+        flank3 = wt["3_overhang"] + wt["3_contant"]
+        begin, end = wt["beginning_of_truncated_start_codon"], wt["end_of_truncated_end_codon"]
+        for alt in iterate_single_variants(coding):
+            if not (alt.startswith(begin) and alt.endswith(end)):
+                continue
+            effect = describe_variant(coding, alt, int(wt["first_aa_number"]))
+            if effect[5] in ("syn", "delins") and effect[2] != "sub":
+                continue
+            kind = "sub" if effect[2] == "sub" else "del" if effect[2] == "del" else "ins"
+            if kind in candidates:
+                sequence = flank5 + alt[len(begin) : len(alt) - len(end)] + flank3
+                candidates[kind].append((exon_id, sequence, coding, alt, wt["start_index"], effect))
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=rows)
+    to_df: Dict[str, List] = {
+        "ID": [],
+        "Sequence": [],
+        "hg38 genomic": [],
+        "hg38 protein": [],
+        "Effect New": [],
+    }
+    for kind in kinds:
+        exon_id, sequence, coding, alt, start, effect = rng.choice(candidates[kind])
+        protein, effect_new = _hgvs_protein(effect, coding, alt, start)
+        to_df["ID"].append(exon_id)
+        to_df["Sequence"].append(sequence)
+        to_df["hg38 genomic"].append(_hgvs_genomic(coding, alt, start, effect[2]))
+        to_df["hg38 protein"].append(protein)
+        to_df["Effect New"].append(effect_new)
+    return pd.DataFrame(to_df)
@@ -0,0 +1,37 @@
+import gzip
+import pytest
+from bench_utils import READS, add_throughput
+from mutility.fastq import count_most_common_sequences, read_fastq_iterator
+
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.mark.parametrize("paired", [False, True], ids=["single", "paired"])
+@pytest.mark.parametrize("compress", [False, True], ids=["plain", "gzip"])
+def test_bench_count_most_common_sequences(
+    benchmark, check_memory, fastq_files, tmp_path, paired, compress
+):
+    r1, r2 = fastq_files[(paired, compress)]
+    outfile = tmp_path / "counts.tsv"
+    benchmark(count_most_common_sequences, outfile, r1, r2, max=READS)
+    add_throughput(benchmark, READS, "reads")
+    check_memory(
+        "count_most_common_sequences", count_most_common_sequences, outfile, r1, r2, max=READS
+    )
+
+
+def _consume(path):
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rb") as op:
+        for _ in read_fastq_iterator(op):
+            pass
+
+
+@pytest.mark.parametrize("compress", [False, True], ids=["plain", "gzip"])
+def test_bench_read_fastq_iterator(benchmark, check_memory, fastq_files, compress):
+    r1, _ = fastq_files[(False, compress)]
+    benchmark(_consume, r1)
+    add_throughput(benchmark, READS, "reads")
+    check_memory("read_fastq_iterator", _consume, r1)
@@ -0,0 +1,46 @@
+import pytest
+from bench_utils import VARIANTS, add_throughput
+from mutility.mutalizer import (
+    CodonComparison,
+    annotate_from_effect_table,
+    extract_codon_from_sequence,
+    get_codon_comparison,
+)
+
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.benchmark
+
+
+def test_bench_codon_comparison(benchmark, check_memory, reference):
+    benchmark(CodonComparison, reference)
+    check_memory("codon_comparison", CodonComparison, reference)
+
+
+def test_bench_effect_table_cached(benchmark, reference, tmp_path):
+    CodonComparison(reference, cache_dir=tmp_path).effect_table
+    benchmark(lambda: CodonComparison(reference, cache_dir=tmp_path).effect_table)
+
+
+def test_bench_get_codon_comparison(benchmark, reference):
+    get_codon_comparison(reference)
+    benchmark(get_codon_comparison, reference)
+
+
+def test_bench_extract_codon_from_sequence(benchmark, check_memory, reference, variants):
+    comparator = CodonComparison(reference)
+    benchmark(lambda: extract_codon_from_sequence(variants.copy(), comparator))
+    add_throughput(benchmark, VARIANTS, "rows")
+    check_memory(
+        "extract_codon_from_sequence", extract_codon_from_sequence, variants.copy(), comparator
+    )
+
+
+def test_bench_annotate_from_effect_table(benchmark, check_memory, reference, variants):
+    comparator = CodonComparison(reference)
+    comparator.effect_table
+    benchmark(lambda: annotate_from_effect_table(variants.copy(), comparator))
+    add_throughput(benchmark, VARIANTS, "rows")
+    check_memory(
+        "annotate_from_effect_table", annotate_from_effect_table, variants.copy(), comparator
+    )
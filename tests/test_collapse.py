@@ -0,0 +1,57 @@
+import random
+import numpy as np
+import pandas as pd
+from mutility.collapse import assign_parents, collapse_count_file, find_neighbours
+from mutility.util import hamming_neighbours
+
+
+def _count_table(seed=1, parents=100, length=30):
+    rng = random.Random(seed)
+    to_df = {"Seq": [], "Count": [], "Parent": []}
+    for p in range(parents):
+        parent = "".join(rng.choices("ACGT", k=length))
+        to_df["Seq"].append(parent)
+        to_df["Count"].append(rng.randint(100, 1000))
+        to_df["Parent"].append(p)
+        for _ in range(rng.randint(0, 3)):
+            child = list(parent)
+            child[rng.randrange(length)] = "N"
+            to_df["Seq"].append("".join(child))
+            to_df["Count"].append(rng.randint(1, 10))
+            to_df["Parent"].append(p)
+    return pd.DataFrame(to_df).drop_duplicates("Seq")
+
+
+def test_find_neighbours():
+    sequences = _count_table()["Seq"].tolist()
+    for max_distance in (1, 2, 3):
+        i, j, d = find_neighbours(sequences, max_distance)
+        a, b, dd = hamming_neighbours(sequences, max_distance=max_distance)
+        assert set(zip(i.tolist(), j.tolist(), d.tolist())) == set(
+            zip(a.tolist(), b.tolist(), dd.tolist())
+        )
+        # small chunks are verified one by one, with the same result
+        chunked = find_neighbours(sequences, max_distance, chunk_size=7)
+        assert all(np.array_equal(x, y) for x, y in zip(chunked, (i, j, d)))
+
+
+def test_assign_parents():
+    counts = np.array([5, 100, 2, 60])
+    # 0-1, 1-3 and 0-2 are neighbours
+    parents = assign_parents(counts, np.array([0, 1, 0]), np.array([1, 3, 2]))
+    # 3 is too abundant to be collapsed into 1, 2 follows 0 into 1
+    assert parents.tolist() == [1, 1, 1, 3]
+
+
+def test_collapse_count_file(tmp_path):
+    df = _count_table()
+    infile = tmp_path / "counts.tsv"
+    df.to_csv(infile, sep="\t", index=False)
+    outfile = tmp_path / "out" / "collapsed.tsv"
+    collapse_count_file(infile, outfile, max_distance=1)
+    collapsed = pd.read_csv(outfile, sep="\t")
+    expected = df.groupby("Parent")["Count"].sum().sort_values(ascending=False)
+    assert len(collapsed) == len(expected)
+    assert sorted(collapsed["Count"].tolist()) == sorted(expected.tolist())
+    assert collapsed["Count"].is_monotonic_decreasing
+    assert (collapsed["Count"] >= collapsed["Count_Parent"]).all()
@@ -0,0 +1,259 @@
+import collections
+import gzip
+import numpy as np
+import pandas as pd
+import pytest
+from mutility.fastq import (
+    BarcodeMatcher,
+    FastqWriterPool,
+    count_most_common_sequences,
+    count_umi_sequences,
+    demultiplex,
+    get_fastq_iterator,
+    iterate_fraction,
+    merge_read_pairs,
+    reservoir_sample,
+    reverse_complement,
+    subsample_fastq,
+    _KeyCounter,
+)
+
+
+def _write_fastq(path, records):
+    path.write_text("".join(f"@{name}\n{seq}\n+\n{'I' * len(seq)}\n" for name, seq in records))
+    return path
+
+
+def test_barcode_matcher():
+    matcher = BarcodeMatcher({"s1": "ACGTAC", "s2": "TTGGCC", "s3": "ACGTTT"}, max_mismatches=1)
+    assert matcher.match("ACGTAC") == "s1"
+    assert matcher.match("ACGTAG") == "s1"
+    assert matcher.match("TTGGCN") == "s2"
+    # one mismatch from s1 and s3
+    assert matcher.match("ACGTAT") is None
+    assert matcher.match("GGGGGG") is None
+    dual = BarcodeMatcher({"s1": "AAAA+CCCC", "s2": "AAAA+GGGG"}, max_mismatches=1)
+    assert dual.match("AATA+CCCG") == "s1"
+    assert dual.match("AAAA+GGTT") is None
+
+
+def test_writer_pool(tmp_path):
+    files = [tmp_path / f"out{i}.fastq.gz" for i in range(5)]
+    with FastqWriterPool(max_open=2, buffer_size=10) as pool:
+        for i in range(100):
+            pool.write(files[i % 5], f"line{i}\n".encode())
+        assert len(pool.handles) <= 2
+    with gzip.open(files[1], "rt") as op:
+        assert op.read().split() == [f"line{i}" for i in range(1, 100, 5)]
+
+
+def test_demultiplex(tmp_path):
+    r1 = _write_fastq(
+        tmp_path / "r1.fastq",
+        [
+            ("a 1:N:0:ACGTAC+GGAA", "AAAAAAAA"),
+            ("b 1:N:0:ACGTAG+GGAA", "CCCCCCCC"),
+            ("c 1:N:0:TTGGCC+CCTT", "GGGGGGGG"),
+            ("d 1:N:0:GGGGGG+CCTT", "TTTTTTTT"),
+        ],
+    )
+    r2 = _write_fastq(
+        tmp_path / "r2.fastq", [(name, "ACGT") for name in ["a 2", "b 2", "c 2", "d 2"]]
+    )
+    sheet = pd.DataFrame(
+        {"Sample": ["s1", "s2", "s3"], "i7": ["acgtac ", "TTGGCC", "CCCCCC"], "i5": ["GGAA"] * 3}
+    )
+    sheet.loc[1, "i5"] = "CCTT"
+    df = demultiplex(r1, tmp_path / "out", sheet, r2, barcode_columns=["i7", "i5"])
+    assert df.to_dict("list") == {
+        "Sample": ["s1", "s2", "s3", "Undetermined"],
+        "Barcode": ["ACGTAC+GGAA", "TTGGCC+CCTT", "CCCCCC+GGAA", ""],
+        "Reads": [2, 1, 0, 1],
+    }
+    reads = [s for s, _, _ in get_fastq_iterator(tmp_path / "out" / "s1_R1.fastq.gz")]
+    assert reads == ["AAAAAAAA", "CCCCCCCC"]
+    assert len(list(get_fastq_iterator(tmp_path / "out" / "s1_R2.fastq.gz"))) == 2
+    assert list(get_fastq_iterator(tmp_path / "out" / "s3_R1.fastq.gz")) == []
+
+
+def test_demultiplex_sample_names(tmp_path):
+    r1 = _write_fastq(tmp_path / "r1.fastq", [("a 1:N:0:ACGTAC", "AAAA")])
+    sheet = pd.DataFrame({"Sample": ["s1", "s1"], "Barcode": ["ACGTAC", "TTGGCC"]})
+    with pytest.raises(ValueError, match="duplicates"):
+        demultiplex(r1, tmp_path / "out", sheet)
+    with pytest.raises(ValueError, match="reserved"):
+        demultiplex(r1, tmp_path / "out", {"Undetermined": "ACGTAC"})
+
+
+def test_demultiplex_inline(tmp_path):
+    records = [("a", "ACGTTTTT"), ("b", "TGCAGGGG"), ("c", "CCCCAAAA")]
+    r1 = _write_fastq(tmp_path / "r1.fastq", records)
+    df = demultiplex(
+        r1,
+        tmp_path / "out",
+        {"s1": "ACGT", "s2": "TGCA"},
+        barcode_location="inline",
+        max_mismatches=0,
+        compress=False,
+    )
+    assert df["Reads"].tolist() == [1, 1, 1]
+    assert (tmp_path / "out" / "s2_R1.fastq").read_text() == "@b\nGGGG\n+\nIIII\n"
+    assert (tmp_path / "out" / "Undetermined_R1.fastq").read_text() == "@c\nCCCCAAAA\n+\nIIIIIIII\n"
+
+
+def _write_pairs(tmp_path, n):
+    r1 = _write_fastq(tmp_path / "r1.fastq", [(f"r{i}/1", f"A{i}") for i in range(n)])
+    r2 = _write_fastq(tmp_path / "r2.fastq", [(f"r{i}/2 x", f"C{i}") for i in range(n)])
+    return r1, r2
+
+
+def test_reservoir_sample(tmp_path):
+    r1, r2 = _write_pairs(tmp_path, 100)
+    sample = reservoir_sample(r1, 10, r2, seed=1)
+    assert len(sample) == 10
+    indices = [int(pair[0][1][1:]) for pair in sample]
+    assert indices == sorted(indices)
+    assert all(int(pair[1][1][1:]) == i for pair, i in zip(sample, indices))
+    assert sample == reservoir_sample(r1, 10, r2, seed=1)
+    assert len(reservoir_sample(r1, 1000)) == 100
+    # every read is about equally likely to be drawn
+    drawn = collections.Counter()
+    for seed in range(400):
+        drawn.update(record[0][1] for record in reservoir_sample(r1, 10, seed=seed))
+    assert min(drawn.values()) > 15 and max(drawn.values()) < 70
+
+
+def test_fraction_sample(tmp_path):
+    r1, r2 = _write_pairs(tmp_path, 1000)
+    names1 = [record[0].split()[0][:-2] for record in iterate_fraction(r1, 0.2, seed=3)]
+    names2 = [record[0].split()[0][:-2] for record in iterate_fraction(r2, 0.2, seed=3)]
+    assert names1 == names2
+    assert 150 < len(names1) < 250
+    assert names1 != [record[0].split()[0][:-2] for record in iterate_fraction(r1, 0.2, seed=4)]
+    written = subsample_fastq(r1, tmp_path / "s1.fastq.gz", r2, tmp_path / "s2.fastq.gz", n=5)
+    assert written == 5
+    assert len(list(get_fastq_iterator(tmp_path / "s2.fastq.gz"))) == 5
+    # fraction sampling counts pairs, not the reads of the last file
+    written = subsample_fastq(
+        r1, tmp_path / "f1.fastq", r2, tmp_path / "f2.fastq", fraction=0.2, seed=3
+    )
+    assert written == len(names1)
+    assert len(list(get_fastq_iterator(tmp_path / "f1.fastq"))) == len(names1)
+    (tmp_path / "other").mkdir()
+    other, _ = _write_pairs(tmp_path / "other", 500)
+    with pytest.raises(ValueError, match="read names"):
+        subsample_fastq(r1, tmp_path / "f1.fastq", other, tmp_path / "f2.fastq", fraction=0.2)
+    subsample_fastq(r1, tmp_path / "empty.fastq", fraction=0)
+    assert (tmp_path / "empty.fastq").read_text() == ""
+
+
+def test_count_most_common_sequences_sampled(tmp_path):
+    r1, _ = _write_pairs(tmp_path, 100)
+    count_most_common_sequences(tmp_path / "counts.tsv", r1, max=10, sample_seed=0)
+    df = pd.read_csv(tmp_path / "counts.tsv", sep="\t")
+    assert len(df) == 10
+    assert df["Seq"].str[1:].astype(int).max() > 10
+
+
+def test_count_most_common_sequences_top_k(tmp_path):
+    sequences = ["AAAA"] * 5 + ["CCCC"] * 3 + ["GGGG"] * 4 + ["TTTT"]
+    r1 = _write_fastq(tmp_path / "r1.fastq", [(f"r{i}", s) for i, s in enumerate(sequences)])
+    r2 = _write_fastq(tmp_path / "r2.fastq", [(f"r{i}", "ACGT") for i in range(len(sequences))])
+    count_most_common_sequences(tmp_path / "counts.tsv", str(r1), top_k=2)
+    df = pd.read_csv(tmp_path / "counts.tsv", sep="\t")
+    assert df.to_dict("list") == {"Seq": ["AAAA", "GGGG"], "Count": [5, 4], "Example": ["r0", "r8"]}
+    for name, read in [("counts.parquet", pd.read_parquet), ("counts.feather", pd.read_feather)]:
+        count_most_common_sequences(tmp_path / name, r1, r2)
+        df = read(tmp_path / name)
+        assert df["Seq1"].tolist() == ["AAAA", "GGGG", "CCCC", "TTTT"]
+        assert isinstance(df["Seq2"].dtype, pd.CategoricalDtype)
+        assert df["Count"].tolist() == [5, 4, 3, 1]
+        assert list(df["Example"][0]) == ["r0", "r0"]
+
+
+def _pair(fragment, length, name="r"):
+    return (fragment[:length], name, "I" * length), (
+        reverse_complement(fragment)[:length],
+        name,
+        "5" * length,
+    )
+
+
+def test_merge_read_pairs():
+    fragment = "ACGTTGCAAGGCTTACCGATAGCTAGGCTATCGGATCCATGCA"
+    read1, read2 = _pair(fragment, 30)
+    # mismatch in the overlap, read 1 has the higher quality
+    base = "A" if read2[0][20] != "A" else "C"
+    mutated = (read2[0][:20] + base + read2[0][21:], "r", read2[2])
+    unrelated = ("A" * 30, "u", "I" * 30), ("A" * 30, "u", "I" * 30)
+    short1, short2 = _pair(fragment, 28, "s")
+    reads1 = [read1, read1, unrelated[0], short1]
+    reads2 = [read2, mutated, unrelated[1], short2]
+    for hint in (None, 17, 5):
+        merged = merge_read_pairs(reads1, reads2, expected_overlap=hint)
+        assert merged[0] == (fragment, "r", "I" * 13 + "I" * 17 + "5" * 13)
+        assert merged[1][0] == fragment
+        assert merged[1][2][22] == chr(33 + 40 - 20)
+        assert merged[2] is None
+        assert merged[3][0] == fragment
+    assert merge_read_pairs(reads1, reads2, min_overlap=20)[0] is None
+
+
+def test_count_most_common_sequences_merged(tmp_path):
+    fragments = [
+        "ACGTTGCAAGGCTTACCGATAGCTAGGCTATCGGATCCATGCA",
+        "TTGACCAGTAGGCATCGACTAGGCAATCGAGGTACCA",
+    ]
+    pairs = [_pair(fragments[i % 3 == 0], 30, f"r{i}") for i in range(9)]
+    r1 = _write_fastq(tmp_path / "r1.fastq", [(read1[1], read1[0]) for read1, _ in pairs])
+    r2 = _write_fastq(tmp_path / "r2.fastq", [(read2[1], read2[0]) for _, read2 in pairs])
+    count_most_common_sequences(tmp_path / "counts.tsv", r1, r2, merge_pairs=True)
+    df = pd.read_csv(tmp_path / "counts.tsv", sep="\t")
+    assert df.to_dict("list") == {"Seq": fragments, "Count": [6, 3], "Example": ["r1", "r0"]}
+
+
+def test_count_umi_sequences(tmp_path):
+    reads = (
+        ["AAAA" + "ACGTACGT"] * 5
+        + ["AAAT" + "ACGTACGT", "CCCC" + "ACGTACGT", "CCCC" + "ACGTACGT"]
+        + ["GGGG" + "TTTT", "GGGA" + "TTTT", "NGGG" + "TTTT"]
+    )
+    r1 = _write_fastq(tmp_path / "r1.fastq", [(f"r{i}", s) for i, s in enumerate(reads)])
+    df = count_umi_sequences(tmp_path / "umis.tsv", r1, umi_pattern="NNNN")
+    assert df.to_dict("list") == {
+        "Seq": ["ACGTACGT", "TTTT"],
+        "Reads": [8, 2],
+        "UMIs": [3, 2],
+        "Molecules": [2, 1],
+    }
+    assert pd.read_csv(tmp_path / "umis.tsv", sep="\t").equals(df)
+    # keys counted in many small batches give the same table
+    batched = count_umi_sequences(tmp_path / "umis.tsv", r1, umi_pattern="NNNN", batch_size=2)
+    assert batched.equals(df)
+    df = count_umi_sequences(tmp_path / "umis.tsv", r1, umi_pattern="NNXN", collapse=False)
+    assert df["Seq"].tolist() == ["AACGTACGT", "GTTTT", "CACGTACGT"]
+    assert df["Reads"].tolist() == [6, 2, 2]
+    assert df["Molecules"].tolist() == df["UMIs"].tolist() == [2, 2, 1]
+
+
+def test_key_counter():
+    rng = np.random.default_rng(5)
+    counter = _KeyCounter()
+    expected = collections.Counter()
+    for size in [50, 10, 10, 200, 3, 3, 3, 1000, 7]:
+        keys = rng.integers(0, 300, size).astype(np.uint64)
+        counter.add(keys)
+        expected.update(keys.tolist())
+    keys, counts = counter.result()
+    assert dict(zip(keys.tolist(), counts.tolist())) == dict(expected)
+    assert (np.diff(keys.astype(np.int64)) > 0).all()
+
+
+def test_count_umi_sequences_header(tmp_path):
+    names = ["a:ACGT 1:N", "b:ACGT 1:N", "c:ACGA 1:N", "d:TTTT 1:N"]
+    r1 = _write_fastq(tmp_path / "r1.fastq", [(name, "GGCC") for name in names])
+    r2 = _write_fastq(tmp_path / "r2.fastq", [(name, "AATT") for name in names])
+    df = count_umi_sequences(tmp_path / "umis.parquet", r1, r2, umi_header=True)
+    assert df[["Seq1", "Seq2", "Reads", "UMIs", "Molecules"]].values.tolist() == [
+        ["GGCC", "AATT", 4, 3, 2]
+    ]
@@ -0,0 +1,94 @@
+import pandas as pd
+from mutility.frames import read_excel_from_biologists, read_excel_workbooks, trim_dna_strings
+
+
+def _write_sample_sheet(path):
+    df = pd.DataFrame(
+        {
+            "Sample": ["S1", None, "S2", None],
+            "Barcode": [" acgt ", "ggcc", "  ", "TtAa"],
+            "Primer": ["p1", "p2", "p3", "p4"],
+        }
+    )
+    df.to_excel(path, index=False)
+
+
+def test_read_excel_from_biologists(tmp_path):
+    infile = tmp_path / "samples.xlsx"
+    _write_sample_sheet(infile)
+    df = read_excel_from_biologists(
+        infile,
+        trim_columns=["Barcode"],
+        merge_columns=["Sample"],
+        combine_columns={"Name": ["Sample", "Primer"]},
+    )
+    # the previous converter based implementation
+    expected = pd.read_excel(infile, converters={"Barcode": trim_dna_strings})
+    assert df["Barcode"].tolist()[:2] == expected["Barcode"].tolist()[:2] == ["ACGT", "GGCC"]
+    assert df["Barcode"].isna().tolist() == expected["Barcode"].isna().tolist()
+    assert df["Sample"].tolist() == ["S1", "S1", "S2", "S2"]
+    assert df["Name"].tolist() == ["S1_p1", "S1_p2", "S2_p3", "S2_p4"]
+
+
+def test_read_excel_trim_numeric_column(tmp_path):
+    infile = tmp_path / "numbers.xlsx"
+    pd.DataFrame({"Index": [12345, None, 7], "Barcode": [" acgt", "gg", None]}).to_excel(
+        infile, index=False
+    )
+    df = read_excel_from_biologists(infile, trim_columns=["Index", "Barcode"])
+    assert df["Index"].tolist()[::2] == ["12345", "7"]
+    assert df["Index"].isna().tolist() == [False, True, False]
+    df = read_excel_workbooks([infile], trim_columns=["Index"])
+    assert df["Index"].tolist()[::2] == ["12345", "7"]
+
+
+def test_read_excel_from_biologists_cache(tmp_path, monkeypatch):
+    infile = tmp_path / "samples.xlsx"
+    _write_sample_sheet(infile)
+    cache_dir = tmp_path / "cache"
+    df = read_excel_from_biologists(infile, merge_columns=["Sample"], cache_dir=cache_dir)
+    assert len(list(cache_dir.glob("*.parquet"))) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("workbook parsed again")
+
+    monkeypatch.setattr(pd, "read_excel", fail)
+    cached = read_excel_from_biologists(infile, merge_columns=["Sample"], cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(cached, df)
+    monkeypatch.undo()
+    # other arguments use another cache entry
+    read_excel_from_biologists(infile, trim_columns=["Barcode"], cache_dir=cache_dir)
+    assert len(list(cache_dir.glob("*.parquet"))) == 2
+    # several sheets are cleaned up per sheet but not cached
+    for sheet_name in (None, [0]):
+        sheets = read_excel_from_biologists(
+            infile, sheet_name=sheet_name, trim_columns=["Barcode"], cache_dir=cache_dir
+        )
+        (sheet,) = sheets.values()
+        assert sheet["Barcode"].tolist()[:2] == ["ACGT", "GGCC"]
+    assert len(list(cache_dir.glob("*.parquet"))) == 2
+
+
+def test_read_excel_workbooks(tmp_path):
+    infiles = []
+    for i in range(3):
+        infile = tmp_path / f"plate{i}.xlsx"
+        with pd.ExcelWriter(infile) as writer:
+            for sheet in ("first", "second"):
+                df = pd.DataFrame(
+                    {"Sample": [f"{sheet}{i}", None], "Barcode": [" acgt", "ttgg "]}
+                )
+                df.to_excel(writer, sheet_name=sheet, index=False)
+        infiles.append(infile)
+    df = read_excel_workbooks(
+        infiles, sheet_name=None, trim_columns=["Barcode"], merge_columns=["Sample"]
+    )
+    assert len(df) == 12
+    assert df["Barcode"].tolist() == ["ACGT", "TTGG"] * 6
+    assert df["Sample"].tolist()[:4] == ["first0", "first0", "second0", "second0"]
+    assert df["source_sheet"].tolist()[:4] == ["first", "first", "second", "second"]
+    assert df["source_file"].unique().tolist() == [str(infile) for infile in infiles]
+    df = read_excel_workbooks(infiles, sheet_name=1, max_workers=1)
+    assert df["source_sheet"].unique().tolist() == ["second"]
+    single = read_excel_from_biologists(infiles[0], sheet_name=1)
+    assert df.iloc[:2, :2].equals(single)
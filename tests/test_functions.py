@@ -0,0 +1,68 @@
+import gc
+import weakref
+import numpy as np
+import pandas as pd
+from mutility.functions import filter_function
+
+
+def _genes(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "chr": pd.Categorical(rng.choice(["1", "2", "X", "MT", "GL000009.2"], n)),
+            "biotype": rng.choice(["protein_coding", "lncRNA", "miRNA"], n),
+            "a": rng.exponential(5, n),
+            "b": rng.exponential(5, n),
+        }
+    )
+
+
+def _reference_filter(df, column_names, threshold, canonical_chromosomes, biotypes):
+    keep = np.zeros(len(df), dtype=bool)
+    for column_name in column_names:
+        keep = keep | (df[column_name] >= threshold)
+    keep = keep & np.array([x in canonical_chromosomes for x in df["chr"].values])
+    if biotypes is not None:
+        keep = keep & np.array([x in biotypes for x in df["biotype"].values])
+    return keep
+
+
+def test_filter_function():
+    df = _genes()
+    chromosomes = ["1", "2", "X"]
+    for biotypes in (None, ["protein_coding", "lncRNA"]):
+        for cache in (False, True):
+            func = filter_function(["a", "b"], 8, chromosomes, biotypes, cache_static_mask=cache)
+            for _ in range(2):
+                keep = func(df)
+                expected = _reference_filter(df, ["a", "b"], 8, chromosomes, biotypes)
+                assert keep.tolist() == list(expected)
+
+
+def test_filter_function_static_mask_cache(monkeypatch):
+    isin_calls = []
+    isin = pd.Series.isin
+
+    def counting_isin(self, values):
+        isin_calls.append(self.name)
+        return isin(self, values)
+
+    monkeypatch.setattr(pd.Series, "isin", counting_isin)
+    df = _genes()
+    func = filter_function(["a"], 0, ["1"], cache_static_mask=True)
+    first = func(df)
+    # the static mask is reused for the same DataFrame, but not for others
+    df_other = df.copy()
+    df_other["chr"] = "1"
+    assert func(df_other).all()
+    assert func(df).equals(first)
+    assert len(isin_calls) == 2
+    # dropping rows in place replaces the index and invalidates the mask
+    df.drop(index=df.index[:2], inplace=True)
+    assert func(df).tolist() == first.tolist()[2:]
+    assert len(isin_calls) == 3
+    # the cache does not keep DataFrames alive
+    ref = weakref.ref(df)
+    del df
+    gc.collect()
+    assert ref() is None
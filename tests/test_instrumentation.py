@@ -0,0 +1,51 @@
+import json
+import pytest
+from mutility import instrumentation
+from mutility.fastq import count_most_common_sequences
+from mutility.instrumentation import Instrumentation
+
+
+@pytest.fixture
+def enabled():
+    instrumentation.reset()
+    instrumentation.enable(trace_memory=True)
+    yield instrumentation.instrumentation
+    instrumentation.disable()
+    instrumentation.reset()
+
+
+def test_instrumentation_disabled():
+    metrics = Instrumentation()
+    with metrics.stage("stage"):
+        metrics.count("records", 10)
+    assert metrics.snapshot() == {"stages": {}, "counters": []}
+
+
+def test_instrumentation_export():
+    metrics = Instrumentation()
+    metrics.enable(trace_memory=True)
+    with metrics.stage("outer"):
+        with metrics.stage("inner"):
+            data = [0] * 100000
+        del data
+    metrics.count("fastq.records_read", 5)
+    metrics.count("regex_matches", 2, pattern='a"b')
+    snapshot = json.loads(metrics.to_json())
+    assert snapshot["stages"]["outer"]["calls"] == 1
+    assert snapshot["stages"]["inner"]["peak_memory"] >= 800000
+    assert snapshot["stages"]["outer"]["peak_memory"] >= snapshot["stages"]["inner"]["peak_memory"]
+    text = metrics.to_prometheus()
+    assert 'mutility_stage_calls_total{stage="inner"} 1' in text
+    assert "mutility_fastq_records_read_total 5" in text
+    assert 'mutility_regex_matches_total{pattern="a\\"b"} 2' in text
+
+
+def test_instrumented_count_most_common_sequences(enabled, tmp_path):
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_text("".join(f"@r{i}\nACGT\n+\nIIII\n" for i in range(10)))
+    count_most_common_sequences(tmp_path / "counts.tsv", fastq)
+    snapshot = enabled.snapshot()
+    assert snapshot["stages"]["fastq.count_most_common_sequences"]["calls"] == 1
+    counters = {c["name"]: c["value"] for c in snapshot["counters"]}
+    assert counters["fastq.records_read"] == 10
+    assert counters["fastq.bytes_decompressed"] == fastq.stat().st_size
@@ -0,0 +1,110 @@
+import random
+import types
+import pandas as pd
+from mutility.fastq import reverse_complement
+from mutility.library import (
+    LibraryIndex,
+    VariantAssigner,
+    ambiguous,
+    count_library_variants,
+    unmatched,
+)
+
+# no reference exons, the first library sequence is the reference
+no_exons = types.SimpleNamespace(df_wt_exons=pd.DataFrame())
+
+
+def _library(seed=0):
+    rng = random.Random(seed)
+    flank5, flank3 = "".join(rng.choices("ACGT", k=25)), "".join(rng.choices("ACGT", k=25))
+    exon = "".join(rng.choices("ACGT", k=60))
+    sequences = [flank5 + exon + flank3]
+    for position in range(0, 60, 6):
+        base = "A" if exon[position] != "A" else "C"
+        sequences.append(flank5 + exon[:position] + base + exon[position + 1 :] + flank3)
+    sequences.append(flank5 + exon[:30] + exon[33:] + flank3)  # deletion
+    return pd.DataFrame({"ID": "Ex1", "Sequence": sequences})
+
+
+def test_library_index():
+    index = LibraryIndex(["ACGTACGT", "ACGTAC", "TTTTGG"])
+    assert index.lookup("TTTTGGAAAA") == 2
+    assert index.lookup("ACGTACGTTT") == ambiguous
+    assert index.lookup("ACGTACTT") == 1
+    assert index.lookup("GGGG") == unmatched
+
+
+def test_count_library_variants(tmp_path):
+    df_library = _library()
+    rng = random.Random(1)
+    expected = [0] * len(df_library)
+    reads = []
+    for i in range(500):
+        variant = rng.randrange(len(df_library))
+        expected[variant] += 1
+        reads.append(df_library["Sequence"][variant] + "AGATCGGAAG")
+    reads += ["N" * 100] * 7
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_text(
+        "".join(f"@r{i}\n{reverse_complement(s)}\n+\n{'I' * len(s)}\n" for i, s in enumerate(reads))
+    )
+    df_counts, df_unmatched = count_library_variants(df_library, fastq, reverse_reads=True)
+    assert df_counts["Count"].tolist() == expected
+    assert df_counts["Sequence"].tolist() == df_library["Sequence"].tolist()
+    assert df_unmatched.to_dict("records") == [
+        {"Seq": "N" * 100, "Count": 7, "Status": "unmatched"}
+    ]
+    df_counts, _ = count_library_variants(df_library, [fastq], max_reads=10, reverse_reads=True)
+    assert df_counts["Count"].sum() == 10
+    # unmatched sequences are tracked in bounded memory, frequent ones survive
+    noise = ["".join(rng.choices("ACGT", k=100)) for _ in range(200)]
+    fastq.write_text(
+        "".join(f"@r{i}\n{s}\n+\n{'I' * len(s)}\n" for i, s in enumerate(["N" * 100] * 30 + noise))
+    )
+    _, df_unmatched = count_library_variants(df_library, fastq, unmatched_top=2)
+    assert len(df_unmatched) == 2
+    assert df_unmatched.iloc[0].to_dict() == {"Seq": "N" * 100, "Count": 30, "Status": "unmatched"}
+
+
+def _mutate(sequence, position):
+    base = "G" if sequence[position] != "G" else "T"
+    return sequence[:position] + base + sequence[position + 1 :]
+
+
+def test_variant_assigner():
+    df_library = _library()
+    assigner = VariantAssigner(df_library, no_exons, max_mismatches=1)
+    sequences = df_library["Sequence"].tolist()
+    reads = [s + "AGATCGGAAG" for s in sequences]
+    reads += [_mutate(s, 100) + "AGATCGGAAG" for s in sequences]
+    reads += [_mutate(_mutate(sequences[1], 100), 5), "T" * 110]
+    rows, distances = assigner.assign(reads)
+    n = len(sequences)
+    assert rows[:n].tolist() == list(range(n))
+    assert distances[:n].tolist() == [0] * n
+    assert rows[n : 2 * n].tolist() == list(range(n))
+    assert distances[n : 2 * n].tolist() == [1] * n
+    assert rows[-2:].tolist() == [unmatched, unmatched]
+    # a read between two variants is ambiguous
+    reference = sequences[0]
+    base = ({"A", "C", "G", "T"} - {reference[25], sequences[1][25]}).pop()
+    rows, distances = assigner.assign([reference[:25] + base + reference[26:]])
+    assert rows.tolist() == [ambiguous]
+    assert distances.tolist() == [1]
+
+
+def test_count_library_variants_mismatches(tmp_path):
+    df_library = _library()
+    sequences = df_library["Sequence"].tolist()
+    reads = [_mutate(s, 80) for s in sequences] + sequences[:3]
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_text(
+        "".join(f"@r{i}\n{s}\n+\n{'I' * len(s)}\n" for i, s in enumerate(reads))
+    )
+    df_counts, _ = count_library_variants(df_library, fastq)
+    assert df_counts["Count"].sum() == 3
+    df_counts, df_unmatched = count_library_variants(
+        df_library, fastq, max_mismatches=1, comparator=no_exons, batch_size=4
+    )
+    assert df_counts["Count"].tolist() == [2, 2, 2] + [1] * (len(sequences) - 3)
+    assert len(df_unmatched) == 0
@@ -1,3 +1,5 @@
+import os
+import shutil
 import pandas as pd
 from pathlib import Path
 from mutility.mutalizer import (
@@ -18,6 +20,12 @@ from mutility.mutalizer import (
     match_pattern_effect_insertion_genomic,
     match_pattern_effect_substitution,
     CodonComparison,
+    get_codon_comparison,
+    annotate_variant_file,
+    extract_codon_from_sequence,
+    compact_mutation_columns,
+    annotate_from_effect_table,
+    effect_table_columns,
 )
 
 tests = [
@@ -413,3 +421,165 @@ def test_add_codon_columns_from_sequence():
     df = comparator.add_codon_columns_from_sequence(test_df)
     assert df["RefCodon"].tolist() == ["AGT", "GTT", "GGT", ""]
     assert df["AltCodon"].tolist() == ["AAT", "CTT", "AGT", ""]
+
+
+def test_codon_comparison_cache(tmp_path):
+    reference = tmp_path / "reference.tsv"
+    shutil.copy(Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv", reference)
+    comparator = CodonComparison(reference, cache_dir=tmp_path / "cache")
+    comparator.effect_table
+    assert comparator.effect_cache_file.exists()
+    for row, result in zip(alt_seqs, [("AGT", "AAT"), ("GTT", "CTT")]):
+        assert comparator.get_first_codon_difference(row) == result
+    # the cache is keyed by size and modification time of the reference
+    cache_file = comparator.effect_cache_file
+    os.utime(reference, ns=(0, reference.stat().st_mtime_ns + 10**9))
+    assert comparator.effect_cache_file != cache_file
+
+
+def test_get_codon_comparison_is_shared():
+    reference = Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+    comparator = get_codon_comparison(reference)
+    assert get_codon_comparison(reference) is comparator
+
+
+def _variant_table():
+    df = pd.DataFrame(alt_seqs[:3])
+    df["hg38 genomic"] = [
+        "NC_000017.11:g.7673802C>T",
+        "NC_000017.11:g.7674241C>G",
+        "NC_000017.11:g.7674947C>T",
+    ]
+    df["hg38 protein"] = [
+        "NC_000017.11(NP_000537.3):p.(Ser261Asn)",
+        "NC_000017.11(NP_000537.3):p.(Val225Leu)",
+        "NC_000017.11(NP_000537.3):p.(Gly187Ser)",
+    ]
+    df["Effect New"] = ["p.S261N", "p.V225L", "p.G187S"]
+    return df
+
+
+def test_annotate_variant_file(tmp_path):
+    comparator = CodonComparison(
+        Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+    )
+    infile = tmp_path / "variants.tsv"
+    _variant_table().to_csv(infile, sep="\t", index=False)
+    expected = extract_codon_from_sequence(_variant_table(), comparator)
+    outfile = tmp_path / "out" / "annotated.tsv"
+    assert annotate_variant_file(infile, outfile, chunksize=2, comparator=comparator) == 3
+    df = pd.read_csv(outfile, sep="\t", dtype=str, keep_default_na=False)
+    assert df["effect"].tolist() == expected["effect"].tolist()
+    assert df["AltCodon"].tolist() == ["AAT", "CTT", "AGT"]
+
+
+def test_annotate_variant_file_parquet(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    comparator = CodonComparison(
+        Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+    )
+    df_in = _variant_table()
+    # empty and integer columns in the first chunk that get values/NaN later
+    df_in["note"] = [None, None, "checked"]
+    df_in["reads"] = pd.array([2**53 + 1, 7, None], dtype="Int64")
+    expected = extract_codon_from_sequence(_variant_table(), comparator)
+    for name in ["variants.tsv", "variants.parquet"]:
+        infile = tmp_path / name
+        if name.endswith(".tsv"):
+            df_in.to_csv(infile, sep="\t", index=False)
+        else:
+            df_in.to_parquet(infile, row_group_size=2)
+        outfile = tmp_path / "out" / f"{name}.parquet"
+        assert annotate_variant_file(infile, outfile, chunksize=2, comparator=comparator) == 3
+        df = pd.read_parquet(outfile)
+        assert df["effect"].tolist() == expected["effect"].tolist()
+        assert df["note"].tolist() == [None, None, "checked"]
+        # integers stay int64, without losing precision
+        reads = pq.read_table(outfile, columns=["reads"])["reads"]
+        assert reads.type == pa.int64()
+        assert reads.to_pylist() == [2**53 + 1, 7, None]
+    annotate_variant_file(
+        tmp_path / "variants.parquet",
+        tmp_path / "subset.tsv",
+        comparator=comparator,
+        parquet_kwargs={"columns": ["ID", "Sequence"] + list(df_in.columns[2:5])},
+    )
+    assert "note" not in pd.read_csv(tmp_path / "subset.tsv", sep="\t")
+
+
+def test_annotate_variant_file_compact_parquet_growing_categories(tmp_path, monkeypatch):
+    import pyarrow.parquet as pq
+    from mutility import mutalizer
+
+    def extract(chunk, comparator, compact):
+        # the categories grow with every chunk, past the 127 that fit int8 codes
+        stop = chunk.index[-1] + 1
+        categories = [f"p.X{i}Y" for i in range(stop)]
+        chunk["effect"] = pd.Categorical(categories[chunk.index[0] :], categories=categories)
+        return chunk
+
+    monkeypatch.setattr(mutalizer, "extract_codon_from_sequence", extract)
+    infile = tmp_path / "variants.tsv"
+    pd.DataFrame({"ID": range(600), "Sequence": "ACGT"}).to_csv(infile, sep="\t", index=False)
+    outfile = tmp_path / "annotated.parquet"
+    rows = annotate_variant_file(infile, outfile, chunksize=100, comparator=object(), compact=True)
+    assert rows == 600
+    assert pq.read_table(outfile)["effect"].to_pylist() == [f"p.X{i}Y" for i in range(600)]
+
+
+def test_compact_mutation_columns():
+    comparator = CodonComparison(
+        Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+    )
+    plain = extract_codon_from_sequence(_variant_table(), comparator)
+    df = compact_mutation_columns(plain.copy())
+    assert df["codon"].dtype == "Int64"
+    assert df["codon"].tolist() == [261, 225, 187]
+    for column in ["type_g", "type_p", "codon_ref", "aa_ref", "aa_alt"]:
+        assert df[column].dtype == "category"
+        assert df[column].astype(str).tolist() == plain[column].tolist()
+    other = compact_mutation_columns(pd.DataFrame({"aa_ref": ["X"], "codon": [""]}))
+    assert (other["aa_ref"].cat.categories == df["aa_ref"].cat.categories).all()
+    assert other["codon"].isna().all()
+
+
+def test_annotate_from_effect_table(tmp_path):
+    reference = Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+    comparator = CodonComparison(reference, cache_dir=tmp_path)
+    expected = extract_codon_from_sequence(_variant_table(), comparator)
+    df = annotate_from_effect_table(_variant_table(), comparator)
+    pd.testing.assert_frame_equal(df[effect_table_columns], expected[effect_table_columns])
+    # deletion of codon 130 (Leu) and wildtype
+    wt = comparator.df_wt_exons.loc["Ex5"]
+    sequence = wt["5_contant"] + wt["5_overhang"] + wt["Exon"] + wt["3_overhang"] + wt["3_contant"]
+    deletion = sequence[:25 + 12] + sequence[25 + 15 :]
+    rows = pd.DataFrame({"ID": ["Ex5", "Ex5"], "Sequence": [deletion, sequence]})
+    df = annotate_from_effect_table(rows, comparator)
+    assert df["effect"].tolist() == ["p.L130del", ""]
+    assert df["type_g_fine"].tolist() == ["del3", ""]
+    cached = CodonComparison(reference, cache_dir=tmp_path)
+    assert len(cached.effect_table) == len(comparator.effect_table)
+    assert (cached.effect_table.keys == comparator.effect_table.keys).all()
+
+
+def test_annotate_from_effect_table_double_mutant():
+    reference = Path(__file__).parent / "data" / "Sequences_lib_5678_with_bbs1.tsv"
+    comparator = CodonComparison(reference)
+    wt = comparator.df_wt_exons.loc["Ex5"]
+    sequence = wt["5_contant"] + wt["5_overhang"] + wt["Exon"] + wt["3_overhang"] + wt["3_contant"]
+    start = 25 + 12
+
+    def substitute(seq, position, codon):
+        return seq[:position] + codon + seq[position + 3 :]
+
+    codon = "AAA" if sequence[start : start + 3] != "AAA" else "CCC"
+    other = "GGG" if sequence[start + 60 : start + 63] != "GGG" else "TTT"
+    single = substitute(sequence, start, codon)
+    double = substitute(single, start + 60, other)
+    rows = pd.DataFrame({"ID": ["Ex5", "Ex5"], "Sequence": [single, double]})
+    df = annotate_from_effect_table(rows, comparator)
+    assert df["AltCodon"].tolist() == [codon, ""]
+    assert df["effect"][0] != ""
+    assert df["effect"][1] == df["type_p"][1] == ""
@@ -0,0 +1,240 @@
+import http.server
+import json
+import os
+import subprocess
+import sys
+import threading
+import urllib.parse
+from pathlib import Path
+import mutility
+import pandas as pd
+import pypipegraph as ppg
+import pytest
+from mutility.uniprot import (
+    IDMapper,
+    export_kinase_snapshot,
+    get_kinase_from_url,
+    get_kinases_with_ensembl_ids,
+    load_kinase_snapshot,
+    parse_kinase_families,
+    uniprot_to_ensenbl,
+    write_kinases,
+)
+from mutility.util import DownloadCache
+
+MAPPINGS = {
+    "P04637": ["ENSG00000141510.18"],
+    "P02340": ["ENSMUSG00000059552.14"],
+    "Q00987": ["ENSG00000135679.26", "ENSG00000999999.1"],
+    "P31750": ["ENSMUSG00000001729.15"],
+    "Q60823": ["ENSMUSG00000004056.16"],
+    "Q9Z2A0": ["ENSMUSG00000024122.17"],
+    "Q9Z265": ["ENSMUSG00000029521.12"],
+}
+
+
+class _IDMappingHandler(http.server.BaseHTTPRequestHandler):
+    """Local stand-in for the UniProt ID mapping REST service."""
+
+    jobs = {}
+    submitted = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body="", content_type="application/json", headers=None):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        ids = form["ids"][0].split(",")
+        job_id = f"job{len(self.jobs)}"
+        self.jobs[job_id] = {"ids": ids, "polls": 0}
+        self.submitted.append(ids)
+        self._send(200, json.dumps({"jobId": job_id}))
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        job_id = parsed.path.rsplit("/", 1)[-1]
+        job = self.jobs[job_id]
+        if parsed.path.startswith("/idmapping/status/"):
+            job["polls"] += 1
+            if job["polls"] == 1:
+                self._send(200, json.dumps({"jobStatus": "RUNNING"}))
+            else:
+                self._send(303, "", headers={"Location": f"/idmapping/results/{job_id}"})
+        else:
+            lines = ["From\tTo"]
+            for id_ in job["ids"]:
+                lines.extend(f"{id_}\t{target}" for target in MAPPINGS.get(id_, []))
+            self._send(200, "\n".join(lines) + "\n", "text/plain")
+
+
+@pytest.fixture
+def id_mapping_server():
+    _IDMappingHandler.jobs.clear()
+    _IDMappingHandler.submitted.clear()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _IDMappingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_id_mapper(id_mapping_server, tmp_path):
+    cache_file = tmp_path / "cache" / "idmapping.sqlite"
+    mapper = IDMapper(cache_file, batch_size=2, base_url=id_mapping_server, poll_interval=0)
+    df = mapper.map(["P04637", "P02340", "Q00987", "UNKNOWN"])
+    assert sorted(len(ids) for ids in _IDMappingHandler.submitted) == [2, 2]
+    assert len(df) == 4
+    assert df[df["from"] == "Q00987"]["to"].tolist() == MAPPINGS["Q00987"]
+    # cached results, including IDs without mapping, are not requested again
+    mapper = IDMapper(cache_file, batch_size=2, base_url=id_mapping_server, poll_interval=0)
+    df = mapper.map(["P04637", "UNKNOWN", "P12345"])
+    assert _IDMappingHandler.submitted[-1] == ["P12345"]
+    assert df["to"].tolist() == ["ENSG00000141510.18"]
+    # expired entries are refetched
+    mapper = IDMapper(cache_file, ttl=0, base_url=id_mapping_server, poll_interval=0)
+    mapper.map(["P04637"])
+    assert _IDMappingHandler.submitted[-1] == ["P04637"]
+
+
+def test_uniprot_to_ensembl(id_mapping_server):
+    mapper = IDMapper(base_url=id_mapping_server, poll_interval=0)
+    df = uniprot_to_ensenbl(["P04637", "P02340"], mapper)
+    assert df.columns.tolist() == ["uniprot", "gene_stable_id"]
+    assert df["gene_stable_id"].tolist() == ["ENSG00000141510", "ENSMUSG00000059552"]
+
+
+PKINFAM = """\
+                ===========================================
+                Classification of protein kinase families
+                ===========================================
+
+Some introductory text (P00000) mentioning FAKE_HUMAN (P99999).
+
+=======================================================================
+AGC Ser/Thr protein kinase family
+=======================================================================
+AKT1       AKT1_HUMAN  (P31749)     Akt1       AKT1_MOUSE  (P31750)
+AKT2       AKT2_HUMAN  (P31751)     Akt2       AKT2_MOUSE  (Q60823)
+
+PDPK1      PDPK1_HUMAN (O15530)     Pdpk1      PDPK1_MOUSE (Q9Z2A0)
+
+=======================================================================
+CAMK Ser/Thr protein kinase family
+=======================================================================
+CHK2       CHK2_HUMAN  (O96017)     Chek2      CHK2_MOUSE  (Q9Z265)
+
+-----------------------------------------------------------------------
+Copyrighted by the UniProt Consortium
+-----------------------------------------------------------------------
+"""
+
+
+def test_parse_kinase_families(tmp_path):
+    df = parse_kinase_families(PKINFAM.splitlines(True))
+    assert len(df) == 8
+    assert set(df["species"]) == {"human", "mouse"}
+    path = tmp_path / "pkinfam.txt"
+    path.write_text(PKINFAM)
+    mouse = get_kinase_from_url("mouse", path)
+    assert list(mouse.columns) == ["uniprot_id", "kinase class"]
+    assert mouse["uniprot_id"].tolist() == ["P31750", "Q60823", "Q9Z2A0", "Q9Z265"]
+    assert mouse["kinase class"].tolist() == ["AGC Ser/Thr protein kinase family"] * 3 + [
+        "CAMK Ser/Thr protein kinase family"
+    ]
+    both = get_kinase_from_url(["human", "mouse"], path)
+    assert (both.groupby("species").size() == 4).all()
+    with pytest.raises(ValueError):
+        get_kinase_from_url("rat", path)
+
+
+def test_write_kinases(id_mapping_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = tmp_path / "pkinfam.txt"
+    source.write_text(PKINFAM)
+    outfile = tmp_path / "results" / "kinases.tsv"
+    cache = DownloadCache(tmp_path / "cache")
+
+    def run():
+        ppg.new_pipegraph(quiet=True, dump_graph=False, interactive=False)
+        write_kinases(outfile, "mouse", source, cache, base_url=id_mapping_server)
+        ppg.run_pipegraph()
+
+    run()
+    df = pd.read_csv(outfile, sep="\t")
+    assert df["gene_stable_id"].tolist() == [
+        "ENSMUSG00000001729",
+        "ENSMUSG00000004056",
+        "ENSMUSG00000024122",
+        "ENSMUSG00000029521",
+    ]
+    mtime = outfile.stat().st_mtime_ns
+    run()
+    assert outfile.stat().st_mtime_ns == mtime
+    assert len(_IDMappingHandler.submitted) == 1
+    # a changed source document invalidates the table, mappings are cached
+    source.write_text(PKINFAM.replace("(Q9Z265)", "(Q9Z265)\nCHK1 CHK1_MOUSE (O35280)"))
+    run()
+    assert len(pd.read_csv(outfile, sep="\t")) == 5
+    assert _IDMappingHandler.submitted[-1] == ["O35280"]
+
+
+def test_kinase_snapshot(id_mapping_server, tmp_path):
+    source = tmp_path / "pkinfam.txt"
+    source.write_text(PKINFAM)
+    mapper = IDMapper(base_url=id_mapping_server, poll_interval=0)
+    snapshot = export_kinase_snapshot(tmp_path / "kinases.v1.parquet", mapper=mapper, source=source)
+    assert len(load_kinase_snapshot(snapshot)) == 8
+    expected = get_kinases_with_ensembl_ids("mouse", mapper, source)
+    # the default mapper would need network access, the snapshot does not
+    df = get_kinases_with_ensembl_ids("mouse", snapshot=snapshot)
+    assert df.reset_index(drop=True).equals(expected.reset_index(drop=True))
+    human = get_kinases_with_ensembl_ids("human", snapshot=snapshot)
+    assert human["gene_stable_id"].isna().all()
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(snapshot).replace_schema_metadata({"mutility_snapshot_version": "0"})
+    pq.write_table(table, tmp_path / "old.parquet")
+    with pytest.raises(ValueError):
+        load_kinase_snapshot(tmp_path / "old.parquet")
+    with pytest.raises(ValueError, match="export_kinase_snapshot"):
+        load_kinase_snapshot(tmp_path / "missing.parquet")
+
+
+def test_kinase_snapshot_default_location(id_mapping_server, tmp_path, monkeypatch):
+    source = tmp_path / "pkinfam.txt"
+    source.write_text(PKINFAM)
+    monkeypatch.setattr(mutility.uniprot, "pkinfam_url", str(source))
+    monkeypatch.setenv("MUTILITY_CACHE", str(tmp_path / "cache"))
+    monkeypatch.delenv("MUTILITY_KINASE_SNAPSHOT", raising=False)
+    mapper = IDMapper(base_url=id_mapping_server, poll_interval=0)
+    # without a snapshot, the table is fetched
+    expected = get_kinases_with_ensembl_ids("mouse", mapper)
+    # snapshots are exported to the user cache, not into the package
+    snapshot = export_kinase_snapshot(mapper=mapper)
+    assert snapshot == tmp_path / "cache" / "kinases.v1.parquet"
+    df = get_kinases_with_ensembl_ids("mouse")
+    assert df.reset_index(drop=True).equals(expected.reset_index(drop=True))
+
+
+def test_uniprot_imports_no_network_libraries():
+    code = (
+        "import sys, mutility.uniprot; "
+        "print(sorted({'requests', 'parse', 'pypipegraph'} & set(sys.modules)))"
+    )
+    env = dict(os.environ, PYTHONPATH=str(Path(mutility.__file__).parents[1]))
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True, env=env
+    )
+    assert out.stdout.strip() == "[]"